@@ -3,7 +3,39 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 import re
+import os
 import sys
+import atexit
+import socket
+import shutil
+import hashlib
+import logging
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+
+# control sockets of ssh master connections, one per target for the whole run
+control_dir = None
+masters = {}
+
+def get_control_dir():
+	global control_dir
+	if not control_dir:
+		control_dir = tempfile.mkdtemp(prefix="pgdist-ssh-")
+	return control_dir
+
+def close_masters():
+	global control_dir
+	for control_path, ssh in masters.items():
+		logging.debug("close ssh master: %s" % (ssh,))
+		with open(os.devnull, "w") as devnull:
+			subprocess.call(["ssh", "-o", "ControlPath=%s" % (control_path,), "-O", "exit", ssh], stdout=devnull, stderr=devnull)
+	masters.clear()
+	if control_dir:
+		shutil.rmtree(control_dir, True)
+		control_dir = None
+
+atexit.register(close_masters)
 
 class Address:
 	def __init__(self, addr):
@@ -11,6 +43,8 @@ class Address:
 		self.ssh = None
 		self.ssh_port = None
 		self.pg = None
+		self.tunnel_address = None
+		self.compress = None
 		if '//' in addr:
 			ssh_str, self.pg = addr.split("//",1)
 
@@ -70,7 +104,63 @@ class Address:
 	def get_param(self, dbname=None):
 		return self.parse(dbname)["param"]
 
-	def cache_file(self, cache_type):
-		if cache_type:
-			return "/tmp/pgdist-cache-%s-%s" % (self.addr.replace("/", "-"), cache_type)
-		return "/tmp/pgdist-cache-%s" % (self.addr.replace("/", "-"),)
+	def ssh_command(self):
+		# ssh reusing master connection of this target
+		control_path = os.path.join(get_control_dir(), hashlib.md5("%s:%s" % (self.ssh, self.ssh_port)).hexdigest()[:16])
+		masters[control_path] = self.ssh
+		args = ["ssh", "-o", "ControlMaster=auto", "-o", "ControlPath=%s" % (control_path,), "-o", "ControlPersist=yes"]
+		if self.ssh_port:
+			args += ["-p", self.ssh_port]
+		args.append(self.ssh)
+		return args
+
+	def tunnel(self):
+		# local address forwarded through ssh master to postgres, None without host in PGCONN
+		if self.tunnel_address is not None:
+			return self.tunnel_address or None
+		# do not try again when tunnel fails
+		self.tunnel_address = False
+		pg = self.parse()
+		if not self.ssh or not pg["host"]:
+			return None
+		s = socket.socket()
+		s.bind(("127.0.0.1", 0))
+		local_port = s.getsockname()[1]
+		s.close()
+		ssh_command = self.ssh_command()
+		with open(os.devnull, "w") as devnull:
+			# start master and add forward to it
+			if subprocess.call(ssh_command + ["true"], stdout=devnull, stderr=devnull) != 0:
+				return None
+			forward = "127.0.0.1:%d:%s:%s" % (local_port, pg["host"], pg["port"] or "5432")
+			if subprocess.call(ssh_command[:-1] + ["-O", "forward", "-L", forward, self.ssh], stdout=devnull, stderr=devnull) != 0:
+				return None
+		logging.verbose("ssh tunnel %s: %s" % (self.ssh, forward))
+		login = ""
+		if pg["user"]:
+			login = pg["user"]
+			if pg["password"]:
+				login += ":" + pg["password"]
+			login += "@"
+		addr = "%s127.0.0.1:%d/%s" % (login, local_port, pg["dbname"] or "")
+		if pg["param"]:
+			addr += "?" + pg["param"]
+		self.tunnel_address = Address(addr)
+		return self.tunnel_address
+
+	def compressor(self):
+		# zstd or gzip installed on both sides of ssh, None when output is not compressed
+		if self.compress is not None:
+			return self.compress or None
+		self.compress = False
+		if not self.ssh:
+			return None
+		probe = "for c in zstd gzip; do command -v $c >/dev/null 2>&1 && echo $c; done"
+		process = subprocess.Popen(self.ssh_command() + [probe], stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+		output, unused_err = process.communicate()
+		for tool in output.split():
+			if find_executable(tool):
+				self.compress = tool
+				break
+		logging.verbose("ssh %s compression: %s" % (self.ssh, self.compress or "none"))
+		return self.compress or None
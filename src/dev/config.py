@@ -15,10 +15,19 @@ except ImportError:
 	import ConfigParser as configparser
 
 import address
+import local_cluster
 
 test_db = None
+# all servers of test_db, test_db is one of them
+test_dbs = []
 config = None
 git_diff = False
+# psql echoes commands, without echo errors are located by line number
+echo_queries = True
+# file with whole output of psql
+psql_log = None
+# test databases are created from templates of loaded projects
+use_templates = True
 
 def load(fname):
 	global config
@@ -47,12 +56,21 @@ def load(fname):
 def load_file(fname):
 	logging.verbose("Load config: %s" % (fname,))
 	global test_db
+	global test_dbs
 	global config
 	try:
 		config = configparser.ConfigParser()
 		config.read(fname)
 		if config.get('pgdist', 'test_db'):
-			test_db = address.Address(config.get('pgdist', 'test_db'))
+			# more servers separated by spaces or commas, the least loaded is selected
+			test_dbs = []
+			for addr in re.split(r"[\s,]+", config.get('pgdist', 'test_db').strip()):
+				if addr == "local":
+					# private cluster of user, see local_cluster
+					test_dbs.append(local_cluster.LocalAddress())
+				else:
+					test_dbs.append(address.Address(addr))
+			test_db = test_dbs[0]
 		else:
 			logging.error("Load config: %s failed" % (fname))
 			sys.exit(1)
@@ -60,6 +78,12 @@ def load_file(fname):
 		logging.error("Load config: %s fail: %s" % (fname, str(e)))
 		sys.exit(1)
 
+def get(option, default=None):
+	# option of section pgdist in loaded config
+	if config and config.has_option('pgdist', option):
+		return config.get('pgdist', option)
+	return default
+
 def check_set_test_db():
 	global test_db
 	if not test_db:
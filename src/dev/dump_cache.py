@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import io
+import gzip
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+import config
+import utils
+
+# seconds entries of type are valid, in config: cache_ttl_<type>
+DEFAULT_TTL = 4 * 60 * 60
+# seconds entries with fingerprint are valid while fingerprint of database matches, in config: cache_ttl_fingerprint
+DEFAULT_FINGERPRINT_TTL = 7 * 24 * 60 * 60
+# size of all entries in MB, least recently used entries are removed over it, in config: cache_size
+DEFAULT_SIZE = 256
+
+class Entry:
+	def __init__(self, fname):
+		self.fname = fname
+		with io.open(fname + ".json", encoding="utf8") as f:
+			meta = json.load(f)
+		self.addr = meta["addr"]
+		self.entry_type = meta["type"]
+		self.params = meta["params"]
+		self.created = meta["created"]
+		self.fingerprint = meta.get("fingerprint")
+		self.size = os.path.getsize(fname)
+		# data file is touched by every read
+		self.used = os.path.getmtime(fname)
+
+	def age(self):
+		return time.time() - self.created
+
+	def expired(self):
+		if self.fingerprint:
+			return self.age() > fingerprint_ttl()
+		return self.age() > ttl(self.entry_type)
+
+	def valid(self, fingerprint):
+		# entry with fingerprint is checked by fingerprint of database, by age otherwise
+		if self.fingerprint and fingerprint:
+			return self.fingerprint == fingerprint and not self.expired()
+		return self.age() <= ttl(self.entry_type)
+
+	def remove(self):
+		for fname in (self.fname, self.fname + ".json"):
+			if os.path.exists(fname):
+				os.remove(fname)
+
+def get_dir():
+	directory = config.get("cache_dir") or os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.environ["HOME"], ".cache"), "pgdist")
+	if not os.path.isdir(directory):
+		os.makedirs(directory, 0o700)
+	return directory
+
+def ttl(entry_type):
+	return int(config.get("cache_ttl_%s" % (entry_type,)) or DEFAULT_TTL)
+
+def fingerprint_ttl():
+	return int(config.get("cache_ttl_fingerprint") or DEFAULT_FINGERPRINT_TTL)
+
+def max_size():
+	return int(config.get("cache_size") or DEFAULT_SIZE) * 1024 * 1024
+
+def entry_file(address, entry_type, params):
+	key = hashlib.sha1(json.dumps([address.addr, entry_type, params], sort_keys=True)).hexdigest()
+	return os.path.join(get_dir(), "%s-%s.gz" % (entry_type, key))
+
+def get(address, entry_type, params=None, fingerprint=None):
+	# cached data or None when entry is missing, expired or database changed
+	fname = entry_file(address, entry_type, params)
+	with utils.Lock(get_dir()):
+		if not os.path.isfile(fname) or not os.path.isfile(fname + ".json"):
+			return None
+		entry = Entry(fname)
+		if not entry.valid(fingerprint):
+			return None
+		f = gzip.open(fname, "rb")
+		try:
+			data = unicode(f.read(), "utf8")
+		finally:
+			f.close()
+		os.utime(fname, None)
+	logging.verbose("load %s from cache %s" % (entry_type, fname))
+	return data
+
+def put(address, entry_type, data, params=None, fingerprint=None):
+	fname = entry_file(address, entry_type, params)
+	if type(data) == unicode:
+		data = data.encode("utf8")
+	directory = get_dir()
+	with utils.Lock(get_dir(), exclusive=True):
+		# written to temporary files and renamed, readers never see part of entry
+		(fd, tmp_data) = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+		os.close(fd)
+		f = gzip.open(tmp_data, "wb")
+		try:
+			f.write(data)
+		finally:
+			f.close()
+		(fd, tmp_meta) = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+		with os.fdopen(fd, "w") as f:
+			json.dump({"addr": address.addr, "type": entry_type, "params": params, "created": time.time(), "fingerprint": fingerprint}, f)
+		os.rename(tmp_data, fname)
+		os.rename(tmp_meta, fname + ".json")
+		evict()
+	logging.verbose("store %s to cache %s" % (entry_type, fname))
+
+def entries():
+	directory = get_dir()
+	r = []
+	for name in sorted(os.listdir(directory)):
+		if name.endswith(".gz") and os.path.isfile(os.path.join(directory, name + ".json")):
+			r.append(Entry(os.path.join(directory, name)))
+	return r
+
+def evict(remove_all=False):
+	# expired entries and least recently used entries over size limit, caller holds exclusive lock
+	removed = []
+	kept = []
+	for entry in entries():
+		if remove_all or entry.expired():
+			entry.remove()
+			removed.append(entry)
+		else:
+			kept.append(entry)
+	kept.sort(key=lambda entry: entry.used)
+	size = sum([entry.size for entry in kept])
+	while kept and size > max_size():
+		entry = kept.pop(0)
+		size -= entry.size
+		entry.remove()
+		removed.append(entry)
+	return removed
+
+def prune(remove_all=False):
+	with utils.Lock(get_dir(), exclusive=True):
+		return evict(remove_all)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import sys
+import time
+import atexit
+import shutil
+import urllib
+import getpass
+import logging
+import tempfile
+import threading
+import subprocess
+from distutils.spawn import find_executable
+
+import config
+import utils
+import address
+
+# seconds the cluster runs without use, in config: test_db_local_idle
+DEFAULT_IDLE = 30 * 60
+# port is only a part of socket name, the cluster does not listen on TCP
+PORT = 5432
+# user running pgdist is superuser of the cluster
+USER = getpass.getuser()
+# test loads do not need durability
+SETTINGS = ("fsync=off", "synchronous_commit=off", "full_page_writes=off", "listen_addresses=''")
+# directory of postgres binaries given to watch process
+bindir = None
+
+def get_dir():
+	directory = config.get("test_db_local_dir")
+	if not directory:
+		# tmpfs when available
+		base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+		directory = os.path.join(base, "pgdist-%s" % (getpass.getuser(),))
+	if not os.path.isdir(directory):
+		os.makedirs(directory, 0o700)
+	return directory
+
+def idle_timeout():
+	return int(config.get("test_db_local_idle") or DEFAULT_IDLE)
+
+def bin_command(name):
+	# config test_db_local_bindir, PATH or bindir of pg_config
+	directory = bindir or config.get("test_db_local_bindir")
+	if directory:
+		return os.path.join(directory, name)
+	if find_executable(name) or not find_executable("pg_config"):
+		return name
+	return os.path.join(subprocess.check_output(["pg_config", "--bindir"]).strip(), name)
+
+def data_dir(directory):
+	return os.path.join(directory, "data")
+
+def used_file(directory):
+	return os.path.join(directory, "used")
+
+def run(args):
+	logging.verbose("run: %s" % (" ".join(args),))
+	try:
+		process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	except OSError as e:
+		logging.error("Local test_db: %s fail: %s" % (args[0], e))
+		sys.exit(1)
+	output = process.communicate()[0]
+	if process.returncode:
+		logging.error("Local test_db: %s fail:\n%s" % (args[0], output))
+		sys.exit(1)
+
+def running(directory):
+	with open(os.devnull, "w") as devnull:
+		return subprocess.call([bin_command("pg_ctl"), "status", "-D", data_dir(directory)], stdout=devnull, stderr=devnull) == 0
+
+def touch(directory):
+	with open(used_file(directory), "a"):
+		os.utime(used_file(directory), None)
+
+def start(directory):
+	# cluster is initialized and started once, next commands reuse it until it is idle
+	with utils.Lock(directory, exclusive=True):
+		touch(directory)
+		if not running(directory):
+			if not os.path.isfile(os.path.join(data_dir(directory), "PG_VERSION")):
+				shutil.rmtree(data_dir(directory), True)
+				logging.info("initdb local test_db: %s" % (data_dir(directory),))
+				run([bin_command("initdb"), "-N", "-A", "trust", "-U", USER, "-E", "UTF8", "-D", data_dir(directory)])
+			options = ["-c %s" % (setting,) for setting in SETTINGS]
+			options += ["-c unix_socket_directories=%s" % (directory,), "-c port=%d" % (PORT,)]
+			run([bin_command("pg_ctl"), "start", "-w", "-D", data_dir(directory), "-l", os.path.join(directory, "postgresql.log"), "-o", " ".join(options)])
+		start_watch(directory)
+	atexit.register(touch, directory)
+
+def start_watch(directory):
+	# detached process stops the cluster after idle timeout, one per cluster
+	pid_file = os.path.join(directory, "watch.pid")
+	if os.path.isfile(pid_file):
+		try:
+			with open(pid_file) as f:
+				os.kill(int(f.read()), 0)
+			return
+		except (OSError, ValueError):
+			pass
+	with open(os.devnull, "r+") as devnull:
+		process = subprocess.Popen([sys.executable, os.path.splitext(os.path.abspath(__file__))[0] + ".py", "watch", directory, str(idle_timeout()), config.get("test_db_local_bindir") or ""],
+			stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+	with open(pid_file, "w") as f:
+		f.write("%d" % (process.pid,))
+
+def connected(directory):
+	# client connections besides this one
+	cmd = "SELECT count(*) FROM pg_catalog.pg_stat_activity WHERE usename IS NOT NULL AND pid <> pg_catalog.pg_backend_pid();"
+	try:
+		output = subprocess.check_output([bin_command("psql"), "-h", directory, "-p", str(PORT), "-U", USER, "-d", "postgres", "-w", "-At", "-c", cmd])
+	except (OSError, subprocess.CalledProcessError):
+		return False
+	return int(output.strip() or 0) > 0
+
+def stop(directory):
+	# caller holds exclusive lock, data of cluster are removed
+	if running(directory):
+		run([bin_command("pg_ctl"), "stop", "-m", "fast", "-D", data_dir(directory)])
+	shutil.rmtree(data_dir(directory), True)
+
+def shutdown(directory):
+	with utils.Lock(directory, exclusive=True):
+		stop(directory)
+
+def watch(directory, timeout):
+	while True:
+		time.sleep(min(60, timeout))
+		with utils.Lock(directory, exclusive=True):
+			if not running(directory):
+				break
+			if time.time() - os.path.getmtime(used_file(directory)) > timeout and not connected(directory):
+				stop(directory)
+				break
+	pid_file = os.path.join(directory, "watch.pid")
+	if os.path.isfile(pid_file):
+		os.remove(pid_file)
+
+class LocalAddress(address.Address):
+	# test_db: local, connection by Unix socket, cluster is started by first use
+	def __init__(self):
+		self.directory = get_dir()
+		address.Address.__init__(self, "%s@%s:%d/postgres" % (urllib.quote(USER.encode("utf8"), safe=""), urllib.quote(self.directory.encode("utf8"), safe=""), PORT))
+		self.started = False
+		self.start_lock = threading.Lock()
+
+	def get_pg(self, dbname=None):
+		with self.start_lock:
+			if not self.started:
+				start(self.directory)
+				self.started = True
+		return address.Address.get_pg(self, dbname)
+
+if __name__ == "__main__":
+	# watch DIRECTORY TIMEOUT BINDIR, started by start_watch
+	if sys.argv[1:2] == ["watch"]:
+		logging.verbose = logging.debug
+		bindir = sys.argv[4] or None
+		watch(sys.argv[2], int(sys.argv[3]))
@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import re
+import sys
+import json
+import logging
+
+import pg_conn
+import pg_parser
+from pg_types import *
+
+# json_build_object
+MIN_SERVER_VERSION = 90400
+
+# start of catalog JSON in output of psql
+CATALOG_MARK = "PGDIST_CATALOG="
+
+EXCLUDE_SCHEMAS = "('pg_catalog', 'information_schema', 'pgdist')"
+
+# privileges in order of pg_dump
+PRIVILEGES = {
+	"TABLE": [("r", "SELECT"), ("a", "INSERT"), ("x", "REFERENCES"), ("d", "DELETE"), ("t", "TRIGGER"), ("D", "TRUNCATE"), ("m", "MAINTAIN"), ("w", "UPDATE")],
+	"SEQUENCE": [("r", "SELECT"), ("U", "USAGE"), ("w", "UPDATE")],
+	"FUNCTION": [("X", "EXECUTE")],
+	"SCHEMA": [("C", "CREATE"), ("U", "USAGE")],
+	"TYPE": [("U", "USAGE")],
+	"TABLES": [("r", "SELECT"), ("a", "INSERT"), ("x", "REFERENCES"), ("d", "DELETE"), ("t", "TRIGGER"), ("D", "TRUNCATE"), ("m", "MAINTAIN"), ("w", "UPDATE")],
+	"SEQUENCES": [("r", "SELECT"), ("U", "USAGE"), ("w", "UPDATE")],
+	"FUNCTIONS": [("X", "EXECUTE")],
+	"TYPES": [("U", "USAGE")],
+	"SCHEMAS": [("C", "CREATE"), ("U", "USAGE")],
+}
+
+DEFAULT_ACL_TYPES = {"r": "TABLES", "S": "SEQUENCES", "f": "FUNCTIONS", "T": "TYPES", "n": "SCHEMAS"}
+
+STORAGE = {"p": "PLAIN", "e": "EXTERNAL", "m": "MAIN", "x": "EXTENDED"}
+
+SEQUENCE_LIMITS = {
+	"smallint": (-32768, 32767),
+	"integer": (-2147483648, 2147483647),
+	"bigint": (-9223372036854775808, 9223372036854775807),
+}
+
+# GUC with list values, items are quoted separately by pg_dump
+LIST_GUC = ("local_preload_libraries", "search_path", "session_preload_libraries", "shared_preload_libraries", "temp_tablespaces", "unix_socket_directories")
+
+def not_extension_member(catalog, oid):
+	return "NOT EXISTS (SELECT 1 FROM pg_depend d WHERE d.classid = '%s'::regclass AND d.objid = %s AND d.deptype = 'e')" % (catalog, oid)
+
+def catalog_query(server_version):
+	if server_version >= 110000:
+		prokind = "p.prokind"
+	else:
+		prokind = "CASE WHEN p.proisagg THEN 'a' WHEN p.proiswindow THEN 'w' ELSE 'f' END"
+	if server_version >= 140000:
+		sqlbody = "CASE WHEN p.prosqlbody IS NOT NULL THEN pg_get_function_sqlbody(p.oid) END"
+	else:
+		sqlbody = "NULL"
+	if server_version >= 120000:
+		support = "NULLIF(p.prosupport::text, '-')"
+		generated = "a.attgenerated"
+	else:
+		support = "NULL"
+		generated = "''"
+	if server_version >= 170000:
+		stattarget = "coalesce(a.attstattarget, -1)"
+	else:
+		stattarget = "a.attstattarget"
+	if server_version >= 100000:
+		partkeydef = "CASE WHEN c.relkind = 'p' THEN pg_get_partkeydef(c.oid) END"
+		not_partition = "NOT c.relispartition"
+		sequence = """SELECT format_type(s.seqtypid, NULL) AS type, s.seqstart::text AS start, s.seqincrement::text AS increment,
+					s.seqmin::text AS min, s.seqmax::text AS max, s.seqcache::text AS cache, s.seqcycle AS cycle
+				FROM pg_sequence s
+				WHERE s.seqrelid = c.oid"""
+	else:
+		partkeydef = "NULL"
+		not_partition = "true"
+		# parameters are in the sequence relation itself, read only for sequences
+		sequence = """SELECT 'bigint' AS type, (xpath('/row/start_value/text()', seq.data))[1]::text AS start, (xpath('/row/increment_by/text()', seq.data))[1]::text AS increment,
+					(xpath('/row/min_value/text()', seq.data))[1]::text AS min, (xpath('/row/max_value/text()', seq.data))[1]::text AS max,
+					(xpath('/row/cache_value/text()', seq.data))[1]::text AS cache, (xpath('/row/is_cycled/text()', seq.data))[1]::text::boolean AS cycle
+				FROM query_to_xml(format('SELECT * FROM %s', c.oid::regclass), false, true, '') AS seq(data)
+				WHERE c.relkind = 'S'"""
+	if server_version >= 90600:
+		initprivs = "(SELECT i.initprivs FROM pg_init_privs i WHERE i.objoid = n.oid AND i.classoid = 'pg_namespace'::regclass AND i.objsubid = 0)"
+		parallel = "p.proparallel"
+	else:
+		initprivs = "NULL"
+		parallel = "'u'"
+
+	queries = {}
+
+	queries["schemas"] = """SELECT quote_ident(n.nspname) AS name, quote_ident(pg_get_userbyid(n.nspowner)) AS owner,
+			coalesce(n.nspacl, acldefault('n', n.nspowner))::text[] AS acl,
+			coalesce(%s, acldefault('n', n.nspowner))::text[] AS acldefault
+		FROM pg_namespace n
+		WHERE n.nspname NOT IN %s AND n.nspname !~ '^pg_(toast|temp_)' AND %s
+		ORDER BY 1""" % (initprivs, EXCLUDE_SCHEMAS, not_extension_member("pg_namespace", "n.oid"))
+
+	queries["default_acl"] = """SELECT quote_ident(n.nspname) AS schema, quote_ident(pg_get_userbyid(a.defaclrole)) AS role, a.defaclobjtype AS type, a.defaclacl::text[] AS acl
+		FROM pg_default_acl a JOIN pg_namespace n ON n.oid = a.defaclnamespace
+		WHERE n.nspname NOT IN %s
+		ORDER BY 1, 2, 3""" % (EXCLUDE_SCHEMAS,)
+
+	queries["extensions"] = """SELECT quote_ident(e.extname) AS name, quote_ident(n.nspname) AS schema, obj_description(e.oid, 'pg_extension') AS comment
+		FROM pg_extension e JOIN pg_namespace n ON n.oid = e.extnamespace
+		WHERE e.oid >= 16384
+		ORDER BY 1"""
+
+	queries["types"] = """SELECT quote_ident(n.nspname) || '.' || quote_ident(t.typname) AS name, t.typtype AS type, quote_ident(pg_get_userbyid(t.typowner)) AS owner,
+			(SELECT array_agg(quote_literal(e.enumlabel) ORDER BY e.enumsortorder) FROM pg_enum e WHERE e.enumtypid = t.oid) AS labels,
+			(SELECT array_agg(quote_ident(a.attname) || ' ' || format_type(a.atttypid, a.atttypmod)
+					|| CASE WHEN a.attcollation <> 0 AND a.attcollation <> at.typcollation
+						THEN ' COLLATE ' || (SELECT quote_ident(cn.nspname) || '.' || quote_ident(co.collname) FROM pg_collation co JOIN pg_namespace cn ON cn.oid = co.collnamespace WHERE co.oid = a.attcollation)
+						ELSE '' END
+					ORDER BY a.attnum)
+				FROM pg_attribute a JOIN pg_type at ON at.oid = a.atttypid
+				WHERE a.attrelid = t.typrelid AND a.attnum > 0 AND NOT a.attisdropped) AS attributes,
+			(SELECT format_type(r.rngsubtype, NULL) FROM pg_range r WHERE r.rngtypid = t.oid) AS subtype,
+			(SELECT NULLIF(r.rngcanonical::text, '-') FROM pg_range r WHERE r.rngtypid = t.oid) AS canonical,
+			(SELECT NULLIF(r.rngsubdiff::text, '-') FROM pg_range r WHERE r.rngtypid = t.oid) AS subtype_diff
+		FROM pg_type t JOIN pg_namespace n ON n.oid = t.typnamespace
+		WHERE n.nspname NOT IN %s AND n.nspname !~ '^pg_(toast|temp_)' AND %s
+			AND (t.typtype IN ('e', 'r') OR (t.typtype = 'c' AND (SELECT c.relkind FROM pg_class c WHERE c.oid = t.typrelid) = 'c'))
+		ORDER BY 1""" % (EXCLUDE_SCHEMAS, not_extension_member("pg_type", "t.oid"))
+
+	queries["functions"] = """SELECT quote_ident(n.nspname) || '.' || quote_ident(p.proname) AS name,
+			pg_get_function_arguments(p.oid) AS args, pg_get_function_identity_arguments(p.oid) AS identity_args,
+			pg_get_function_result(p.oid) AS result, quote_ident(l.lanname) AS language, %s AS kind,
+			p.provolatile AS volatile, p.proisstrict AS strict, p.prosecdef AS security_definer, p.proleakproof AS leakproof,
+			p.procost::text AS cost, p.proretset AS retset, p.prorows::text AS rows, %s AS support, %s AS parallel,
+			p.proconfig AS config, p.prosrc AS src, p.probin AS bin, %s AS sqlbody,
+			quote_ident(pg_get_userbyid(p.proowner)) AS owner,
+			coalesce(p.proacl, acldefault('f', p.proowner))::text[] AS acl, acldefault('f', p.proowner)::text[] AS acldefault
+		FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace JOIN pg_language l ON l.oid = p.prolang
+		WHERE n.nspname NOT IN %s AND n.nspname !~ '^pg_(toast|temp_)' AND %s
+		ORDER BY 1, 2""" % (prokind, support, parallel, sqlbody, EXCLUDE_SCHEMAS, not_extension_member("pg_proc", "p.oid"))
+
+	queries["relations"] = """SELECT c.oid, quote_ident(n.nspname) || '.' || quote_ident(c.relname) AS name, c.relkind AS kind, c.relpersistence AS persistence,
+			quote_ident(pg_get_userbyid(c.relowner)) AS owner, c.reloptions AS options,
+			coalesce(c.relacl, acldefault(CASE WHEN c.relkind = 'S' THEN 's' ELSE 'r' END::"char", c.relowner))::text[] AS acl,
+			acldefault(CASE WHEN c.relkind = 'S' THEN 's' ELSE 'r' END::"char", c.relowner)::text[] AS acldefault,
+			obj_description(c.oid, 'pg_class') AS comment,
+			CASE WHEN c.relkind IN ('v', 'm') THEN pg_get_viewdef(c.oid) END AS viewdef,
+			%s AS partkeydef,
+			(SELECT array_agg(quote_ident(pn.nspname) || '.' || quote_ident(pc.relname) ORDER BY i.inhseqno)
+				FROM pg_inherits i JOIN pg_class pc ON pc.oid = i.inhparent JOIN pg_namespace pn ON pn.oid = pc.relnamespace
+				WHERE i.inhrelid = c.oid AND %s) AS inherits,
+			(SELECT json_agg(x ORDER BY x.attnum) FROM (
+				SELECT a.attnum, quote_ident(a.attname) AS name, format_type(a.atttypid, a.atttypmod) AS type, a.attnotnull AS notnull,
+					%s AS generated, a.attislocal AS local, %s AS stattarget, a.attstorage AS storage, t.typstorage AS typstorage,
+					pg_get_expr(d.adbin, d.adrelid) AS default,
+					CASE WHEN a.attcollation <> 0 AND a.attcollation <> t.typcollation
+						THEN (SELECT quote_ident(cn.nspname) || '.' || quote_ident(co.collname) FROM pg_collation co JOIN pg_namespace cn ON cn.oid = co.collnamespace WHERE co.oid = a.attcollation)
+						END AS collation,
+					col_description(a.attrelid, a.attnum) AS comment
+				FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+					LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+				WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped) x) AS columns,
+			(SELECT json_agg(x ORDER BY x.name) FROM (
+				SELECT quote_ident(co.conname) AS name, co.contype AS type, co.convalidated AS validated, pg_get_constraintdef(co.oid) AS def
+				FROM pg_constraint co
+				WHERE co.conrelid = c.oid AND co.conislocal AND co.contype IN ('c', 'f', 'p', 'u', 'x')) x) AS constraints,
+			(SELECT array_agg(pg_get_indexdef(i.indexrelid) ORDER BY i.indexrelid)
+				FROM pg_index i
+				WHERE i.indrelid = c.oid AND NOT EXISTS (SELECT 1 FROM pg_constraint co WHERE co.conindid = i.indexrelid AND co.contype IN ('p', 'u', 'x'))) AS indexes,
+			(SELECT json_agg(x ORDER BY x.name) FROM (
+				SELECT quote_ident(tg.tgname) AS name, pg_get_triggerdef(tg.oid) AS def, tg.tgenabled AS enabled
+				FROM pg_trigger tg
+				WHERE tg.tgrelid = c.oid AND NOT tg.tgisinternal) x) AS triggers,
+			(SELECT array_agg(pg_get_ruledef(r.oid) ORDER BY r.rulename)
+				FROM pg_rewrite r
+				WHERE r.ev_class = c.oid AND r.rulename <> '_RETURN') AS rules,
+			CASE WHEN c.relkind = 'S' THEN (SELECT row_to_json(x) FROM (
+				%s) x) END AS sequence,
+			(SELECT quote_ident(tn.nspname) || '.' || quote_ident(tc.relname) || '.' || quote_ident(ta.attname)
+				FROM pg_depend d JOIN pg_class tc ON tc.oid = d.refobjid JOIN pg_namespace tn ON tn.oid = tc.relnamespace
+					JOIN pg_attribute ta ON ta.attrelid = d.refobjid AND ta.attnum = d.refobjsubid
+				WHERE d.classid = 'pg_class'::regclass AND d.objid = c.oid AND d.refclassid = 'pg_class'::regclass AND d.deptype = 'a' AND c.relkind = 'S') AS owned_by,
+			EXISTS (SELECT 1 FROM pg_depend d WHERE d.classid = 'pg_class'::regclass AND d.objid = c.oid AND d.deptype = 'i') AS identity
+		FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+		WHERE n.nspname NOT IN %s AND n.nspname !~ '^pg_(toast|temp_)' AND c.relkind IN ('r', 'p', 'S', 'v', 'm') AND %s
+		ORDER BY 2""" % (partkeydef, not_partition, generated, stattarget, sequence, EXCLUDE_SCHEMAS, not_extension_member("pg_class", "c.oid"))
+
+	# objects which are not read from catalogs, --catalog is rejected when they exist
+	unsupported = [
+		"""SELECT 'operator ' || o.oid::regoperator::text FROM pg_operator o JOIN pg_namespace n ON n.oid = o.oprnamespace
+			WHERE n.nspname NOT IN %s AND %s""" % (EXCLUDE_SCHEMAS, not_extension_member("pg_operator", "o.oid")),
+		"""SELECT 'aggregate ' || p.oid::regprocedure::text FROM pg_proc p JOIN pg_aggregate a ON a.aggfnoid = p.oid JOIN pg_namespace n ON n.oid = p.pronamespace
+			WHERE n.nspname NOT IN %s AND %s""" % (EXCLUDE_SCHEMAS, not_extension_member("pg_proc", "p.oid")),
+	]
+	if server_version >= 90500:
+		unsupported.append("""SELECT 'policy ' || quote_ident(pl.polname) || ' on ' || pl.polrelid::regclass::text FROM pg_policy pl JOIN pg_class c ON c.oid = pl.polrelid
+			JOIN pg_namespace n ON n.oid = c.relnamespace
+			WHERE n.nspname NOT IN %s""" % (EXCLUDE_SCHEMAS,))
+	queries["unsupported"] = "SELECT * FROM (%s) x(name) ORDER BY 1" % ("\n\t\tUNION ALL ".join(unsupported),)
+
+	parts = []
+	for name in sorted(queries):
+		parts.append("'%s', (SELECT coalesce(json_agg(q), '[]') FROM (%s) q)" % (name, queries[name]))
+	return "SET search_path = '';\nSELECT '%s' || json_build_object(%s)::text;\n" % (CATALOG_MARK, ",\n".join(parts))
+
+def body_items(command, header, item):
+	# lines between header and closing bracket of CREATE TABLE/TYPE, split as by pg_parser
+	items = []
+	for line in command.split('\n'):
+		if re.match(header, line):
+			continue
+		if re.match(r"\);", line):
+			continue
+		if re.match(r"\s*$", line):
+			continue
+		y = re.match(item, line)
+		if y:
+			items.append(y.group('item'))
+			continue
+		logging.error('ERROR: ' + command)
+	return items
+
+def dollar_quote(text):
+	# same delimiter as pg_dump chooses
+	suffixes = "_XXXXXXX"
+	delimiter = "$"
+	i = 0
+	while delimiter in text:
+		delimiter += suffixes[i]
+		i = (i + 1) % len(suffixes)
+	return "%s$%s%s$" % (delimiter, text, delimiter)
+
+def parse_aclitem(item):
+	x = re.match(r'^(?P<grantee>"([^"]|"")*"|[^=]*)=(?P<privileges>[^/]*)/(?P<grantor>.*)$', item)
+	if not x:
+		return None
+	grantee = x.group("grantee") or "PUBLIC"
+	return (grantee, x.group("privileges"), x.group("grantor"))
+
+def privileges_text(object_type, privileges, all_privileges):
+	names = [name for (c, name) in PRIVILEGES[object_type] if c in privileges]
+	if all_privileges and set(c for c in all_privileges if c != "*") <= set(privileges):
+		return "ALL"
+	return ",".join(names)
+
+def acl_commands(object_type, object_name, acl, acldefault, owner):
+	# GRANT/REVOKE commands changing default privileges to acl, like pg_dump
+	acl = acl or []
+	acldefault = acldefault or []
+	all_privileges = None
+	for item in acldefault:
+		parsed = parse_aclitem(item)
+		if parsed and parsed[0] == owner:
+			all_privileges = parsed[1]
+	if not all_privileges:
+		all_privileges = "".join(c for (c, name) in PRIVILEGES[object_type])
+	revoke = []
+	grant = []
+	for item in acldefault:
+		if item in acl:
+			continue
+		parsed = parse_aclitem(item)
+		if parsed:
+			revoke.append("REVOKE %s ON %s %s FROM %s;" % (privileges_text(object_type, parsed[1].replace("*", ""), all_privileges), object_type, object_name, parsed[0]))
+	for item in acl:
+		if item in acldefault:
+			continue
+		parsed = parse_aclitem(item)
+		if not parsed:
+			continue
+		(grantee, privileges, grantor) = parsed
+		without_option = "".join(c for i, c in enumerate(privileges) if c != "*" and privileges[i+1:i+2] != "*")
+		with_option = "".join(c for i, c in enumerate(privileges) if c != "*" and privileges[i+1:i+2] == "*")
+		if without_option:
+			grant.append("GRANT %s ON %s %s TO %s;" % (privileges_text(object_type, without_option, all_privileges), object_type, object_name, grantee))
+		if with_option:
+			grant.append("GRANT %s ON %s %s TO %s WITH GRANT OPTION;" % (privileges_text(object_type, with_option, all_privileges), object_type, object_name, grantee))
+	return (grant, revoke)
+
+def default_acl_commands(schema_name, role, object_type, acl):
+	commands = []
+	for item in acl or []:
+		parsed = parse_aclitem(item)
+		if not parsed:
+			continue
+		(grantee, privileges, grantor) = parsed
+		commands.append("ALTER DEFAULT PRIVILEGES FOR ROLE %s IN SCHEMA %s GRANT %s ON %s TO %s;" % (role, schema_name, privileges_text(object_type, privileges.replace("*", ""), None), object_type, grantee))
+	return commands
+
+def reloptions(options):
+	return ", ".join(["%s=%s" % (option.split("=", 1)[0], quote_literal(option.split("=", 1)[1])) for option in options])
+
+def config_value(config):
+	(name, value) = config.split("=", 1)
+	if name.lower() in LIST_GUC:
+		value = ", ".join([quote_literal(v.strip().strip('"')) for v in value.split(",")])
+	else:
+		value = quote_literal(value)
+	return "SET %s TO %s" % (name, value)
+
+def function_command(f):
+	command = "CREATE FUNCTION %s(%s) RETURNS %s" % (f["name"], f["args"], f["result"])
+	command += "\n    LANGUAGE %s" % (f["language"],)
+	if f["kind"] == "w":
+		command += " WINDOW"
+	if f["volatile"] == "i":
+		command += " IMMUTABLE"
+	elif f["volatile"] == "s":
+		command += " STABLE"
+	if f["strict"]:
+		command += " STRICT"
+	if f["security_definer"]:
+		command += " SECURITY DEFINER"
+	if f["leakproof"]:
+		command += " LEAKPROOF"
+	if f["cost"] != "0":
+		if f["language"] in ("internal", "c"):
+			if f["cost"] != "1":
+				command += " COST %s" % (f["cost"],)
+		elif f["cost"] != "100":
+			command += " COST %s" % (f["cost"],)
+	if f["retset"] and f["rows"] not in ("0", "1000"):
+		command += " ROWS %s" % (f["rows"],)
+	if f["support"]:
+		command += " SUPPORT %s" % (f["support"],)
+	if f["parallel"] == "s":
+		command += " PARALLEL SAFE"
+	elif f["parallel"] == "r":
+		command += " PARALLEL RESTRICTED"
+	for config in f["config"] or []:
+		command += "\n    %s" % (config_value(config),)
+	if f["sqlbody"]:
+		command += "\n    %s;\n" % (f["sqlbody"],)
+	elif f["language"] == "c":
+		command += "\n    AS %s, %s;\n" % (quote_literal(f["bin"]), quote_literal(f["src"]))
+	elif f["language"] == "internal":
+		command += "\n    AS %s;\n" % (quote_literal(f["src"]),)
+	else:
+		command += "\n    AS %s;\n" % (dollar_quote(f["src"]),)
+	return command
+
+def sequence_command(name, s):
+	command = "CREATE SEQUENCE %s\n" % (name,)
+	if s["type"] != "bigint":
+		command += "    AS %s\n" % (s["type"],)
+	command += "    START WITH %s\n" % (s["start"],)
+	command += "    INCREMENT BY %s\n" % (s["increment"],)
+	(type_min, type_max) = SEQUENCE_LIMITS.get(s["type"], SEQUENCE_LIMITS["bigint"])
+	if int(s["increment"]) > 0:
+		(default_min, default_max) = (1, type_max)
+	else:
+		(default_min, default_max) = (type_min, -1)
+	if int(s["min"]) == default_min:
+		command += "    NO MINVALUE\n"
+	else:
+		command += "    MINVALUE %s\n" % (s["min"],)
+	if int(s["max"]) == default_max:
+		command += "    NO MAXVALUE\n"
+	else:
+		command += "    MAXVALUE %s\n" % (s["max"],)
+	command += "    CACHE %s" % (s["cache"],)
+	if s["cycle"]:
+		command += "\n    CYCLE"
+	command += ";\n"
+	return command
+
+def table_command(r):
+	lines = []
+	defaults = []
+	columns_conf = []
+	comments = []
+	for column in r["columns"] or []:
+		if column["comment"] is not None:
+			comments.append("COMMENT ON COLUMN %s.%s IS %s;\n" % (r["name"], column["name"], quote_literal(column["comment"])))
+		if not column["local"]:
+			continue
+		line = "%s %s" % (column["name"], column["type"])
+		if column["default"] is not None:
+			if column["generated"] == "s":
+				line += " GENERATED ALWAYS AS (%s) STORED" % (column["default"],)
+			elif "nextval(" in column["default"]:
+				# default using sequence is set after sequence is created
+				defaults.append("COLUMN %s SET DEFAULT %s" % (column["name"], column["default"]))
+			else:
+				line += " DEFAULT %s" % (column["default"],)
+		if column["notnull"]:
+			line += " NOT NULL"
+		if column["collation"]:
+			line += " COLLATE %s" % (column["collation"],)
+		lines.append(line)
+		if column["stattarget"] >= 0:
+			columns_conf.append("COLUMN %s SET STATISTICS %d" % (column["name"], column["stattarget"]))
+		if column["storage"] != column["typstorage"]:
+			columns_conf.append("COLUMN %s SET STORAGE %s" % (column["name"], STORAGE[column["storage"]]))
+	constraints = []
+	for constraint in r["constraints"] or []:
+		if constraint["type"] == "c" and constraint["validated"]:
+			lines.append("CONSTRAINT %s %s" % (constraint["name"], constraint["def"]))
+		else:
+			constraints.append("CONSTRAINT %s %s" % (constraint["name"], constraint["def"]))
+
+	if r["persistence"] == "u":
+		command = "CREATE UNLOGGED TABLE %s (" % (r["name"],)
+	else:
+		command = "CREATE TABLE %s (" % (r["name"],)
+	if lines:
+		command += "".join([("," if i else "") + "\n    " + line for i, line in enumerate(lines)])
+	command += "\n)"
+	if r["partkeydef"]:
+		command += "\nPARTITION BY %s" % (r["partkeydef"],)
+	if r["inherits"]:
+		command += "\nINHERITS (%s)" % (", ".join(r["inherits"]),)
+	if r["options"]:
+		command += "\nWITH (%s)" % (reloptions(r["options"]),)
+	command += ";\n"
+
+	if r["comment"] is not None:
+		comments.insert(0, "COMMENT ON TABLE %s IS %s;\n" % (r["name"], quote_literal(r["comment"])))
+	return (command, defaults, constraints, columns_conf, comments)
+
+def view_command(r):
+	viewdef = r["viewdef"].rstrip().rstrip(";")
+	options = ""
+	check_option = ""
+	for option in r["options"] or []:
+		if option.startswith("check_option="):
+			check_option = "\n  WITH %s CHECK OPTION" % (option.split("=", 1)[1].upper(),)
+	view_options = [option for option in r["options"] or [] if not option.startswith("check_option=")]
+	if view_options:
+		options = " WITH (%s)" % (reloptions(view_options),)
+	if r["kind"] == "m":
+		return "CREATE MATERIALIZED VIEW %s%s AS\n%s\n  WITH NO DATA;\n" % (r["name"], options, viewdef)
+	return "CREATE VIEW %s%s AS\n%s%s;\n" % (r["name"], options, viewdef, check_option)
+
+def load_project(pg, no_owner=False, no_acl=False):
+	# Project built from system catalogs of database, elements have same names and commands as from parsed pg_dump
+	server_version = pg.server_version()
+	if server_version < MIN_SERVER_VERSION:
+		logging.error("Error: catalog introspection needs PostgreSQL 9.4 or newer")
+		sys.exit(1)
+	(retcode, output) = pg.psql(cmd=catalog_query(server_version), single_transaction=True, tuples_only=True)
+	output = unicode(output, "utf8")
+	i = output.find(CATALOG_MARK)
+	if i < 0:
+		raise pg_conn.PgError(1, "catalog", output=output[-2000:])
+	catalog = json.loads(output[i + len(CATALOG_MARK):])
+	if catalog["unsupported"]:
+		logging.error("Error: objects not read from catalogs, compare without --catalog:\n%s" % ("\n".join([u["name"] for u in catalog["unsupported"]]),))
+		sys.exit(1)
+
+	project = Project()
+	project.schemas["public"] = Schema(None, "public")
+
+	for s in catalog["schemas"]:
+		if s["name"] != "public":
+			project.schemas[s["name"]] = Schema("CREATE SCHEMA %s;\n" % (s["name"],), s["name"])
+			if not no_owner:
+				project.schemas[s["name"]].owner = s["owner"]
+		if not no_acl:
+			(grant, revoke) = acl_commands("SCHEMA", s["name"], s["acl"], s["acldefault"], s["owner"])
+			project.schemas[s["name"]].grant += grant
+			project.schemas[s["name"]].revoke += revoke
+
+	if not no_acl:
+		for a in catalog["default_acl"]:
+			if a["schema"] in project.schemas:
+				project.schemas[a["schema"]].grant += default_acl_commands(a["schema"], a["role"], DEFAULT_ACL_TYPES[a["type"]], a["acl"])
+
+	for e in catalog["extensions"]:
+		extention = Extention("CREATE EXTENSION IF NOT EXISTS %s WITH SCHEMA %s;\n" % (e["name"], e["schema"]), e["name"], e["schema"])
+		if e["comment"] is not None:
+			extention.comment = "COMMENT ON EXTENSION %s IS %s;\n" % (e["name"], quote_literal(e["comment"]))
+		project.extentions[e["name"]] = extention
+
+	for t in catalog["types"]:
+		if t["type"] == "e":
+			command = "CREATE TYPE %s AS ENUM (%s\n);\n" % (t["name"], ",".join(["\n    " + label for label in t["labels"] or []]))
+			element = Enum(command, t["name"], body_items(command, r"CREATE TYPE (?P<name>\S+) AS ENUM \(", r"\s*(?P<item>[^,]+),?$"))
+		elif t["type"] == "c":
+			command = "CREATE TYPE %s AS (%s\n);\n" % (t["name"], ",".join(["\n\t" + attribute for attribute in t["attributes"] or []]))
+			element = Type(command, t["name"], body_items(command, r"CREATE TYPE (?P<name>\S+) AS \(", r"\s*(?P<item>.*[^,]),?$"))
+		else:
+			command = "CREATE TYPE %s AS RANGE (\n    subtype = %s" % (t["name"], t["subtype"])
+			if t["canonical"]:
+				command += ",\n    canonical = %s" % (t["canonical"],)
+			if t["subtype_diff"]:
+				command += ",\n    subtype_diff = %s" % (t["subtype_diff"],)
+			command += "\n);\n"
+			element = Range(command, t["name"])
+		if not no_owner:
+			element.owner = t["owner"]
+		project.types[t["name"]] = element
+
+	for f in catalog["functions"]:
+		# procedures and aggregates are not functions for the parser
+		if f["kind"] not in ("f", "w"):
+			continue
+		args = pg_parser.remove_default("(%s)" % (f["args"],))
+		function = Function(function_command(f), f["name"], "(%s)" % (f["args"],), args)
+		if not no_owner:
+			function.owner = f["owner"]
+		if not no_acl:
+			(function.grant, function.revoke) = acl_commands("FUNCTION", "%s(%s)" % (f["name"], f["identity_args"]), f["acl"], f["acldefault"], f["owner"])
+		project.functions[f["name"] + str(args)] = function
+
+	for r in catalog["relations"]:
+		if r["kind"] in ("r", "p"):
+			(command, defaults, constraints, columns_conf, comments) = table_command(r)
+			element = Table(command, r["name"], body_items(command, r"CREATE( UNLOGGED)?( FOREIGN)? TABLE (?P<name>\S+) ?\(", r"\s*(?P<item>.*[^,]),?$"))
+			element.defaults = defaults
+			element.constraints = constraints
+			element.columns_conf = columns_conf
+			element.indexes = [re.sub(r"^CREATE ", "", index) for index in r["indexes"] or []]
+			for trigger in r["triggers"] or []:
+				element.triggers.append(re.sub(r"^CREATE ", "", trigger["def"]))
+				if trigger["enabled"] == "D":
+					element.triggers.append("DISABLE TRIGGER %s" % (trigger["name"],))
+			if comments:
+				# parser keeps last comment of table
+				element.comment = comments[-1]
+			project.tables[r["name"]] = element
+		elif r["kind"] == "S":
+			# identity sequences are part of table
+			if r["identity"] or not r["sequence"]:
+				continue
+			element = Sequence(sequence_command(r["name"], r["sequence"]), r["name"])
+			element.owned_by = r["owned_by"]
+			project.sequences[r["name"]] = element
+		else:
+			element = View(view_command(r), r["name"])
+			project.views[r["name"]] = element
+		element.rule = [rule.strip() for rule in r["rules"] or []]
+		if not no_owner:
+			element.owner = r["owner"]
+		if not no_acl:
+			object_type = "SEQUENCE" if r["kind"] == "S" else "TABLE"
+			(element.grant, element.revoke) = acl_commands(object_type, r["name"], r["acl"], r["acldefault"], r["owner"])
+
+	return project
@@ -11,8 +11,24 @@ import csv
 import os
 import json
 import time
+import uuid
+import getpass
+import Queue
+import socket
+import atexit
+import threading
+import collections
+
+try:
+	import psycopg2
+	import psycopg2.extensions
+except ImportError:
+	psycopg2 = None
 
 import config
+import pg_parser
+from pg_types import NULL_MARKER
+import dump_cache
 
 class PgError(Exception):
     def __init__(self, returncode, cmd, output=None):
@@ -22,6 +38,516 @@ class PgError(Exception):
     def __str__(self):
         return "Command '%s' returned non-zero exit status %d" % (self.cmd, self.returncode)
 
+# end of remote output with exit code of remote command
+RETCODE_MARK = "PGDIST_RETCODE="
+
+# catalogs, row key and minimal server version of fingerprint of structure
+FINGERPRINT_CATALOGS = (
+	("pg_namespace", "oid::text", 0),
+	("pg_class", "oid::text", 0),
+	("pg_attribute", "attrelid::text || '.' || attnum::text", 0),
+	("pg_attrdef", "oid::text", 0),
+	("pg_constraint", "oid::text", 0),
+	("pg_index", "indexrelid::text", 0),
+	("pg_inherits", "inhrelid::text || '.' || inhparent::text", 0),
+	("pg_proc", "oid::text", 0),
+	("pg_type", "oid::text", 0),
+	("pg_enum", "oid::text", 0),
+	("pg_trigger", "oid::text", 0),
+	("pg_rewrite", "oid::text", 0),
+	("pg_description", "objoid::text || '.' || classoid::text || '.' || objsubid::text", 0),
+	("pg_default_acl", "oid::text", 0),
+	("pg_extension", "oid::text", 0),
+	("pg_operator", "oid::text", 0),
+	("pg_aggregate", "aggfnoid::text", 0),
+	("pg_opclass", "oid::text", 0),
+	("pg_opfamily", "oid::text", 0),
+	("pg_amop", "oid::text", 0),
+	("pg_amproc", "oid::text", 0),
+	("pg_cast", "oid::text", 0),
+	("pg_collation", "oid::text", 0),
+	("pg_conversion", "oid::text", 0),
+	("pg_ts_config", "oid::text", 0),
+	("pg_ts_config_map", "mapcfg::text || '.' || maptokentype::text || '.' || mapseqno::text", 0),
+	("pg_ts_dict", "oid::text", 0),
+	("pg_ts_parser", "oid::text", 0),
+	("pg_ts_template", "oid::text", 0),
+	("pg_policy", "oid::text", 90500),
+	("pg_sequence", "seqrelid::text", 100000),
+)
+
+# prefix of template databases of test loads
+TEMPLATE_PREFIX = "pgdist_tpl_"
+
+# prefix of test databases
+TEST_PREFIX = "pgdist_test_"
+# key of advisory locks of load slots, number of slots in config: test_db_max_loads
+LOAD_LOCK = "pgdist_load"
+
+# prefix of empty databases kept ready for test loads, followed by user and random part
+POOL_PREFIX = "pgdist_pool_"
+POOL_RANDOM = 16
+# number of pooled databases, in config: test_db_pool
+POOL_SIZE = 2
+
+# connections copying table data in parallel
+COPY_JOBS = 4
+
+# lines of psql output kept for error message
+TAIL_LINES = 40
+
+def synchronized(method):
+	# session shared by threads runs one command at a time
+	def wrapper(self, *args, **kwargs):
+		with self.lock:
+			return method(self, *args, **kwargs)
+	return wrapper
+
+class Session:
+	# one connection for the whole run of pgdist, psql scripts are executed statement by statement
+	def __init__(self, address, dbname=None):
+		self.address = address
+		self.dbname = dbname
+		self.lock = threading.Lock()
+		logging.verbose("connect: %s" % (address.get_pg(dbname),))
+		try:
+			self.conn = psycopg2.connect(address.get_pg(dbname))
+		except psycopg2.Error as e:
+			raise PgError(2, "connect %s" % (address.get_pg(dbname),), output="%s" % (e,))
+		self.conn.autocommit = True
+		psycopg2.extensions.register_type(psycopg2.extensions.UNICODE, self.conn)
+		self.conn.set_client_encoding("UTF8")
+
+	def close(self):
+		if not self.conn.closed:
+			self.conn.close()
+
+	@synchronized
+	def run(self, cmd=None, single_transaction=True, file=None, cwd=None, tuples_only=False, exit_on_fail=True):
+		cwd = cwd or "."
+		if file:
+			with io.open(os.path.join(cwd, file), encoding="utf8") as f:
+				commands = expand_script(f.read(), os.path.dirname(os.path.join(cwd, file)), cwd)
+		else:
+			commands = expand_script(cmd or "", cwd, cwd)
+		if commands is None:
+			return None
+
+		output = io.StringIO()
+		cursor = self.conn.cursor()
+		# clean state of session like new psql
+		command = "DISCARD ALL;"
+		try:
+			cursor.execute(command)
+			if single_transaction:
+				cursor.execute("BEGIN;")
+			for (command, copy_data) in commands:
+				if copy_data is not None:
+					cursor.copy_expert(command, io.BytesIO(copy_data.encode("utf8")))
+				elif re.match(r"\s*COPY\s.*\sTO\s+STDOUT\b", command, re.IGNORECASE | re.DOTALL):
+					if not tuples_only:
+						output.write("%s\n" % (command.strip(),))
+					data = io.BytesIO()
+					cursor.copy_expert(command, data)
+					output.write(unicode(data.getvalue(), "utf8"))
+				else:
+					cursor.execute(command)
+					if tuples_only and cursor.description:
+						for row in cursor.fetchall():
+							output.write("|".join(map(tuples_only_value, row)) + "\n")
+			if single_transaction:
+				cursor.execute("COMMIT;")
+		except psycopg2.Error as e:
+			if self.conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+				self.conn.rollback()
+			# like psql --echo-queries: failed command and error
+			output.write("%s\n" % (command.strip(),))
+			output.write(e.pgerror or "%s\n" % (e,))
+			retcode = 3
+			if exit_on_fail:
+				out = "\n".join(output.getvalue().split("\n")[-TAIL_LINES:])
+				raise PgError(retcode, cmd or file, output=out.encode("utf8"))
+			return (retcode, output.getvalue().encode("utf8"))
+		finally:
+			cursor.close()
+		return (0, output.getvalue().encode("utf8"))
+
+	@synchronized
+	def copy_to(self, cmd, snapshot=None, output=None):
+		# data of COPY ... TO STDOUT in own transaction, optionally in exported snapshot
+		# output - file-like written while data are read, nothing is returned
+		cursor = self.conn.cursor()
+		data = io.BytesIO() if output is None else output
+		try:
+			cursor.execute("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+			if snapshot:
+				cursor.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot,))
+			cursor.copy_expert(cmd, data)
+			cursor.execute("COMMIT;")
+		except psycopg2.Error as e:
+			if self.conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+				cursor.execute("ROLLBACK;")
+			raise PgError(3, cmd, output=(e.pgerror or "%s" % (e,)).encode("utf8"))
+		finally:
+			cursor.close()
+		if output is None:
+			return data.getvalue()
+
+	@synchronized
+	def copy_from(self, cmd, stream):
+		# COPY ... FROM STDIN reading data from file-like stream in own transaction
+		cursor = self.conn.cursor()
+		try:
+			cursor.copy_expert(cmd, stream)
+		except psycopg2.Error as e:
+			raise PgError(3, cmd, output=(e.pgerror or "%s" % (e,)).encode("utf8"))
+		finally:
+			cursor.close()
+
+class CsvStream:
+	# file-like CSV of rows for COPY FROM STDIN, rows are formatted when they are read
+	def __init__(self, rows):
+		self.rows = iter(rows)
+		self.buf = io.BytesIO()
+		self.writer = csv.writer(self.buf, delimiter=b";")
+		self.pending = b""
+
+	def read(self, size=-1):
+		while size < 0 or len(self.pending) < size:
+			try:
+				row = next(self.rows)
+			except StopIteration:
+				break
+			self.writer.writerow([NULL_MARKER.encode("utf8") if v is None else (v.encode("utf8") if type(v) == unicode else v) for v in row])
+			self.pending += self.buf.getvalue()
+			self.buf.seek(0)
+			self.buf.truncate()
+		if size < 0:
+			data, self.pending = self.pending, b""
+		else:
+			data, self.pending = self.pending[:size], self.pending[size:]
+		return data
+
+	def readline(self, size=-1):
+		return self.read(size)
+
+def csv_rows(stream):
+	# rows of CSV output of COPY TO STDOUT, NULL_MARKER is None
+	rows = []
+	for row in csv.reader(stream):
+		row = [unicode(v, "utf8") for v in row]
+		rows.append([None if v == NULL_MARKER else v for v in row])
+	return rows
+
+def copy_rows(session, cmd, snapshot=None):
+	# output of COPY is parsed while it is read from connection, whole table is not buffered
+	(read_fd, write_fd) = os.pipe()
+	reader = os.fdopen(read_fd, "rb")
+	writer = os.fdopen(write_fd, "wb")
+	errors = []
+	def copy():
+		try:
+			session.copy_to(cmd, snapshot, output=writer)
+		except Exception as e:
+			errors.append(e)
+		finally:
+			writer.close()
+	thread = threading.Thread(target=copy)
+	thread.start()
+	try:
+		try:
+			rows = csv_rows(reader)
+		finally:
+			# failed parsing does not leave copy blocked on full pipe
+			reader.close()
+			thread.join()
+	except csv.Error:
+		# output of failed copy is cut anywhere
+		if not errors:
+			raise
+	if errors:
+		raise errors[0]
+	return rows
+
+def feed_stdin(pipe, script, stream=None):
+	# script and data of COPY FROM STDIN are written while output is read
+	try:
+		if script:
+			pipe.write(script)
+		if stream is not None:
+			while True:
+				data = stream.read(65536)
+				if not data:
+					break
+				pipe.write(data)
+			pipe.write(b"\\.\n")
+		pipe.close()
+	except IOError:
+		# psql stopped on error, output tells why
+		pass
+
+def read_tail(pipe):
+	# last lines of output in memory, whole output only in psql log
+	tail = collections.deque(maxlen=TAIL_LINES)
+	log = None
+	if config.psql_log:
+		log = open(config.psql_log, "ab")
+	try:
+		for line in iter(pipe.readline, b""):
+			tail.append(line)
+			if log:
+				log.write(line)
+	finally:
+		if log:
+			log.close()
+	return b"".join(tail)
+
+def error_context(output, cmd=None, file=None, cwd=None):
+	# psql without echo reports line of failed command: psql:FILE:LINE: ERROR: ...
+	x = re.search(r"^psql:(?P<file>.+?):(?P<line>\d+): ERROR:", output, re.MULTILINE)
+	if not x:
+		return b""
+	line = int(x.group("line"))
+	if x.group("file") == "<stdin>":
+		script = cmd or ""
+	else:
+		fname = os.path.join(cwd or ".", x.group("file"))
+		if not os.path.isfile(fname):
+			return b""
+		with io.open(fname, encoding="utf8") as f:
+			script = f.read()
+	lines = script.split("\n")[max(line - 10, 0):line]
+	context = "\n-- %s, lines %d-%d:\n%s\n" % (x.group("file"), max(line - 9, 1), line, "\n".join(lines))
+	return context.encode("utf8")
+
+def tuples_only_value(value):
+	if value is None:
+		return ""
+	if value is True:
+		return "t"
+	if value is False:
+		return "f"
+	if type(value) == unicode:
+		return value
+	return unicode(value)
+
+# psql meta commands run by session
+SESSION_META = ("ir", "include_relative", "i", "include", "restrict", "unrestrict")
+
+def session_script(script):
+	# False when script has syntax which pg_parser.Tokens does not split right (written for pg_dump output):
+	# E'' strings, quoted identifiers, $ outside dollar quotes and psql meta commands run only by psql
+	i = 0
+	start = 0
+	line_start = True
+	while i < len(script):
+		c = script[i]
+		if c == "\n":
+			line_start = True
+			i += 1
+			continue
+		if c in " \t\r":
+			i += 1
+			continue
+		at_line_start = line_start
+		line_start = False
+		prev = script[i - 1] if i else ""
+		# comments before command are not a part of it
+		leading = not script[start:i].strip()
+		if script.startswith("--", i):
+			end = script.find("\n", i)
+			i = len(script) if end == -1 else end
+			if leading:
+				start = i
+			continue
+		if script.startswith("/*", i):
+			depth = 0
+			while i < len(script):
+				if script.startswith("/*", i):
+					depth += 1
+					i += 2
+				elif script.startswith("*/", i):
+					depth -= 1
+					i += 2
+					if not depth:
+						break
+				else:
+					i += 1
+			if leading:
+				start = i
+			continue
+		if c == "'":
+			if prev and prev in "Ee" and not re.match(r"\w", script[i - 2:i - 1] or " ", re.UNICODE):
+				return False
+			while True:
+				end = script.find("'", i + 1)
+				if end == -1:
+					return False
+				i = end + 1
+				if not script.startswith("'", i):
+					break
+			continue
+		if c == '"':
+			return False
+		if c == "$":
+			x = re.match(r"\$([A-Za-z_][A-Za-z0-9_]*)?\$", script[i:])
+			if not x or re.match(r"\w", prev, re.UNICODE):
+				return False
+			end = script.find(x.group(0), i + len(x.group(0)))
+			if end == -1:
+				return False
+			i = end + len(x.group(0))
+			continue
+		if c == "\\":
+			x = re.match(r"\\(\S+)", script[i:])
+			if not x or not at_line_start or x.group(1) not in SESSION_META:
+				return False
+			end = script.find("\n", i)
+			i = len(script) if end == -1 else end
+			start = i
+			continue
+		if c == ";":
+			i += 1
+			if re.match(r"\s*COPY\s.*\sFROM\s+STDIN\b", script[start:i], re.IGNORECASE | re.DOTALL):
+				# data end by line \.
+				x = re.compile(r"^\\\.\r?$", re.MULTILINE).search(script, i)
+				i = len(script) if not x else x.end()
+			start = i
+			continue
+		i += 1
+	return True
+
+def expand_script(script, directory, cwd):
+	# split script to commands, \ir and \i are included, other meta commands need psql
+	if not session_script(script):
+		logging.debug("script needs psql")
+		return None
+	commands = []
+	for comment, command in pg_parser.Tokens(io.StringIO(script)):
+		if not command.strip().rstrip(";").strip():
+			continue
+		if command.startswith("\\"):
+			x = re.match(r"\\(?P<meta>\S+)\s*(?P<arg>.*?)\s*$", command)
+			meta = x.group("meta")
+			arg = x.group("arg").strip("'")
+			if meta in ("ir", "include_relative", "i", "include"):
+				if meta in ("ir", "include_relative"):
+					fname = os.path.join(directory, arg)
+				else:
+					fname = os.path.join(cwd, arg)
+				with io.open(fname, encoding="utf8") as f:
+					included = expand_script(f.read(), os.path.dirname(fname), cwd)
+				if included is None:
+					return None
+				commands += included
+				continue
+			if meta in ("restrict", "unrestrict"):
+				# pg_dump protection of psql meta commands, session does not run them
+				continue
+			logging.debug("meta command %s needs psql" % (meta,))
+			return None
+		x = re.match(r"(?P<command>\s*COPY\s.*?\sFROM\s+STDIN\b.*?;)[ \t]*(\r?\n|$)(?P<data>.*)$", command, re.IGNORECASE | re.DOTALL)
+		if x:
+			data = re.sub(r"(^|\n)\\\.\r?\n?$", r"\1", x.group("data"))
+			commands.append((x.group("command"), data))
+			continue
+		commands.append((command, None))
+	return commands
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+def connect_address(address):
+	# address for psycopg2, None when postgres cannot be connected directly
+	if not psycopg2:
+		return None
+	if address.ssh:
+		# postgres behind ssh is connected by forwarded port
+		return address.tunnel()
+	return address
+
+def get_session(address, dbname=None):
+	key = (address.addr, dbname)
+	with sessions_lock:
+		if key not in sessions:
+			conn_address = connect_address(address)
+			if not conn_address:
+				return None
+			sessions[key] = Session(conn_address, dbname)
+		return sessions[key]
+
+def close_sessions(address=None, dbname=None):
+	with sessions_lock:
+		for key in sessions.keys():
+			if address and key != (address.addr, dbname):
+				continue
+			sessions.pop(key).close()
+
+atexit.register(close_sessions)
+
+# test databases dropped in background {dbname: process of psql}, command exits without waiting for them
+cleanups = {}
+cleanups_lock = threading.Lock()
+
+def wait_cleanups(dbname=None):
+	with cleanups_lock:
+		processes = [cleanups.pop(name) for name in cleanups.keys() if not dbname or name == dbname]
+	for process in processes:
+		process.wait()
+
+# one refill of pool at a time
+refill_lock = threading.Lock()
+refilling = False
+
+def pool_size():
+	return int(config.get("test_db_pool") or POOL_SIZE)
+
+class LoadSlot:
+	# one of max_loads advisory locks of test pg held by own connection during a load
+	def __init__(self, address, max_loads):
+		self.address = address
+		self.max_loads = max_loads
+		self.session = None
+		self.slot = None
+
+	def acquire(self):
+		# True when slot is held or loads are not limited
+		if not self.max_loads:
+			return True
+		if not self.session:
+			conn_address = connect_address(self.address)
+			if not conn_address:
+				logging.verbose("test_db_max_loads needs psycopg2, loads are not limited")
+				return True
+			self.session = Session(conn_address)
+		# filter stops at first locked slot
+		cmd = """SELECT slot FROM pg_catalog.generate_series(0, %d) slot
+			WHERE pg_catalog.pg_try_advisory_lock(pg_catalog.hashtext('%s'), slot) LIMIT 1;""" % (self.max_loads - 1, LOAD_LOCK)
+		(retcode, output) = self.session.run(cmd=cmd, single_transaction=False, tuples_only=True)
+		if not output.strip():
+			return False
+		self.slot = int(output.strip())
+		logging.verbose("load slot %d of test pg" % (self.slot,))
+		return True
+
+	def release(self):
+		# lock is released with connection
+		if self.session:
+			self.session.close()
+		self.session = None
+		self.slot = None
+
+def load_counts(address):
+	# number of held load slots and connections to test databases of server, None when it cannot be connected
+	cmd = """SELECT (SELECT count(*) FROM pg_catalog.pg_locks WHERE locktype = 'advisory' AND granted AND classid = pg_catalog.hashtext('%s')::oid),
+			(SELECT count(*) FROM pg_catalog.pg_stat_activity WHERE datname LIKE '%s%%');""" % (LOAD_LOCK, TEST_PREFIX.replace("_", "\\_"))
+	try:
+		(retcode, output) = PG(address).psql(cmd=cmd, tuples_only=True)
+	except PgError as e:
+		logging.verbose("Test pg %s fail:\n%s" % (address.addr, e.output))
+		return None
+	return tuple([int(value) for value in output.strip().split("|")])
+
 class PG:
 	def __init__(self, addr, dbname=None):
 		self.address = addr
@@ -30,6 +556,8 @@ class PG:
 		else:
 			self.dbname = None
 		self.loaded_projects_name = []
+		self.snapshot = None
+		self.snapshot_session = None
 
 	def psql(self, cmd=None, single_transaction=True, change_db=False, file=None, cwd=None, tuples_only=False, exit_on_fail=True):
 		return self.run(c='psql', cmd=cmd, single_transaction=single_transaction, change_db=change_db, file=file, cwd=cwd, tuples_only=tuples_only, exit_on_fail=exit_on_fail)
@@ -37,11 +565,23 @@ class PG:
 	def pg_dump(self, change_db=False, no_owner=False, no_acl=False):
 		return self.run(c='pg_dump', single_transaction=False, change_db=change_db, no_owner=no_owner, no_acl=no_acl)
 
-	def run(self, c, cmd=None, single_transaction=True, change_db=False, file=None, cwd=None, no_owner=False, no_acl=False, tuples_only=False, exit_on_fail=True):
+	def run(self, c, cmd=None, single_transaction=True, change_db=False, file=None, cwd=None, no_owner=False, no_acl=False, tuples_only=False, exit_on_fail=True, stream=None, detach=False):
+		# stream - file-like data of COPY FROM STDIN in cmd, sent to stdin of psql after cmd
+		# detach - cmd is run by --command and not waited on, returns process, output is discarded
+		if c == "psql" and stream is None and not detach:
+			if change_db and self.dbname:
+				session = get_session(self.address, self.dbname)
+			else:
+				session = get_session(self.address)
+			if session:
+				r = session.run(cmd=cmd, single_transaction=single_transaction, file=file, cwd=cwd, tuples_only=tuples_only, exit_on_fail=exit_on_fail)
+				if r is not None:
+					return r
+
 		args = [c]
 		if c == "psql":
 			args.append("--no-psqlrc")
-			if not tuples_only:
+			if not tuples_only and config.echo_queries:
 				args.append("--echo-queries")
 			args.append("--set")
 			args.append("ON_ERROR_STOP=1")
@@ -59,6 +599,8 @@ class PG:
 		if c == "pg_dump":
 			args.append("--schema-only")
 			args.append("--exclude-schema=pgdist")
+			if self.snapshot:
+				args.append("--snapshot=%s" % (self.snapshot,))
 		if no_owner:
 			args.append("--no-owner")
 		if no_acl:
@@ -66,49 +608,362 @@ class PG:
 		if tuples_only:
 			args.append("--tuples-only")
 			args.append("--no-align")
+			args.append("--quiet")
+		if detach:
+			args.append("--command")
+			args.append(cmd)
 
+		compressor = None
 		if self.address.ssh:
 			ssh_args = []
 			for arg in args:
 				ssh_args.append("'%s'" % (arg.replace("\\", "\\\\").replace("'", "\\'"),))
-			args = ["ssh"]
-			if self.address.ssh_port:
-				args += ["-p", self.address.ssh_port]
-			args.append(self.address.ssh)
-			args.append(" ".join(ssh_args))
+			remote = " ".join(ssh_args)
+			# big outputs are compressed on remote side
+			if c == "pg_dump" or (cmd and re.search(r"\sTO\s+STDOUT\b", cmd, re.IGNORECASE)):
+				compressor = self.address.compressor()
+			if compressor:
+				remote = "( %s 2>&1; rc=$?; echo; echo %s$rc ) | %s -c" % (remote, RETCODE_MARK, compressor)
+			if detach:
+				# remote psql outlives ssh session and its master
+				remote = "nohup %s >/dev/null 2>&1 &" % (remote,)
+			args = self.address.ssh_command()
+			args.append(remote)
 		logging.verbose("run: %s" % (" ".join(args),))
+		if compressor:
+			return self.run_compressed(args, cmd, compressor, exit_on_fail)
+		if detach:
+			# own process group, Ctrl+C of command does not interrupt it
+			with open(os.devnull, "r+b") as devnull:
+				return subprocess.Popen(args, stdin=devnull, stdout=devnull, stderr=devnull, cwd=cwd or ".", preexec_fn=os.setpgrp)
 		process = subprocess.Popen(args, bufsize=8192, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE, cwd=cwd or ".")
+		script = cmd.encode(encoding="UTF8") if cmd else None
+		feeder = threading.Thread(target=feed_stdin, args=(process.stdin, script, stream))
+		feeder.start()
+		if c == "pg_dump" or tuples_only:
+			output = process.stdout.read()
+		else:
+			# output of scripts is needed only for error message
+			output = read_tail(process.stdout)
+		feeder.join()
+		retcode = process.wait()
+		if exit_on_fail and retcode != 0:
+			output = "\n".join(output.split("\n")[-TAIL_LINES:])
+			if not config.echo_queries:
+				output += error_context(output, cmd, file, cwd)
+			raise PgError(retcode, script, output=output)
+		return (retcode, output)
+
+	def run_compressed(self, args, cmd, compressor, exit_on_fail=True):
+		process = subprocess.Popen(args, bufsize=8192, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+		decompress = subprocess.Popen([compressor, "-dc"], bufsize=8192, stdin=process.stdout, stdout=subprocess.PIPE)
+		process.stdout.close()
 		if cmd:
-			cmd = cmd.encode(encoding="UTF8")
-		output, unused_err = process.communicate(cmd)
-		retcode = process.poll()
+			process.stdin.write(cmd.encode(encoding="UTF8"))
+		process.stdin.close()
+		output, unused_err = decompress.communicate()
+		process.wait()
+		i = output.rfind("\n" + RETCODE_MARK)
+		if i >= 0:
+			retcode = int(output[i + len(RETCODE_MARK) + 1:].strip() or 1)
+			output = output[:i]
+		else:
+			retcode = process.returncode or decompress.returncode or 1
 		if exit_on_fail and retcode != 0:
-			output = "\n".join(output.split("\n")[-40:])
+			output = "\n".join(output.split("\n")[-TAIL_LINES:])
 			raise PgError(retcode, cmd, output=output)
 		return (retcode, output)
 
-	def init(self):
+	def server_version(self):
+		(retcode, output) = self.psql(cmd="SHOW server_version_num;", tuples_only=True)
+		return int(output.strip())
+
+	def dump_version(self):
+		# version of pg_dump which dumps this database, on remote side of ssh, None when unknown
+		args = ["pg_dump", "--version"]
+		if self.address.ssh:
+			args = self.address.ssh_command() + ["pg_dump --version"]
+		try:
+			output = subprocess.check_output(args, stderr=subprocess.STDOUT)
+		except (OSError, subprocess.CalledProcessError) as e:
+			logging.verbose("pg_dump --version fail: %s" % (e,))
+			return None
+		x = re.search(r"\d+(\.\d+)*", output)
+		if x:
+			return x.group(0)
+		return None
+
+	def table_sizes(self):
+		# {relation: (relpages, reltuples)} from statistics of tables, indexes, sequences and views
+		cmd = """SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname), c.relpages, c.reltuples::bigint
+			FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+			WHERE c.relkind IN ('r', 'p', 'm', 'i', 'I', 'S', 'v') AND n.nspname NOT IN ('pg_catalog', 'information_schema');"""
+		(retcode, output) = self.psql(cmd=cmd, tuples_only=True)
+		sizes = {}
+		for line in output.splitlines():
+			row = line.rsplit("|", 2)
+			if len(row) == 3:
+				sizes[row[0]] = (int(row[1]), max(int(row[2]), 0))
+		return sizes
+
+	def fingerprint(self, entry_type, table_data=None):
+		# hash changed by every change of cached content, None when it cannot be read
+		try:
+			if entry_type == "roles":
+				cmd = "SELECT md5(string_agg(oid::text || ':' || rolname, ',' ORDER BY rolname)) FROM pg_catalog.pg_roles;"
+				(retcode, output) = self.psql(cmd=cmd, tuples_only=True)
+				return output.strip() or None
+			# xmin of catalog row is changed by every CREATE, ALTER, GRANT, COMMENT, vacuum updates statistics in place
+			server_version = self.server_version()
+			rows = []
+			for (catalog, key, min_version) in FINGERPRINT_CATALOGS:
+				if server_version >= min_version:
+					rows.append("SELECT '%s:' || %s || ':' || xmin::text FROM pg_catalog.%s" % (catalog, key, catalog))
+			if entry_type == "data" and table_data:
+				# counters are not changed without track_counts, data are valid by age only
+				(retcode, output) = self.psql(cmd="SHOW track_counts;", change_db=True, tuples_only=True)
+				if output.strip() != "on":
+					logging.verbose("track_counts is off, cache of data is valid by age only")
+					return None
+				# counters of modified rows and relfilenode changed by TRUNCATE, statistics are not transactional, changes only invalidate more often
+				tables = ", ".join(["pg_catalog.to_regclass('%s')" % (tb.table_name.replace("'", "''"),) for tb in table_data])
+				rows.append("""SELECT 'data:' || c.oid::text || ':' || c.relfilenode::text || ':' || s.n_tup_ins::text || ':' || s.n_tup_upd::text || ':' || s.n_tup_del::text
+					FROM pg_catalog.pg_class c JOIN pg_catalog.pg_stat_all_tables s ON s.relid = c.oid WHERE c.oid IN (%s)""" % (tables,))
+			cmd = "SELECT md5(string_agg(f, ',' ORDER BY f)) FROM (%s) AS x(f);" % ("\nUNION ALL ".join(rows),)
+			(retcode, output) = self.psql(cmd=cmd, change_db=True, tuples_only=True)
+			return output.strip() or None
+		except PgError as e:
+			logging.verbose("fingerprint of %s fail, cache is valid by age only:\n%s" % (entry_type, e.output))
+			return None
+
+	def database_identity(self):
+		# cluster and database, the same for every address of one database and for its physical replicas
+		try:
+			if self.server_version() < 90600:
+				return None
+			cmd = "SELECT system_identifier::text || ':' || pg_catalog.current_database() FROM pg_catalog.pg_control_system();"
+			(retcode, output) = self.psql(cmd=cmd, change_db=True, tuples_only=True)
+			return output.strip() or None
+		except PgError as e:
+			logging.verbose("identity of database fail:\n%s" % (e.output,))
+			return None
+
+	def export_snapshot(self):
+		# snapshot held open until release_snapshot, pg_dump and dump_data see the same data
+		if self.snapshot:
+			return self.snapshot
+		conn_address = connect_address(self.address)
+		if not conn_address:
+			return None
+		self.snapshot_session = Session(conn_address, self.dbname)
+		cursor = self.snapshot_session.conn.cursor()
+		try:
+			cursor.execute("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+			cursor.execute("SELECT pg_export_snapshot();")
+			self.snapshot = cursor.fetchone()[0]
+		except psycopg2.Error as e:
+			logging.verbose("export snapshot fail: %s" % (e,))
+			self.release_snapshot()
+			return None
+		finally:
+			cursor.close()
+		logging.verbose("exported snapshot: %s" % (self.snapshot,))
+		return self.snapshot
+
+	def release_snapshot(self):
+		if self.snapshot_session:
+			self.snapshot_session.close()
+		self.snapshot_session = None
+		self.snapshot = None
+
+	def init(self, template=None):
 		self.clean()
+		# time of creation for test-db reap
+		info = {"created": time.time(), "host": socket.gethostname(), "pid": os.getpid()}
 		try:
 			logging.debug("Init test database.")
-			self.psql("CREATE DATABASE %s;" % (self.dbname,), single_transaction=False)
+			if template:
+				self.psql("CREATE DATABASE %s TEMPLATE %s;" % (self.dbname, template), single_transaction=False)
+			elif not self.take_pooled():
+				self.psql("CREATE DATABASE %s;" % (self.dbname,), single_transaction=False)
+			self.psql("COMMENT ON DATABASE %s IS '%s';" % (self.dbname, json.dumps(info).replace("'", "''")), single_transaction=False)
 		except PgError as e:
 			logging.error("Create database fail:\n%s" % (e.output))
 			sys.exit(1)
 
 
-	def clean(self):
+	def clean(self, background=False):
+		# background - database is dropped by detached psql, command does not wait for it, see wait_cleanups
 		if "_test_" in self.dbname:
 			logging.debug("Clean test database.")
-			try:
-				self.psql("DROP DATABASE IF EXISTS %s;" % (self.dbname,), single_transaction=False)
-			except PgError as e:
-				logging.error("Clean database fail:\n%s" % (e.output))
-				sys.exit(1)
+			self.release_snapshot()
+			close_sessions(self.address, self.dbname)
+			wait_cleanups(self.dbname)
+			if background:
+				process = self.drop_database(self.dbname, exit_on_fail=False, detach=True)
+				if process:
+					with cleanups_lock:
+						cleanups[self.dbname] = process
+			else:
+				self.drop_database(self.dbname)
 		else:
 			logging.error("Error: clean only test database")
 			sys.exit(1)
 
+	def pool_prefix(self):
+		# pool of role of connection, only owner of database can rename it
+		user = self.address.get_user() or getpass.getuser()
+		return re.sub(r"\W", "", "%s%s_" % (POOL_PREFIX, user))[:63 - POOL_RANDOM]
+
+	def pool_regexp(self):
+		# prefix of one user is not a prefix of pool of another one, length of random part is checked
+		return "^%s[0-9a-f]{%d}$" % (self.pool_prefix(), POOL_RANDOM)
+
+	def pooled_databases(self):
+		# {name: (size, info, connections)} of databases of pool of user
+		return dict([(name, database) for name, database in self.test_databases(self.pool_prefix()).items() if re.match(self.pool_regexp(), name)])
+
+	def take_pooled(self):
+		# empty database of pool renamed to test database, False when pool is empty
+		if not pool_size():
+			return False
+		# locked database is being taken by another command, rename is committed with unlock
+		cmd = """DO $do$ DECLARE pooled name; BEGIN
+				SELECT datname INTO pooled FROM pg_catalog.pg_database
+					WHERE datname ~ '%s' AND pg_catalog.pg_try_advisory_xact_lock(pg_catalog.hashtext('%s'), pg_catalog.hashtext(datname)) LIMIT 1;
+				IF pooled IS NOT NULL THEN
+					EXECUTE pg_catalog.format('ALTER DATABASE %%I RENAME TO %%I', pooled, '%s');
+				END IF;
+			END $do$;""" % (self.pool_regexp(), POOL_PREFIX, self.dbname)
+		try:
+			self.psql(cmd=cmd)
+			(retcode, output) = self.psql(cmd="SELECT count(*) FROM pg_catalog.pg_database WHERE datname = '%s';" % (self.dbname,), tuples_only=True)
+		except PgError as e:
+			logging.verbose("Take pooled database fail:\n%s" % (e.output,))
+			return False
+		taken = output.strip() == "1"
+		if taken:
+			logging.debug("Test database from pool.")
+		self.refill_pool()
+		return taken
+
+	def refill_pool(self):
+		# missing pooled databases are created in background
+		global refilling
+		with refill_lock:
+			if refilling:
+				return
+			refilling = True
+		thread = threading.Thread(target=self.fill_pool)
+		thread.start()
+
+	def fill_pool(self):
+		global refilling
+		try:
+			(retcode, output) = self.psql(cmd="SELECT count(*) FROM pg_catalog.pg_database WHERE datname ~ '%s';" % (self.pool_regexp(),), tuples_only=True, exit_on_fail=False)
+			if retcode:
+				return
+			# time of creation for test-db reap, pooled database keeps it until it is taken
+			info = {"created": time.time(), "host": socket.gethostname(), "pid": os.getpid()}
+			for i in range(pool_size() - int(output.strip())):
+				name = self.pool_prefix() + uuid.uuid4().hex[:POOL_RANDOM]
+				try:
+					self.psql("CREATE DATABASE %s;" % (name,), single_transaction=False)
+					self.psql("COMMENT ON DATABASE %s IS '%s';" % (name, json.dumps(info).replace("'", "''")), single_transaction=False)
+				except PgError as e:
+					logging.verbose("Fill pool fail:\n%s" % (e.output,))
+					return
+		finally:
+			with refill_lock:
+				refilling = False
+
+	def drop_database(self, dbname, exit_on_fail=True, detach=False):
+		# connections left by interrupted commands do not block drop
+		# detach - returns process of psql, failed drop is left to test-db reap
+		try:
+			if self.server_version() >= 130000:
+				cmd = "DROP DATABASE IF EXISTS %s WITH (FORCE);" % (dbname,)
+			else:
+				self.terminate_backends(dbname)
+				cmd = "DROP DATABASE IF EXISTS %s;" % (dbname,)
+			if detach:
+				return self.run(c="psql", cmd=cmd, single_transaction=False, detach=True)
+			self.psql(cmd, single_transaction=False)
+		except PgError as e:
+			logging.error("Clean database %s fail:\n%s" % (dbname, e.output))
+			if exit_on_fail:
+				sys.exit(1)
+			return False
+		return True
+
+	def terminate_backends(self, dbname):
+		cmd = "SELECT pg_catalog.pg_terminate_backend(pid) FROM pg_catalog.pg_stat_activity WHERE datname = '%s' AND pid <> pg_catalog.pg_backend_pid();" % (dbname,)
+		self.psql(cmd=cmd, single_transaction=False, tuples_only=True, exit_on_fail=False)
+
+	def test_databases(self, prefix=TEST_PREFIX):
+		# {name: (size, info, connections)} of test databases, info is empty for databases of older pgdist
+		cmd = """SELECT d.datname, pg_catalog.pg_database_size(d.oid),
+				(SELECT count(*) FROM pg_catalog.pg_stat_activity a WHERE a.datname = d.datname),
+				pg_catalog.shobj_description(d.oid, 'pg_database')
+			FROM pg_catalog.pg_database d WHERE d.datname LIKE '%s%%';""" % (prefix.replace("_", "\\_"),)
+		(retcode, output) = self.psql(cmd=cmd, tuples_only=True)
+		databases = {}
+		for line in output.splitlines():
+			row = line.split("|", 3)
+			if len(row) == 4:
+				try:
+					info = json.loads(row[3])
+				except ValueError:
+					info = {}
+				databases[row[0]] = (int(row[1]), info, int(row[2]))
+		return databases
+
+	def templates(self):
+		# {name: (size, info)} of template databases of test loads
+		cmd = """SELECT datname, pg_catalog.pg_database_size(oid), pg_catalog.shobj_description(oid, 'pg_database')
+			FROM pg_catalog.pg_database WHERE datname LIKE '%s%%';""" % (TEMPLATE_PREFIX,)
+		(retcode, output) = self.psql(cmd=cmd, tuples_only=True)
+		templates = {}
+		for line in output.splitlines():
+			row = line.split("|", 2)
+			if len(row) == 3:
+				try:
+					info = json.loads(row[2])
+				except ValueError:
+					info = {}
+				templates[row[0]] = (int(row[1]), info)
+		return templates
+
+	def save_template(self, name, info):
+		# copy of test database, nobody can be connected to it
+		self.release_snapshot()
+		close_sessions(self.address, self.dbname)
+		info = dict(info, used=time.time())
+		try:
+			self.psql("CREATE DATABASE %s TEMPLATE %s;" % (name, self.dbname), single_transaction=False)
+			self.psql("COMMENT ON DATABASE %s IS '%s';" % (name, json.dumps(info).replace("'", "''")), single_transaction=False)
+		except PgError as e:
+			logging.verbose("Save template %s fail:\n%s" % (name, e.output))
+			return False
+		return True
+
+	def touch_template(self, name, info):
+		# time of last use for eviction
+		info = dict(info, used=time.time())
+		self.psql("COMMENT ON DATABASE %s IS '%s';" % (name, json.dumps(info).replace("'", "''")), single_transaction=False, exit_on_fail=False)
+
+	def drop_template(self, name):
+		if not name.startswith(TEMPLATE_PREFIX):
+			logging.error("Error: drop only template database")
+			sys.exit(1)
+		try:
+			self.psql("DROP DATABASE IF EXISTS %s;" % (name,), single_transaction=False)
+		except PgError as e:
+			# test database is being created from it
+			logging.verbose("Drop template %s fail:\n%s" % (name, e.output))
+			return False
+		return True
+
 	def create_roles(self, project=None, roles=None):
 		if project:
 			roles = map(lambda x: x.name, project.roles)
@@ -124,14 +979,17 @@ class PG:
 			self.psql(cmd=cmd)
 
 	def get_roles(self, cache):
-		if cache and self.test_cache_file("roles"):
-			logging.verbose("load roles from cache file")
-			return json.load(open(self.address.cache_file("roles")))
+		fingerprint = None
+		if cache:
+			fingerprint = self.fingerprint("roles")
+			cached = dump_cache.get(self.address, "roles", fingerprint=fingerprint)
+			if cached is not None:
+				return json.loads(cached)
 		cmd = """SELECT string_agg(rolname, ',') FROM pg_roles;"""
 		(retcode, output) = self.psql(cmd=cmd, tuples_only=True)
 		r = output.strip().split(",")
 		if cache:
-			json.dump(r, open(self.address.cache_file("roles"), "w"))
+			dump_cache.put(self.address, "roles", json.dumps(r), fingerprint=fingerprint)
 		return r
 
 	def load_project(self, project):
@@ -169,13 +1027,17 @@ class PG:
 		self.psql(cmd=dump, single_transaction=False, change_db=True)
 
 	def dump(self, no_owner=False, no_acl=False, cache=False):
-		if cache and self.test_cache_file("struct"):
-			logging.verbose("load struct from cache file")
-			return open(self.address.cache_file("struct")).read()
+		params = [no_owner, no_acl]
+		fingerprint = None
+		if cache:
+			fingerprint = self.fingerprint("struct")
+			cached = dump_cache.get(self.address, "struct", params, fingerprint)
+			if cached is not None:
+				return cached
 		(retcode, output) = self.pg_dump(change_db=True, no_owner=no_owner, no_acl=no_acl)
 		r = unicode(output, "UTF8")
 		if cache:
-			open(self.address.cache_file("struct"), "w").write(r)
+			dump_cache.put(self.address, "struct", r, params, fingerprint)
 		return r
 
 
@@ -185,63 +1047,122 @@ class PG:
 			self.psql(single_transaction=True, file=filename, change_db=True)
 
 	def load_data(self, project, table_data):
+		# tables are loaded in parallel, tables failing on foreign key are loaded again after the others
+		tables = Queue.Queue()
+		for table in project.table_data:
+			tables.put(table)
+		failed = []
+		errors = []
+		workers = []
+		for i in xrange(min(COPY_JOBS, len(project.table_data))):
+			worker = threading.Thread(target=self.load_data_worker, args=(tables, table_data, failed, errors))
+			worker.start()
+			workers.append(worker)
+		for worker in workers:
+			worker.join()
+		if errors:
+			raise errors[0]
 		for table in project.table_data:
-			csv_data = io.BytesIO()
-			writer = csv.writer(csv_data, delimiter=";".encode("utf8"))
-			for row in table_data[table.table_name][1:]:
-				r = []
-				for v in row:
-					if v is None:
-						r.append("NULL@15#7&679")
+			if table.table_name in failed:
+				self.copy_table(get_session(self.address, self.dbname), table, table_data)
+
+	def load_data_worker(self, tables, table_data, failed, errors):
+		session = None
+		conn_address = connect_address(self.address)
+		if conn_address:
+			session = Session(conn_address, self.dbname)
+		try:
+			while True:
+				try:
+					table = tables.get_nowait()
+				except Queue.Empty:
+					return
+				try:
+					self.copy_table(session, table, table_data)
+				except PgError as e:
+					if re.search(r"violates foreign key constraint", e.output or ""):
+						failed.append(table.table_name)
 					else:
-						r.append(v)
-				writer.writerow(r)
-			self.psql(cmd="COPY %s (%s) FROM STDIN WITH(FORMAT CSV, DELIMITER E';', NULL 'NULL@15#7&679');\n%s" % (table.table_name, ", ".join(table_data[table.table_name][0]), csv_data.getvalue()), change_db=True)
+						errors.append(e)
+		finally:
+			if session:
+				session.close()
+
+	def copy_table(self, session, table, table_data):
+		data = table_data[table.table_name]
+		cmd = "COPY %s (%s) FROM STDIN WITH(FORMAT CSV, DELIMITER E';', NULL '%s');" % (table.table_name, ", ".join(data[0]), NULL_MARKER)
+		logging.verbose("load data: %s" % (table.table_name,))
+		if session:
+			session.copy_from(cmd, CsvStream(data[1:]))
+		else:
+			self.run("psql", cmd=cmd + "\n", change_db=True, tuples_only=True, stream=CsvStream(data[1:]))
 
 	def dump_data(self, project, cache=False):
-		if cache and self.test_cache_file("data"):
-			logging.verbose("load data from cache file")
-			return json.load(open(self.address.cache_file("data")))
-		r = {}
-		c = []
+		# data of other set of tables is another entry
+		params = sorted([str(tb) for tb in project.table_data])
+		fingerprint = None
+		if cache:
+			fingerprint = self.fingerprint("data", project.table_data)
+			cached = dump_cache.get(self.address, "data", params, fingerprint)
+			if cached is not None:
+				return json.loads(cached)
+		tables = Queue.Queue()
 		for tb in project.table_data:
-			c.append("COPY %s TO STDOUT WITH(FORMAT CSV, HEADER, FORCE_QUOTE *, NULL 'NULL@15#7&679');" % (tb,))
-		(retcode, output) = self.psql(cmd="\n".join(c), change_db=True, exit_on_fail=False)
-		data = io.StringIO(unicode(output, "utf8"))
-
-		line = data.readline()
-		while True:
-			if not line:
-				break
-			x = re.match(r"COPY (?P<table>\S*) .*TO STDOUT.*NULL@15#7&679", line)
-			if x:
-				data_table = []
-				table_name = x.group("table")
-				line = data.readline()
-				if line.startswith("ERROR: "):
-					logging.warning(line)
-					continue
-				if line != "\n":
-					data_table.append(line)
-				while True:
-					line = data.readline()
-					if not line:
-						break
-					if re.match(r"COPY (?P<table>\S*) .*TO STDOUT.*NULL@15#7&679", line):
-						break
-					data_table.append(line)
-				dt = list(csv.reader(data_table))
-				for row in dt:
-					for i in xrange(len(row)):
-						if row[i] == "NULL@15#7&679":
-							row[i] = None
-				r[table_name] = dt
-			else:
-				line = data.readline()
+			tables.put(tb)
+		# all tables are copied in one snapshot by several connections
+		own_snapshot = not self.snapshot
+		r = {}
+		errors = []
+		try:
+			if own_snapshot and project.table_data:
+				self.export_snapshot()
+			workers = []
+			for i in xrange(min(COPY_JOBS, len(project.table_data))):
+				worker = threading.Thread(target=self.dump_data_worker, args=(tables, r, errors))
+				worker.start()
+				workers.append(worker)
+			for worker in workers:
+				worker.join()
+		finally:
+			if own_snapshot:
+				self.release_snapshot()
+		# data of a missing table would make wrong diff or update
+		if errors:
+			raise PgError(errors[0].returncode, errors[0].cmd, output="\n".join([e.output or str(e) for e in errors]))
 		if cache:
-			json.dump(r, open(self.address.cache_file("data"), "w"))
+			dump_cache.put(self.address, "data", json.dumps(r), params, fingerprint)
 		return r
 
+	def dump_data_worker(self, tables, result, errors):
+		session = None
+		try:
+			if self.snapshot:
+				session = Session(connect_address(self.address), self.dbname)
+			while True:
+				try:
+					table = tables.get_nowait()
+				except Queue.Empty:
+					return
+				cmd = "COPY %s TO STDOUT WITH(FORMAT CSV, HEADER, FORCE_QUOTE *, NULL '%s');" % (table, NULL_MARKER)
+				try:
+					if session:
+						rows = copy_rows(session, cmd, self.snapshot)
+					else:
+						(retcode, data) = self.psql(cmd=cmd, change_db=True, tuples_only=True)
+						rows = csv_rows(io.BytesIO(data))
+				except PgError as e:
+					errors.append(e)
+					continue
+				result[table.table_name] = rows
+		except PgError as e:
+			# tables of this worker are not copied
+			errors.append(e)
+		except Exception as e:
+			errors.append(PgError(1, "dump data", output="%s" % (e,)))
+		finally:
+			if session:
+				session.close()
+
 	def pg_extractor(self, pg_extractor, no_owner=False, no_acl=False):
 		args = ["pg_extractor", "--getall", "--gettriggers", "--basedir", pg_extractor.get_dumpdir()]
 		env = None
@@ -268,9 +1189,3 @@ class PG:
 		process = subprocess.Popen(args, bufsize=8192, cwd=pg_extractor.get_dumpdir(), env=env)
 		retcode = process.wait()
 		pg_extractor.add_db(self.address.get_dbname(self.dbname))
-
-	def test_cache_file(self, cache_type):
-		fname = self.address.cache_file(cache_type)
-		if os.path.isfile(fname):
-			return time.time() - os.path.getmtime(fname) < 4 * 60 * 60
-		return False
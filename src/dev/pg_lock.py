@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import re
+
+import pg_parser
+
+LOCK_LEVELS = [
+	"NONE",
+	"ACCESS SHARE",
+	"ROW SHARE",
+	"ROW EXCLUSIVE",
+	"SHARE UPDATE EXCLUSIVE",
+	"SHARE",
+	"SHARE ROW EXCLUSIVE",
+	"EXCLUSIVE",
+	"ACCESS EXCLUSIVE",
+]
+
+# rough speed of sequential scan in 8kB pages per second (~100MB/s)
+SCAN_PAGES_PER_SECOND = 12800
+# rewrite writes the table and rebuilds all its indexes
+REWRITE_FACTOR = 3
+
+# (regexp, lock, rewrite, scan, transactional)
+# first matching rule wins, group "table" is the locked relation
+RULES = [
+	(r"CREATE\s+(UNIQUE\s+)?INDEX\s+CONCURRENTLY\s.*\sON\s+(ONLY\s+)?(?P<table>\S+)", "SHARE UPDATE EXCLUSIVE", False, True, False),
+	(r"DROP\s+INDEX\s+CONCURRENTLY\s", "SHARE UPDATE EXCLUSIVE", False, False, False),
+	(r"REINDEX\s.*CONCURRENTLY\s+(?P<table>\S+)", "SHARE UPDATE EXCLUSIVE", False, True, False),
+	(r"VACUUM\s*(\(.*\)\s*)?((FULL|FREEZE|VERBOSE|ANALYZE)\s*)*;", "SHARE UPDATE EXCLUSIVE", False, True, False),
+	(r"VACUUM\s+(\(.*\)\s*)?FULL\s+(\S+\s+)*?(?P<table>[^\s;(]+)\s*;", "ACCESS EXCLUSIVE", True, True, False),
+	(r"VACUUM\b(.*\s)?(?P<table>[^\s;(]+)\s*;", "SHARE UPDATE EXCLUSIVE", False, True, False),
+	(r"VACUUM\b", "SHARE UPDATE EXCLUSIVE", False, True, False),
+	(r"(CREATE|DROP)\s+DATABASE\s", "NONE", False, False, False),
+	(r"ALTER\s+SYSTEM\s", "NONE", False, False, False),
+	(r"CREATE\s+(UNIQUE\s+)?INDEX\s.*\sON\s+(ONLY\s+)?(?P<table>\S+)", "SHARE", False, True, True),
+	(r"REINDEX\s+(TABLE|INDEX)\s+(?P<table>\S+)", "SHARE", False, True, True),
+	(r"CLUSTER\s+(?P<table>\S+)", "ACCESS EXCLUSIVE", True, True, True),
+	(r"TRUNCATE\s+(TABLE\s+)?(ONLY\s+)?(?P<table>[^\s,;]+)", "ACCESS EXCLUSIVE", False, False, True),
+	(r"LOCK\s+(TABLE\s+)?(ONLY\s+)?(?P<table>[^\s,;]+)\s+IN\s+(?P<lock>.+?)\s+MODE", None, False, False, True),
+	(r"LOCK\s+(TABLE\s+)?(ONLY\s+)?(?P<table>[^\s,;]+)", "ACCESS EXCLUSIVE", False, False, True),
+	(r"CREATE\s+(CONSTRAINT\s+)?TRIGGER\s.*\sON\s+(?P<table>\S+)", "SHARE ROW EXCLUSIVE", False, False, True),
+	(r"DROP\s+TRIGGER\s.*\sON\s+(?P<table>[^\s;]+)", "ACCESS EXCLUSIVE", False, False, True),
+	(r"(DROP|ALTER)\s+(MATERIALIZED\s+VIEW|VIEW|SEQUENCE|INDEX)\s+(IF\s+EXISTS\s+)?(?P<table>[^\s,;]+)", "ACCESS EXCLUSIVE", False, False, True),
+	(r"DROP\s+TABLE\s+(IF\s+EXISTS\s+)?(?P<table>[^\s,;]+)", "ACCESS EXCLUSIVE", False, False, True),
+	(r"REFRESH\s+MATERIALIZED\s+VIEW\s+CONCURRENTLY\s+(?P<table>[^\s;]+)", "EXCLUSIVE", False, True, True),
+	(r"REFRESH\s+MATERIALIZED\s+VIEW\s+(?P<table>[^\s;]+)", "ACCESS EXCLUSIVE", True, True, True),
+	(r"UPDATE\s+(ONLY\s+)?(?P<table>\S+)", "ROW EXCLUSIVE", False, True, True),
+	(r"DELETE\s+FROM\s+(ONLY\s+)?(?P<table>\S+)", "ROW EXCLUSIVE", False, True, True),
+	(r"INSERT\s+INTO\s+(?P<table>[^\s(]+)", "ROW EXCLUSIVE", False, False, True),
+	(r"COPY\s+(?P<table>[^\s(]+)(\s*\(.*?\))?\s+FROM\s", "ROW EXCLUSIVE", False, False, True),
+	(r"(SELECT|COPY)\s", "ACCESS SHARE", False, False, True),
+]
+
+# subcommands of ALTER TABLE: (regexp, lock, rewrite, scan)
+ALTER_TABLE_RULES = [
+	(r"ALTER\s+(COLUMN\s+)?\S+\s+(SET\s+DATA\s+)?TYPE\s", "ACCESS EXCLUSIVE", True, True),
+	# from PostgreSQL 11 only volatile default is evaluated for every row, stable one (now()) once
+	(r"ADD\s+(COLUMN\s+)?.*\sDEFAULT\s+.*\b(nextval|random|clock_timestamp|timeofday|gen_random_uuid|uuid_generate_\w+)\s*\(", "ACCESS EXCLUSIVE", True, True),
+	(r"ADD\s+(COLUMN\s+)?\S+\s+\S+.*\s(GENERATED\s.*STORED|SERIAL|BIGSERIAL)", "ACCESS EXCLUSIVE", True, True),
+	(r"SET\s+(LOGGED|UNLOGGED|TABLESPACE|WITH\s+OIDS|WITHOUT\s+OIDS)\b", "ACCESS EXCLUSIVE", True, True),
+	(r"ADD\s+(CONSTRAINT\s+\S+\s+)?FOREIGN\s+KEY\s.*NOT\s+VALID", "SHARE ROW EXCLUSIVE", False, False),
+	(r"ADD\s+(CONSTRAINT\s+\S+\s+)?FOREIGN\s+KEY\s", "SHARE ROW EXCLUSIVE", False, True),
+	(r"ADD\s+(CONSTRAINT\s+\S+\s+)?CHECK\s.*NOT\s+VALID", "ACCESS EXCLUSIVE", False, False),
+	(r"ADD\s+(CONSTRAINT\s+\S+\s+)?(CHECK|PRIMARY\s+KEY|UNIQUE|EXCLUDE)\s", "ACCESS EXCLUSIVE", False, True),
+	(r"ALTER\s+(COLUMN\s+)?\S+\s+SET\s+NOT\s+NULL", "ACCESS EXCLUSIVE", False, True),
+	(r"VALIDATE\s+CONSTRAINT\s", "SHARE UPDATE EXCLUSIVE", False, True),
+	(r"(SET\s+STATISTICS|SET\s*\(|RESET\s*\(|CLUSTER\s+ON|SET\s+WITHOUT\s+CLUSTER)", "SHARE UPDATE EXCLUSIVE", False, False),
+	(r"(ENABLE|DISABLE)\s+(ALWAYS\s+|REPLICA\s+)?TRIGGER\s", "SHARE ROW EXCLUSIVE", False, False),
+	(r"ATTACH\s+PARTITION\s", "SHARE UPDATE EXCLUSIVE", False, True),
+]
+
+# before PostgreSQL 11 ADD COLUMN with any default rewrites the table
+ALTER_TABLE_RULES_BEFORE_11 = [
+	(r"ADD\s+(COLUMN\s+)?.*\sDEFAULT\s+NULL\b", "ACCESS EXCLUSIVE", False, False),
+	(r"ADD\s+(COLUMN\s+)?.*\sDEFAULT\s", "ACCESS EXCLUSIVE", True, True),
+]
+
+class Statement:
+	def __init__(self, command, comment="", server_version=None):
+		self.command = command
+		self.comment = comment
+		self.table = None
+		self.lock = "NONE"
+		self.rewrite = False
+		self.scan = False
+		self.transactional = True
+		self.creates = False
+		self.ends_part = False
+		self.classify(server_version)
+
+	def classify(self, server_version=None):
+		command = re.sub(r"\s+", " ", remove_comments(self.command)).strip()
+		if not command:
+			return
+
+		x = re.match(r"ALTER\s+TYPE\s+\S+\s+ADD\s+VALUE\s", command, re.IGNORECASE)
+		if x:
+			self.lock = "ACCESS EXCLUSIVE"
+			# before PostgreSQL 12 ADD VALUE cannot run inside a transaction block
+			self.transactional = bool(server_version and server_version >= 120000)
+			# new label cannot be used until the transaction adding it is committed
+			self.ends_part = self.transactional
+			return
+
+		x = re.match(r"CREATE\s+((GLOBAL\s+|LOCAL\s+)?(TEMP|TEMPORARY)\s+|UNLOGGED\s+)?TABLE\s+(IF\s+NOT\s+EXISTS\s+)?(?P<table>[^\s(]+)", command, re.IGNORECASE)
+		if x:
+			self.table = x.group("table")
+			self.creates = True
+			return
+
+		x = re.match(r"ALTER\s+(FOREIGN\s+)?TABLE\s+(IF\s+EXISTS\s+)?(ONLY\s+)?(?P<table>\S+)\s+(?P<actions>.*)", command, re.IGNORECASE)
+		if x:
+			self.table = x.group("table")
+			for action in split_actions(x.group("actions")):
+				for (regexp, lock, rewrite, scan) in alter_table_rules(server_version):
+					if re.match(regexp, action, re.IGNORECASE):
+						break
+				else:
+					(lock, rewrite, scan) = ("ACCESS EXCLUSIVE", False, False)
+				if lock_level(lock) > lock_level(self.lock):
+					self.lock = lock
+				self.rewrite = self.rewrite or rewrite
+				self.scan = self.scan or scan
+			return
+
+		for (regexp, lock, rewrite, scan, transactional) in RULES:
+			x = re.match(regexp, command, re.IGNORECASE)
+			if x:
+				if "table" in x.groupdict():
+					self.table = x.group("table")
+				if lock:
+					self.lock = lock
+				else:
+					self.lock = re.sub(r"\s+", " ", x.group("lock").upper())
+				self.rewrite = rewrite
+				self.scan = scan
+				self.transactional = transactional
+				return
+
+	def is_empty(self):
+		return not remove_comments(self.command).strip(" \t\r\n;")
+
+	def heavy(self):
+		# lock blocking writes into table, transaction holds it until commit
+		return bool(self.table) and lock_level(self.lock) >= lock_level("SHARE")
+
+	def estimate(self, pages):
+		# estimated duration in seconds
+		if self.rewrite:
+			return float(pages) * REWRITE_FACTOR / SCAN_PAGES_PER_SECOND
+		if self.scan:
+			return float(pages) / SCAN_PAGES_PER_SECOND
+		return 0.0
+
+	def blocks(self):
+		# what the lock blocks for other sessions
+		level = lock_level(self.lock)
+		if level >= lock_level("ACCESS EXCLUSIVE"):
+			return "reads, writes"
+		if level >= lock_level("SHARE"):
+			return "writes"
+		if level >= lock_level("SHARE UPDATE EXCLUSIVE"):
+			return "ddl"
+		return ""
+
+	def kind(self):
+		if self.is_empty():
+			return None
+		if not self.transactional:
+			return "not_transactional"
+		if self.heavy():
+			return "heavy"
+		return "light"
+
+def lock_level(lock):
+	if lock in LOCK_LEVELS:
+		return LOCK_LEVELS.index(lock)
+	return 0
+
+def alter_table_rules(server_version=None):
+	# unknown server version is taken as the old one
+	if server_version and server_version >= 110000:
+		return ALTER_TABLE_RULES
+	return ALTER_TABLE_RULES_BEFORE_11 + ALTER_TABLE_RULES
+
+def transaction_control(command):
+	# BEGIN, COMMIT, ... would end transaction of single transaction part
+	return bool(re.match(r"\s*(BEGIN|START\s+TRANSACTION|COMMIT|END|ROLLBACK|ABORT|SAVEPOINT|RELEASE|PREPARE\s+TRANSACTION)\b", remove_comments(command), re.IGNORECASE))
+
+def remove_comments(command):
+	return re.sub(r"^\s*--.*$", "", command, flags=re.MULTILINE)
+
+def split_actions(actions):
+	# split comma separated subcommands of ALTER TABLE, skip commas in brackets and strings
+	result = []
+	depth = 0
+	quote = None
+	start = 0
+	for i, c in enumerate(actions):
+		if quote:
+			if c == quote:
+				quote = None
+		elif c in ("'", '"'):
+			quote = c
+		elif c == "(":
+			depth += 1
+		elif c == ")":
+			depth -= 1
+		elif c == "," and depth == 0:
+			result.append(actions[start:i].strip())
+			start = i + 1
+	result.append(actions[start:].strip().rstrip(";"))
+	return result
+
+def statements(stream, server_version=None):
+	# locks of tables created by the script itself block nobody
+	created = set()
+	for comment, command in pg_parser.Tokens(stream):
+		statement = Statement(command, comment, server_version)
+		if statement.table:
+			statement.table = re.sub(r"[(;].*$", "", statement.table)
+		if statement.table and "." not in statement.table:
+			statement.table = "public." + statement.table
+		if statement.creates:
+			created.add(statement.table)
+		if statement.table in created:
+			statement.table = None
+		yield statement
@@ -47,6 +47,17 @@ class Tokens:
 			self.read_next()
 
 
+	def read_copy_data(self):
+		# data of COPY FROM STDIN are terminated by line \.
+		line = ''
+		while self.next_char1 != '':
+			line += self.next_char1
+			self.read_next()
+			if self.next_char0 == '\n':
+				if line.rstrip('\r\n') == '\\.':
+					return
+				line = ''
+
 	def next(self):
 		buf = io.StringIO()
 		while True:
@@ -141,6 +152,8 @@ class Tokens:
 			self.read_next()
 			if self.next_char1 == '\n':
 				self.read_next()
+			if self.comment_stop_pos != -1 and re.match(r"\s*COPY\s.*\sFROM\s+STDIN\b", self.buf.getvalue()[self.comment_stop_pos:], re.IGNORECASE | re.DOTALL):
+				self.read_copy_data()
 			self.buf.seek(0)
 			if self.comment_stop_pos == -1:
 				yield self.buf.getvalue(), ''
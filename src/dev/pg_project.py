@@ -5,7 +5,15 @@ from __future__ import print_function
 import re
 import os
 import sys
+import time
+import json
 import glob
+import Queue
+import uuid
+import random
+import hashlib
+import threading
+import traceback
 import getpass
 import difflib
 import tarfile
@@ -13,12 +21,47 @@ import logging
 import io
 import cStringIO
 import subprocess
+from distutils.version import LooseVersion
 
 import color
 import utils
 import pg_conn
 import config
 import pg_parser
+import pg_types
+import pg_catalog
+import pg_lock
+import table_print
+import dump_cache
+import pg_snapshot
+import address
+import local_cluster
+
+# label of pipeline running in thread, see run_pipelines
+pipeline = threading.local()
+progress_lock = threading.Lock()
+# set when one of parallel pipelines fails
+cancelled = threading.Event()
+# test databases of running pipelines
+running_dbs = set()
+# held load slots of test databases {dbname: pg_conn.LoadSlot}
+load_slots = {}
+# part of names of test databases, commands running in parallel do not share them
+run_id = uuid.uuid4().hex[:8]
+# postgres cuts longer identifiers
+MAX_DBNAME = 63
+
+# template databases of test loads kept on test pg, in config: template_count, template_size (MB)
+TEMPLATE_COUNT = 10
+TEMPLATE_SIZE = 4096
+# archives of required projects {(git, tree_ish): tar data}, fetched once per command
+remote_archives = {}
+remote_archives_lock = threading.Lock()
+
+# hours after which test databases are orphaned, in config: test_db_reap_age
+TEST_DB_REAP_AGE = 24
+auto_reap_lock = threading.Lock()
+auto_reaped = False
 
 class Part:
 	def __init__(self, single_transaction=True, number=1):
@@ -26,6 +69,8 @@ class Part:
 		self.single_transaction = single_transaction
 		self.data = ""
 		self.number = number
+		self.backfill = None
+		self.squashed = None
 
 	def add_data(self, data):
 		self.data += data
@@ -237,6 +282,19 @@ class ProjectFs(ProjectBase):
 	def get_file(self, fname):
 		return open(os.path.join(self.directory, "sql", fname))
 
+	def sql_hash(self):
+		# all files in sql directory, files are included by \ir too
+		h = hashlib.sha1()
+		sql_dir = os.path.join(self.directory, "sql")
+		for root, dirs, files in os.walk(sql_dir):
+			dirs.sort()
+			for fname in sorted(files):
+				path = os.path.join(root, fname)
+				h.update(os.path.relpath(path, sql_dir).encode("utf8") + b"\0")
+				with open(path, "rb") as f:
+					h.update(hashlib.sha1(f.read()).digest())
+		return h.hexdigest()
+
 	def add_file(self, fname):
 		if not self.parts:
 			logging.error("Error: no part")
@@ -261,6 +319,18 @@ class ProjectGit(ProjectBase):
 		else:
 			# TODO err msg
 			sys.exit(1)
+		if git_remote:
+			# every project gets its own tar, parallel loads do not share reading of it
+			with remote_archives_lock:
+				if (git_remote, git_tree_ish) not in remote_archives:
+					remote_archives[(git_remote, git_tree_ish)] = self.archive(args)
+				output = remote_archives[(git_remote, git_tree_ish)]
+		else:
+			output = self.archive(args)
+		self.tar = tarfile.open(fileobj=cStringIO.StringIO(output), bufsize=10240)
+		self.load_conf(self.tar.extractfile("sql/pg_project.sql"))
+
+	def archive(self, args):
 		logging.verbose("Git archive: %s" % (" ".join(args),))
 		process = subprocess.Popen(args, bufsize=8192, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, cwd=self.directory or ".")
 		output, err = process.communicate()
@@ -268,18 +338,27 @@ class ProjectGit(ProjectBase):
 		if retcode != 0:
 			logging.error("Fail get git version: %s" % (err))
 			sys.exit(1)
-		self.tar = tarfile.open(fileobj=cStringIO.StringIO(output), bufsize=10240)
-		self.load_conf(self.tar.extractfile("sql/pg_project.sql"))
+		return output
 
 	def get_file(self, fname):
 		return self.tar.extractfile("sql/"+fname)
 
+	def sql_hash(self):
+		h = hashlib.sha1()
+		for member in sorted(self.tar.getmembers(), key=lambda member: member.name):
+			if member.isfile() and member.name.startswith("sql/"):
+				h.update(member.name[4:].encode("utf8") + b"\0")
+				h.update(hashlib.sha1(self.tar.extractfile(member).read()).digest())
+		return h.hexdigest()
+
 class UpdatePart:
 	def __init__(self, part, fname, single_transaction=True, new=False):
 		self.number = part
 		self.fname = fname
 		self.single_transaction = single_transaction
 		self.data = ""
+		self.backfill = None
+		self.squashed = None
 
 		if not new:
 			self.load_conf()
@@ -302,6 +381,14 @@ class UpdatePart:
 					x = re.match(r"--\s*not\s*single_transaction", line)
 					if x:
 						self.single_transaction = False
+					# backfill
+					x = re.match(r"--\s*backfill:\s+(?P<backfill>.*\S)", line)
+					if x:
+						self.backfill = x.group("backfill")
+					# squashed
+					x = re.match(r"--\s*squashed:\s+(?P<versions>.*\S)", line)
+					if x:
+						self.squashed = x.group("versions").split()
 					# end header
 					x = re.match(r"--\s*end\s+header", line)
 					if x:
@@ -315,9 +402,9 @@ class UpdatePart:
 					if x and end_header_comment:
 						data_start = True
 
-	def save_conf(self, name, old_version, new_version):
+	def save_conf(self, name, old_version, new_version, roles=None, requires=None):
 		with open(self.fname, "w") as file:
-			file.write(utils.get_header(name, "project-update", part=self, old_version=old_version, new_version=new_version))
+			file.write(utils.get_header(name, "project-update", part=self, roles=roles, requires=requires, old_version=old_version, new_version=new_version))
 			file.write(utils.get_part_header([self], "project-update"))
 
 			if self.data:
@@ -592,6 +679,60 @@ def create_version(version, git_tag, force):
 			build_file.write("--\n")
 		print("Created file: %s" % (fname))
 
+def progress(message):
+	# whole lines, prefixed by label of pipeline running in thread
+	label = getattr(pipeline, "label", None)
+	if label:
+		message = "[%s] %s" % (label, message)
+	with progress_lock:
+		sys.stderr.write(message + "\n")
+
+def run_pipelines(pipelines, parallel=True):
+	# [(label, function, args, kwargs)] run in parallel, failure of one pipeline cancels the others
+	# pg_extractor compares its dumps in order of pipelines, it needs parallel=False
+	results = [None] * len(pipelines)
+	failed = []
+	def run(i, label, function, args, kwargs):
+		pipeline.label = label
+		try:
+			results[i] = function(*args, **kwargs)
+		except SystemExit:
+			failed.append(label)
+			cancel_pipelines()
+		except Exception:
+			logging.error("Pipeline %s fail:\n%s" % (label, traceback.format_exc()))
+			failed.append(label)
+			cancel_pipelines()
+		finally:
+			pipeline.label = None
+	cancelled.clear()
+	threads = []
+	for i, (label, function, args, kwargs) in enumerate(pipelines):
+		if not parallel:
+			if not failed:
+				run(i, label, function, args, kwargs)
+			continue
+		thread = threading.Thread(target=run, args=(i, label, function, args, kwargs))
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		thread.join()
+	if failed:
+		sys.exit(1)
+	return results
+
+def cancel_pipelines():
+	# running commands in test databases of other pipelines are terminated
+	if cancelled.is_set():
+		return
+	cancelled.set()
+	for dbname in list(running_dbs):
+		pg_conn.PG(config.test_db).terminate_backends(dbname)
+
+def check_cancelled():
+	if cancelled.is_set():
+		raise pg_conn.PgError(1, "cancelled", output="cancelled")
+
 def load_requires(project, pg, loop_detect=[]):
 	loop2 = loop_detect + [project.name]
 	for require in project.requires:
@@ -600,74 +741,278 @@ def load_requires(project, pg, loop_detect=[]):
 		if require.project_name not in pg.loaded_projects_name:
 			p = ProjectGit(git_remote=require.git, git_tree_ish=require.tree_ish)
 			load_requires(p, pg, loop_detect)
-			print("load require project %s to test pg" % (p.name,), file=sys.stderr)
+			progress("load require project %s to test pg" % (p.name,))
 			pg.load_project(p)
 
+def requires_key(project, loop_detect=[]):
+	# content of required projects, branch in tree-ish gets a new key when it moves
+	loop2 = loop_detect + [project.name]
+	key = []
+	for require in project.requires:
+		if require.project_name in loop2:
+			logging.error("Error: requires loop: %s" % (" > ".join(loop2)))
+			sys.exit(1)
+		p = ProjectGit(git_remote=require.git, git_tree_ish=require.tree_ish)
+		key.append((require.project_name, p.sql_hash(), requires_key(p, loop2)))
+	return key
+
+def template_name(*key):
+	return pg_conn.TEMPLATE_PREFIX + hashlib.sha1(json.dumps(key)).hexdigest()[:24]
+
+def file_hash(fname):
+	if not fname:
+		return None
+	with open(fname, "rb") as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+def init_and_load(project, pg, pre_load=None):
+	# test database with pre_load, requires and project, copied from templates kept on test pg
+	if not config.use_templates:
+		pg.init()
+		pg.load_file(pre_load)
+		load_requires(project, pg)
+		progress("load project %s to test pg" % (project.name,))
+		pg.load_project(project)
+		return
+	requires_template = None
+	if pre_load or project.requires:
+		requires_template = template_name("requires", file_hash(pre_load), requires_key(project))
+	project_template = template_name("project", requires_template, project.name, project.sql_hash())
+	templates = pg.templates()
+	if project_template in templates:
+		progress("create test database from template of project %s" % (project.name,))
+		pg.init(template=project_template)
+		pg.touch_template(project_template, templates[project_template][1])
+		pg.create_roles(project)
+		return
+	if requires_template in templates:
+		progress("create test database from template of requires of project %s" % (project.name,))
+		pg.init(template=requires_template)
+		pg.touch_template(requires_template, templates[requires_template][1])
+	else:
+		pg.init()
+		pg.load_file(pre_load)
+		load_requires(project, pg)
+		check_cancelled()
+		if requires_template:
+			pg.save_template(requires_template, {"project": project.name, "stage": "requires"})
+	check_cancelled()
+	progress("load project %s to test pg" % (project.name,))
+	pg.load_project(project)
+	check_cancelled()
+	pg.save_template(project_template, {"project": project.name, "stage": "project"})
+	evict_templates(pg)
+
+def evict_templates(pg):
+	# least recently used templates over count and size limits
+	count = int(config.get("template_count") or TEMPLATE_COUNT)
+	size_limit = int(config.get("template_size") or TEMPLATE_SIZE) * 1024 * 1024
+	templates = sorted(pg.templates().items(), key=lambda template: template[1][1].get("used", 0), reverse=True)
+	size = 0
+	for i, (name, (template_size, info)) in enumerate(templates):
+		size += template_size
+		if i >= count or size > size_limit:
+			logging.verbose("drop template %s of %s" % (name, info.get("project")))
+			pg.drop_template(name)
+
+def test_db_prefix():
+	return re.sub(r"\W", "", "%s%s_" % (pg_conn.TEST_PREFIX, getpass.getuser()))
+
 def get_test_dbname(project_name, dbs=None):
+	auto_reap()
 	if dbs:
-		return "pgdist_test_%s_%s_%s" % (getpass.getuser(), project_name, dbs)
+		name = "%s%s_%s" % (test_db_prefix(), project_name, dbs)
 	else:
-		return "pgdist_test_%s_%s" % (getpass.getuser(), project_name)
+		name = "%s%s" % (test_db_prefix(), project_name)
+	name = re.sub(r"\W", "", name)
+	suffix = "_%s" % (run_id,)
+	if len(name) + len(suffix) > MAX_DBNAME:
+		# long names are cut and distinguished by hash
+		name = "%s_%s" % (name[:MAX_DBNAME - len(suffix) - 7], hashlib.sha1(name.encode("utf8")).hexdigest()[:6])
+	return name + suffix
+
+def max_loads():
+	return int(config.get("test_db_max_loads") or 0)
+
+def start_load(pg):
+	# test database of pipeline, waits for free load slot of test pg
+	running_dbs.add(pg.dbname)
+	slot = pg_conn.LoadSlot(pg.address, max_loads())
+	load_slots[pg.dbname] = slot
+	waiting = False
+	while not slot.acquire():
+		check_cancelled()
+		if not waiting:
+			progress("wait for free load slot of test pg (test_db_max_loads %d)" % (max_loads(),))
+			waiting = True
+		time.sleep(1)
+
+def end_load(pg):
+	running_dbs.discard(pg.dbname)
+	slot = load_slots.pop(pg.dbname, None)
+	if slot:
+		slot.release()
+
+def select_test_db():
+	# the least loaded of more test_db servers by held load slots and connections to test databases
+	if len(config.test_dbs) < 2:
+		return
+	loads = []
+	for addr in config.test_dbs:
+		counts = pg_conn.load_counts(addr)
+		if counts is not None:
+			# equally loaded servers are chosen randomly
+			loads.append((counts, random.random(), addr))
+	if loads:
+		config.test_db = min(loads)[2]
+	logging.verbose("test_db: %s" % (config.test_db.addr,))
+
+def reap_test_dbs(pg, age):
+	# test databases of user older than age hours left by interrupted commands
+	dropped = []
+	now = time.time()
+	for name, (size, info, connections) in sorted(pg.test_databases(test_db_prefix()).items()):
+		if name in running_dbs or name in pg_conn.cleanups:
+			continue
+		if "created" in info:
+			if now - info["created"] < age * 3600:
+				continue
+		elif connections:
+			# database of older pgdist without time of creation, dropped when unused
+			continue
+		logging.verbose("reap test database %s" % (name,))
+		if pg.drop_database(name, exit_on_fail=False):
+			dropped.append((name, size))
+	# pooled databases over size of pool and old ones, pool is refilled by next load
+	pooled = sorted(pg.pooled_databases().items(), key=lambda database: database[1][1].get("created", 0), reverse=True)
+	for i, (name, (size, info, connections)) in enumerate(pooled):
+		if connections or (i < pg_conn.pool_size() and now - info.get("created", 0) < age * 3600):
+			continue
+		logging.verbose("reap pooled database %s" % (name,))
+		if pg.drop_database(name, exit_on_fail=False):
+			dropped.append((name, size))
+	return dropped
+
+def reap_age():
+	return float(config.get("test_db_reap_age") or TEST_DB_REAP_AGE)
+
+def auto_reap():
+	# config test_db_auto_reap, once per command in background
+	global auto_reaped
+	if config.get("test_db_auto_reap", "no").lower() not in ("yes", "true", "on", "1"):
+		return
+	with auto_reap_lock:
+		if auto_reaped:
+			return
+		auto_reaped = True
+	thread = threading.Thread(target=reap_test_dbs, args=(pg_conn.PG(config.test_db), reap_age()))
+	thread.start()
+
+def test_db_stop():
+	# local cluster is stopped before idle timeout, its databases are removed
+	if not isinstance(config.test_db, local_cluster.LocalAddress):
+		logging.error("Error: test_db is not local")
+		sys.exit(1)
+	local_cluster.shutdown(config.test_db.directory)
+
+def test_db_reap(age=None, reap_all=False):
+	config.check_set_test_db()
+	if reap_all:
+		age = 0
+	elif age is None:
+		age = reap_age()
+	dropped = []
+	for addr in config.test_dbs:
+		dropped += reap_test_dbs(pg_conn.PG(addr), age)
+	for name, size in dropped:
+		print(name)
+	print("removed %d test databases, %.1f MB" % (len(dropped), sum([size for name, size in dropped]) / 1024.0 / 1024.0))
 
 def load_and_dump(project, clean=True, no_owner=False, no_acl=False, pre_load=None, post_load=None, updates=None, dbs=None, pg_extractor=None):
 	try:
 		pg = pg_conn.PG(config.test_db, dbname=get_test_dbname(project.name, dbs))
-		pg.init()
-		pg.load_file(pre_load)
-		load_requires(project, pg)
-		print("load project %s to test pg" % (project.name,), file=sys.stderr)
-		pg.load_project(project)
+		start_load(pg)
+		init_and_load(project, pg, pre_load)
 		if updates:
 			for update in updates:
-				print("load update %s %s to test pg" % (project.name, update), file=sys.stderr)
+				check_cancelled()
+				progress("load update %s %s to test pg" % (project.name, update))
 				pg.load_update(update)
+		check_cancelled()
 		pg.load_file(post_load)
-		print("dump structure and data from test pg", file=sys.stderr)
+		progress("dump structure and data from test pg")
 		dump = pg.dump(no_owner, no_acl)
 		table_data = pg.dump_data(project)
 		if pg_extractor:
 			pg.pg_extractor(pg_extractor, no_owner, no_acl)
+		check_cancelled()
 	except pg_conn.PgError as e:
-		logging.error("Load project fail:\n%s" % (e.output))
+		end_load(pg)
+		if cancelled.is_set():
+			progress("cancelled")
+		else:
+			logging.error("Load project fail:\n%s" % (e.output))
 		if clean:
-			pg.clean()
+			pg.clean(background=True)
 		else:
 			print("Check database: %s" % pg.dbname)
 		sys.exit(1)
+	end_load(pg)
 	if clean:
-		pg.clean()
+		pg.clean(background=True)
 	else:
 		print("Check database: %s" % pg.dbname)
 	return dump, table_data
 
+def load_and_parse(project, parse=True, data=True, **load_args):
+	# pipeline of load_and_dump and parse of the dump
+	dump, table_data = load_and_dump(project, **load_args)
+	if not parse:
+		return None
+	progress("parse dump of project %s" % (project.name,))
+	pr = pg_parser.parse(io.StringIO(dump))
+	if data:
+		pr.set_data(table_data)
+	return pr
+
 def load_dump_and_dump(dump_remote, project, table_data=None, clean=True, no_owner=False, no_acl=False, pre_load=None, post_load=None, dbs=None, pg_extractor=None, project_name=None):
 	try:
 		if not project_name:
 			project_name = project.name
 		pg = pg_conn.PG(config.test_db, dbname=get_test_dbname(project_name, dbs))
+		start_load(pg)
 		pg.init()
 		pg.load_file(pre_load)
-		print("load dump to test pg", file=sys.stderr)
+		check_cancelled()
+		progress("load dump to test pg")
 		pg.load_dump(dump_remote)
 		if project and table_data:
+			check_cancelled()
 			pg.load_data(project, table_data)
+		check_cancelled()
 		pg.load_file(post_load)
-		print("dump structure and data from test pg", file=sys.stderr)
+		progress("dump structure and data from test pg")
 		dump = pg.dump(no_owner, no_acl)
 		table_data_new = None
 		if project:
 			table_data_new = pg.dump_data(project)
 		if pg_extractor:
 			pg.pg_extractor(pg_extractor, no_owner, no_acl)
+		check_cancelled()
 	except pg_conn.PgError as e:
-		logging.error("Load dump fail:\n%s" % (e.output))
+		end_load(pg)
+		if cancelled.is_set():
+			progress("cancelled")
+		else:
+			logging.error("Load dump fail:\n%s" % (e.output))
 		if clean:
-			pg.clean()
+			pg.clean(background=True)
 		else:
 			print("Check database: %s" % pg.dbname)
 		sys.exit(1)
+	end_load(pg)
 	if clean:
-		pg.clean()
+		pg.clean(background=True)
 	else:
 		print("Check database: %s" % pg.dbname)
 	return dump, table_data_new
@@ -675,25 +1020,34 @@ def load_dump_and_dump(dump_remote, project, table_data=None, clean=True, no_own
 def load_file_and_dump(fname, project_name="undef", clean=True, no_owner=False, no_acl=False, pre_load=None, post_load=None, dbs=None, pg_extractor=None):
 	try:
 		pg = pg_conn.PG(config.test_db, dbname=get_test_dbname(project_name, dbs))
+		start_load(pg)
 		pg.init()
 		pg.load_file(pre_load)
-		print("load file %s to test pg" % (fname,), file=sys.stderr)
+		check_cancelled()
+		progress("load file %s to test pg" % (fname,))
 		pg.load_file(fname)
+		check_cancelled()
 		pg.load_file(post_load)
-		print("dump structure and data from test pg", file=sys.stderr)
+		progress("dump structure and data from test pg")
 		dump = pg.dump(no_owner, no_acl)
 		if pg_extractor:
 			pg.pg_extractor(pg_extractor, no_owner, no_acl)
+		check_cancelled()
 	except pg_conn.PgError as e:
-		logging.error("Load dump fail:\n%s" % (e.output))
-		print(e.output)
+		end_load(pg)
+		if cancelled.is_set():
+			progress("cancelled")
+		else:
+			logging.error("Load dump fail:\n%s" % (e.output))
+			print(e.output)
 		if clean:
-			pg.clean()
+			pg.clean(background=True)
 		else:
 			print("Check database: %s" % pg.dbname)
 		sys.exit(1)
+	end_load(pg)
 	if clean:
-		pg.clean()
+		pg.clean(background=True)
 	else:
 		print("Check database: %s" % pg.dbname)
 	return dump
@@ -712,7 +1066,8 @@ def test_load(clean=True, pre_load=None, post_load=None, pg_extractor=None, no_o
 	print("")
 
 def create_update(git_tag, new_version, force, gitversion=None, clean=True, pre_load=None, post_load=None,
-		pre_load_old=None, pre_load_new=None, post_load_old=None, post_load_new=None, part_count=None):
+		pre_load_old=None, pre_load_new=None, post_load_old=None, post_load_new=None, part_count=None, backfills=None, batch_size=10000,
+		target_version=None):
 	if not pre_load_old:
 		pre_load_old = pre_load
 	if not pre_load_new:
@@ -769,9 +1124,50 @@ def create_update(git_tag, new_version, force, gitversion=None, clean=True, pre_
 	if not os.path.isdir(os.path.join(project_old.directory, "sql_dist")):
 		os.mkdir(os.path.join(project_old.directory, "sql_dist"))
 
+	fname_pattern = "%s--%s--%s*.sql" % (to_fname(project_old.name), to_fname(old_version), to_fname(new_version))
+	for build_fname in glob.glob(os.path.join(project_old.directory, "sql_dist", fname_pattern)):
+		if not force:
+			logging.error("Error file exists: %s" % (build_fname,))
+			sys.exit(1)
+
+	pr_new = None
+	update_data = io.StringIO()
+	update_data_nt = io.StringIO()
+	if config.git_diff:
+		for diff_file in diff_files:
+			update_data.write("-- %s\n\n" % (diff_file[0]))
+			update_data.write(diff_file[1])
+	else:
+		(pr_old, pr_new) = run_pipelines([
+			("old", load_and_parse, (project_old,), dict(clean=clean, pre_load=pre_load_old, post_load=post_load_old, dbs="old")),
+			("new", load_and_parse, (project_new,), dict(clean=clean, pre_load=pre_load_new, post_load=post_load_new, dbs="new")),
+		])
+		# update is generated for the server it will run on, test pg by default
+		if target_version:
+			server_version = parse_version(target_version)
+		else:
+			server_version = get_server_version(config.test_db)
+		pr_old.gen_update(update_data, pr_new, server_version, update_data_nt)
+
+	# (single_transaction, backfill, data) of every part
+	update_parts = []
+	if config.git_diff:
+		update_parts.append((True, None, update_data.getvalue()))
+	else:
+		# not transactional commands go first, split merges them with following ones of the same kind
+		for single_transaction, data in split_update(update_data_nt.getvalue() + update_data.getvalue(), server_version):
+			update_parts.append((single_transaction, None, data))
+	# PARTS is minimal count of parts, backfill parts are added after them
+	for i in xrange(part_count - len(update_parts)):
+		update_parts.append((True, None, ""))
+	for backfill in backfills or []:
+		# backfill runs in batches, each batch is committed separately
+		(backfill_header, backfill_command) = get_backfill(backfill, pr_new, batch_size)
+		update_parts.append((False, backfill_header, backfill_command))
+
 	# first part can be without --p%02d (--p01)
-	for part in xrange(part_count):
-		if part_count == 1:
+	for part, (single_transaction, backfill, data) in enumerate(update_parts):
+		if len(update_parts) == 1:
 			fname_part = ""
 		else:
 			fname_part = "--p%02d" % (part+1)
@@ -779,29 +1175,143 @@ def create_update(git_tag, new_version, force, gitversion=None, clean=True, pre_
 		fname = "%s--%s--%s%s.sql" % (to_fname(project_old.name), to_fname(old_version), to_fname(new_version), fname_part)
 		build_fname = os.path.join(project_old.directory, "sql_dist", fname)
 
-		if os.path.isfile(build_fname) and not force:
-			logging.error("Error file exists: %s" % (build_fname,))
+		logging.verbose("Create file: %s" % (build_fname,))
+		update_part = UpdatePart(part+1, build_fname, single_transaction, new=True)
+		update_part.backfill = backfill
+		update_part.data = data
+		update_part.save_conf(project_new.name, old_version, new_version, roles=project_new.roles, requires=project_new.requires)
+		print("Edit created file: %s" % (build_fname))
+	print("and test it by 'pgdist test-update %s %s'" % (git_tag, new_version))
+
+def split_update(data, server_version=None):
+	# split generated update into parts: statements not allowed in transaction block
+	# get own parts, statements locking tables (SHARE and stronger) are separated
+	# from the light ones, order of statements is kept, statements which
+	# have to be committed before next ones (ADD VALUE) end their part
+	# returns [(single_transaction, data), ...]
+	parts = []
+	kind = None
+	ends_part = False
+	buf = io.StringIO()
+	for statement in pg_lock.statements(io.StringIO(data), server_version):
+		statement_kind = statement.kind()
+		comment = statement.comment
+		if statement_kind and kind and (statement_kind != kind or ends_part and not statement.ends_part):
+			# end of previous element belongs to previous part
+			lines = comment.splitlines(True)
+			for i in reversed(xrange(len(lines))):
+				if re.match(r";?--\s*end\s", lines[i]):
+					buf.write("".join(lines[:i+1]))
+					comment = "".join(lines[i+1:])
+					break
+			parts.append((kind != "not_transactional", buf.getvalue()))
+			buf = io.StringIO()
+			ends_part = False
+		if statement_kind:
+			kind = statement_kind
+			ends_part = ends_part or statement.ends_part
+		buf.write(comment)
+		buf.write(statement.command)
+	if buf.getvalue().strip() or not parts:
+		parts.append((kind != "not_transactional", buf.getvalue()))
+	return parts
+
+def get_backfill(backfill, project, batch_size):
+	# TABLE[(KEY)] SET COLUMN = EXPRESSION [WHERE CONDITION]
+	x = re.match(r'\s*(?P<table>(?:"(?:[^"]|"")*"|[^\s"(])+)\s*(\((?P<key>(?:"(?:[^"]|"")*"|[^)"])+)\))?\s+(?P<set>SET\s.*\S)', backfill, re.IGNORECASE | re.DOTALL)
+	if not x:
+		logging.error("Error: backfill cannot be parsed: %s" % (backfill,))
+		sys.exit(1)
+	table_name = x.group("table")
+	if "." not in table_name:
+		table_name = "public." + table_name
+	key = x.group("key")
+	if not key:
+		if not project or table_name not in project.tables:
+			logging.error("Error: backfill table %s not found, set key column: TABLE(KEY) SET ..." % (table_name,))
 			sys.exit(1)
+		primary_key = project.tables[table_name].primary_key()
+		if not primary_key or len(primary_key) != 1:
+			logging.error("Error: backfill table %s has no single column primary key, set key column: TABLE(KEY) SET ..." % (table_name,))
+			sys.exit(1)
+		key = pg_types.quote_ident(primary_key[0])
+	command = "UPDATE %s %s;\n" % (table_name, x.group("set").rstrip(";"))
+	return "%s %s %d" % (table_name, key.strip(), batch_size), command
 
-		logging.verbose("Create file: %s" % (build_fname,))
-		update_part = Part(True, part+1)
+def analyze_update(old_version, new_version, addr):
+	project = ProjectFs()
+	update = Update(project.name, old_version, new_version)
+	if not update.parts:
+		logging.error("Error: update %s -> %s not found" % (old_version, new_version))
+		sys.exit(1)
 
-		with open(build_fname, "w") as build_file:
-			build_file.write(utils.get_header(project_new.name, "project-update", part=update_part, roles=project_new.roles, requires=project_new.requires, old_version=old_version, new_version=new_version))
-			build_file.write(utils.get_part_header([update_part], "project-update"))
-
-			if config.git_diff and part == 0:
-				for diff_file in diff_files:
-					build_file.write("-- %s\n\n" % (diff_file[0]))
-					build_file.write(diff_file[1])
-			elif part == 0:
-				dump_old, x = load_and_dump(project_old, clean=clean, pre_load=pre_load_old, post_load=post_load_old, dbs="old")
-				dump_new, x = load_and_dump(project_new, clean=clean, pre_load=pre_load_new, post_load=post_load_new, dbs="new")
-				pr_old = pg_parser.parse(io.StringIO(dump_old))
-				pr_new = pg_parser.parse(io.StringIO(dump_new))
-				pr_old.gen_update(build_file, pr_new)
-		print("Edit created file: %s" % (build_fname))
-		print("and test it by 'pgdist test-update %s %s'" % (git_tag, new_version))
+	try:
+		pg = pg_conn.PG(addr)
+		server_version = pg.server_version()
+		sizes = pg.table_sizes()
+	except pg_conn.PgError as e:
+		logging.error("Get table sizes fail:\n%s" % (e.output))
+		sys.exit(1)
+
+	# (score, part, line, statement, pages, tuples, duration, held)
+	report = []
+	for part in update.parts:
+		# data are the end of part file, count lines of header
+		with io.open(part.fname, encoding="utf8") as f:
+			content = f.read()
+		line = content[:len(content) - len(part.data)].count("\n") + 1
+		part_statements = []
+		for statement in pg_lock.statements(io.StringIO(part.data), server_version):
+			line += statement.comment.count("\n")
+			if not statement.is_empty():
+				(pages, tuples) = sizes.get(statement.table, (0, 0))
+				part_statements.append((line, statement, pages, tuples, statement.estimate(pages)))
+			line += statement.command.count("\n")
+		part_duration = sum(map(lambda x: x[4], part_statements))
+		for (line, statement, pages, tuples, duration) in part_statements:
+			if part.single_transaction and not part.backfill and statement.blocks():
+				# lock is held until the end of transaction
+				held = part_duration
+			else:
+				held = duration
+			if statement.blocks() == "reads, writes":
+				weight = 100
+			elif statement.blocks() == "writes":
+				weight = 10
+			else:
+				weight = 1
+			score = (weight * held, pg_lock.lock_level(statement.lock))
+			report.append((score, part, line, statement, pages, tuples, duration, held))
+
+	report.sort(key=lambda x: x[0], reverse=True)
+	tp = table_print.TablePrint(["part:line", "lock", "blocks", "rewrite", "scan", "table", "pages", "rows", "duration", "lock held", "statement"])
+	for (score, part, line, statement, pages, tuples, duration, held) in report:
+		command = re.sub(r"\s+", " ", pg_lock.remove_comments(statement.command)).strip()
+		if len(command) > 60:
+			command = command[:57] + "..."
+		tp.add([
+			"%d:%d" % (part.number, line),
+			statement.lock,
+			statement.blocks(),
+			"yes" if statement.rewrite else "",
+			"yes" if statement.scan else "",
+			statement.table or "",
+			pages,
+			tuples,
+			format_duration(duration),
+			format_duration(held),
+			command,
+		])
+	print(tp.format())
+
+def format_duration(seconds):
+	if seconds < 1:
+		return "< 1s"
+	if seconds < 60:
+		return "%ds" % (seconds,)
+	if seconds < 3600:
+		return "%dm %ds" % (seconds // 60, seconds % 60)
+	return "%dh %dm" % (seconds // 3600, seconds % 3600 // 60)
 
 def part_update_add(old_version, new_version, transaction_type=None):
 	project = ProjectFs()
@@ -837,31 +1347,131 @@ def test_update(git_tag, new_version, clean=True, gitversion=None, pre_load=None
 	upds = []
 	upds.append(Update(project_old.name, old_version, new_version))
 
-	dump_updated, table_data_updated = load_and_dump(project_old, clean=clean, pre_load=pre_load_old, post_load=post_load_old, updates=upds, dbs="updated",
-		pg_extractor=pg_extractor)
-	dump_cur, table_data_cur = load_and_dump(project_new, clean=clean, pre_load=pre_load_new, post_load=post_load_new,
-		pg_extractor=pg_extractor)
+	# data of tables is not compared
+	(pr_updated, pr_cur) = run_pipelines([
+		("updated", load_and_parse, (project_old,), dict(clean=clean, pre_load=pre_load_old, post_load=post_load_old, updates=upds, dbs="updated",
+			pg_extractor=pg_extractor, parse=not pg_extractor, data=False)),
+		("current", load_and_parse, (project_new,), dict(clean=clean, pre_load=pre_load_new, post_load=post_load_new,
+			pg_extractor=pg_extractor, parse=not pg_extractor, data=False)),
+	], parallel=not pg_extractor)
 
 	if pg_extractor:
 		pg_extractor.print_diff()
 		pg_extractor.clean()
 	else:
-		pr_cur = pg_parser.parse(io.StringIO(dump_cur))
-		pr_updated = pg_parser.parse(io.StringIO(dump_updated))
 		if not no_owner:
 			logging.info("checking element owners")
 			pr_updated.check_elements_owner()
 		pr_updated.diff(pr_cur)
 
+def find_update_chain(project_name, old_version, new_version, directory=None):
+	# chain of updates like pgdist update chooses them, without direct update old -> new
+	if not directory:
+		directory = find_directory()
+	fname_re = r"%s--(?P<old>.+?)--(?P<new>.+?)(--p\d+)?\.sql$" % (re.escape(to_fname(project_name)),)
+	updates = set()
+	for fname in glob.glob(os.path.join(directory, "sql_dist", "%s--*.sql" % (to_fname(project_name),))):
+		x = re.match(fname_re, os.path.basename(fname))
+		if x and not re.match(r"p\d+$", x.group("new")):
+			updates.add((x.group("old"), x.group("new")))
+	updates.discard((to_fname(old_version), to_fname(new_version)))
+
+	chain = []
+	version = to_fname(old_version)
+	while version != to_fname(new_version):
+		candidates = [u for u in updates if u[0] == version and LooseVersion(u[1]) <= LooseVersion(new_version)]
+		if not candidates:
+			logging.error("Error: update chain from %s to %s not found" % (old_version, new_version))
+			sys.exit(1)
+		update = max(candidates, key=lambda u: LooseVersion(u[1]))
+		chain.append(Update(project_name, update[0], update[1], directory))
+		version = update[1]
+	return chain
+
+def squash_updates(git_tag, new_version, force, gitversion=None, test=True, **test_args):
+	if gitversion:
+		old_version = gitversion
+	else:
+		old_version = re.sub(r"^[^\d]*", "", git_tag)
+	new_version = re.sub(r"^[^\d]*", "", new_version)
+
+	project = ProjectFs()
+	chain = find_update_chain(project.name, old_version, new_version)
+	if len(chain) < 2:
+		logging.error("Error: nothing to squash, update chain from %s to %s has %d update(s)" % (old_version, new_version, len(chain)))
+		sys.exit(1)
+
+	versions = [chain[0].old_version]
+	data = io.StringIO()
+	for update in chain:
+		versions.append(update.new_version)
+		for part in update.parts:
+			if not part.single_transaction or part.backfill:
+				logging.error("Error: update %s -> %s part %d is not single transaction, chain cannot be squashed" % (update.old_version, update.new_version, part.number))
+				sys.exit(1)
+			for comment, command in pg_parser.Tokens(io.StringIO(part.data)):
+				if pg_lock.transaction_control(command):
+					logging.error("Error: update %s -> %s part %d contains %s, chain cannot be squashed" % (update.old_version, update.new_version, part.number, pg_lock.remove_comments(command).strip().rstrip(";")))
+					sys.exit(1)
+			data.write("\n--\n-- update %s -> %s part %d\n--\n\n" % (update.old_version, update.new_version, part.number))
+			data.write(part.data.strip())
+			data.write("\n")
+
+	fname_pattern = "%s--%s--%s*.sql" % (to_fname(project.name), to_fname(old_version), to_fname(new_version))
+	for build_fname in glob.glob(os.path.join(project.directory, "sql_dist", fname_pattern)):
+		if not force:
+			logging.error("Error file exists: %s" % (build_fname,))
+			sys.exit(1)
+		os.unlink(build_fname)
+
+	fname = "%s--%s--%s.sql" % (to_fname(project.name), to_fname(old_version), to_fname(new_version))
+	build_fname = os.path.join(project.directory, "sql_dist", fname)
+	logging.verbose("Create file: %s" % (build_fname,))
+	part = UpdatePart(1, build_fname, True, new=True)
+	part.squashed = versions
+	part.data = data.getvalue()
+	part.save_conf(project.name, old_version, new_version, roles=project.roles, requires=project.requires)
+	print("Created squashed update: %s (%s)" % (build_fname, " -> ".join(versions)))
+
+	if test:
+		test_update(git_tag, new_version, gitversion=gitversion, **test_args)
+
 def dump_remote(addr, no_owner, no_acl, cache):
 	try:
 		pg = pg_conn.PG(addr)
-		print("dump remote", file=sys.stderr)
+		progress("dump remote")
 		return pg.dump(no_owner, no_acl, cache=cache)
 	except pg_conn.PgError as e:
 		logging.error("Dump fail:\n%s" % (e.output))
 		sys.exit(1)
 
+def dump_remote_and_data(project, addr, no_owner, no_acl, cache):
+	# structure and data of tables from one snapshot of remote database
+	try:
+		pg = pg_conn.PG(addr)
+		progress("dump remote")
+		pg.export_snapshot()
+		# pg_dump runs while tables are copied, both in exported snapshot
+		result = {}
+		def dump_structure():
+			try:
+				result["dump"] = pg.dump(no_owner, no_acl, cache=cache)
+			except pg_conn.PgError as e:
+				result["error"] = e
+		thread = threading.Thread(target=dump_structure)
+		thread.start()
+		try:
+			table_data = pg.dump_data(project, cache=cache)
+		finally:
+			thread.join()
+			pg.release_snapshot()
+		if "error" in result:
+			raise result["error"]
+		return result["dump"], table_data
+	except pg_conn.PgError as e:
+		logging.error("Dump fail:\n%s" % (e.output))
+		sys.exit(1)
+
 def dump_remote_data(project, addr, cache):
 	try:
 		pg = pg_conn.PG(addr)
@@ -870,6 +1480,98 @@ def dump_remote_data(project, addr, cache):
 		logging.error("Dump data fail:\n%s" % (e.output))
 		sys.exit(1)
 
+def catalog_remote(addr, no_owner, no_acl):
+	try:
+		pg = pg_conn.PG(addr)
+		progress("read catalog remote")
+		return pg_catalog.load_project(pg, no_owner, no_acl)
+	except pg_conn.PgError as e:
+		logging.error("Read catalog fail:\n%s" % (e.output))
+		sys.exit(1)
+
+def catalog_check(addr, no_owner, no_acl, ignore_space=False):
+	# differences between project from pg_dump and from catalogs of the same database
+	pr_dump = pg_parser.parse(io.StringIO(dump_remote(addr, no_owner, no_acl, False)))
+	pr_catalog = catalog_remote(addr, no_owner, no_acl)
+	print("-- pg_dump (-) and catalog (+) of %s" % (addr.addr,))
+	pr_dump.diff(pr_catalog, no_owner=no_owner, no_acl=no_acl, ignore_space=ignore_space)
+
+def cache_list():
+	tp = table_print.TablePrint(["type", "pgconn", "params", "size", "age", "last use"])
+	now = time.time()
+	for entry in dump_cache.entries():
+		params = entry.params
+		if entry.entry_type == "data":
+			params = "%d tables" % (len(params),)
+		elif entry.entry_type == "struct":
+			params = ", ".join([name for name, value in zip(("no-owner", "no-acl"), params) if value])
+		tp.add([
+			entry.entry_type,
+			entry.addr,
+			params or "",
+			"%.1f MB" % (entry.size / 1024.0 / 1024.0,),
+			format_duration(entry.age()),
+			format_duration(now - entry.used),
+		])
+	print(tp.format())
+
+def cache_prune(remove_all=False):
+	removed = dump_cache.prune(remove_all)
+	print("removed %d cache entries, %.1f MB" % (len(removed), sum([entry.size for entry in removed]) / 1024.0 / 1024.0))
+
+def cache_warm(addr, git_tag, no_owner, no_acl):
+	# fill cache used by diff-db --cache
+	if git_tag:
+		project = ProjectGit(git_tag)
+	else:
+		project = ProjectFs()
+	get_roles(addr, True)
+	dump_remote_and_data(project, addr, no_owner, no_acl, True)
+
+def snapshot(addr, name, no_owner, no_acl, cache):
+	# structure and data of tables of project in database saved for diffs without database
+	project = ProjectFs()
+	dump, table_data = dump_remote_and_data(project, addr, no_owner, no_acl, cache)
+	name = pg_snapshot.save(name, addr, pg_parser.parse(io.StringIO(dump)), table_data, no_owner, no_acl)
+	print(name)
+
+def snapshot_list():
+	tp = table_print.TablePrint(["name", "pgconn", "created", "elements", "tables", "options"])
+	for manifest in pg_snapshot.manifests():
+		tp.add([
+			manifest["name"],
+			manifest["addr"],
+			time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(manifest["created"])),
+			sum([len(elements) for elements in manifest["elements"].values()]) + len(manifest["others"]),
+			len(manifest["data"]),
+			", ".join([option for option in ("no-owner", "no-acl") if manifest[option.replace("-", "_")]]),
+		])
+	print(tp.format())
+	objects = pg_snapshot.objects()
+	print("objects: %d, %.1f MB" % (len(objects), sum([size for key, size in objects]) / 1024.0 / 1024.0))
+
+def snapshot_diff(name1, name2, clean, no_owner, no_acl, pre_load=None, post_load=None, swap=False, ignore_space=False):
+	# second snapshot or local project loaded to test pg
+	manifest1, pr1 = pg_snapshot.load(name1)
+	if name2:
+		manifest2, pr2 = pg_snapshot.load(name2)
+	else:
+		config.check_set_test_db()
+		project = ProjectFs()
+		dump_cur, table_data_cur = load_and_dump(project, clean, no_owner, no_acl, pre_load=pre_load, post_load=post_load)
+		pr2 = pg_parser.parse(io.StringIO(dump_cur))
+		pr2.set_data(table_data_cur)
+		name2 = "local project"
+	if swap:
+		pr1, pr2 = pr2, pr1
+		name1, name2 = name2, name1
+	print("-- %s (-) and %s (+)" % (name1, name2))
+	pr1.diff(pr2, no_owner=no_owner, no_acl=no_acl, ignore_space=ignore_space)
+
+def snapshot_rm(name):
+	removed = pg_snapshot.remove(name)
+	print("removed snapshot %s and %d unused objects" % (name, removed))
+
 def get_roles(addr, cache):
 	try:
 		pg = pg_conn.PG(addr)
@@ -878,6 +1580,14 @@ def get_roles(addr, cache):
 		logging.error("Get roles fail:\n%s" % (e.output))
 		sys.exit(1)
 
+def get_server_version(addr):
+	try:
+		pg = pg_conn.PG(addr)
+		return pg.server_version()
+	except pg_conn.PgError as e:
+		logging.error("Get server version fail:\n%s" % (e.output))
+		sys.exit(1)
+
 def create_roles(roles):
 	try:
 		pg = pg_conn.PG(config.test_db)
@@ -906,21 +1616,92 @@ def print_diff(dump1, dump2, data1, data2, diff_raw, no_owner, no_acl, fromfile,
 		pr2.set_data(data2)
 		pr1.diff(pr2, no_owner=no_owner, no_acl=no_acl, ignore_space=ignore_space)
 
-def diff_pg(addr, git_tag, diff_raw, clean, no_owner, no_acl, pre_load=None, post_load=None, pre_remoted_load=None, post_remoted_load=None, swap=False, pg_extractor=None, cache=False, ignore_space=False):
+def direct_remote(addr, normalize, diff_raw, pre_remoted_load, post_remoted_load, pg_extractor):
+	# dump of server with the same major version as test pg is parsed without restore and dump in test pg
+	if normalize or diff_raw or pre_remoted_load or post_remoted_load or pg_extractor:
+		return False
+	if major_version(get_server_version(addr)) != major_version(get_server_version(config.test_db)):
+		return False
+	# output of pg_dump depends on its own version too, also minor releases add lines
+	remote_dump = pg_conn.PG(addr).dump_version()
+	if not remote_dump or remote_dump != pg_conn.PG(config.test_db).dump_version():
+		return False
+	progress("remote and test pg have the same major version and pg_dump, remote dump is not reloaded")
+	return True
+
+def parse_version(version):
+	# "9.6", "11" or "110005" to server_version_num
+	x = re.match(r"^\s*(?P<major>\d+)(\.(?P<minor>\d+))?\s*$", version)
+	if not x:
+		logging.error("Error: bad PostgreSQL version: %s" % (version,))
+		sys.exit(1)
+	major = int(x.group("major"))
+	minor = int(x.group("minor") or 0)
+	if major >= 10000:
+		return major
+	if major >= 10:
+		return major * 10000 + minor
+	return major * 10000 + minor * 100
+
+def major_version(server_version):
+	if server_version >= 100000:
+		return server_version // 10000
+	return server_version // 100
+
+def remote_and_dump(addr, project, direct, clean, no_owner, no_acl, pre_load=None, post_load=None, pg_extractor=None, cache=False, project_name=None):
+	# pipeline of remote database: dump, restore to test pg and dump again unless direct
+	if direct:
+		if project:
+			return dump_remote_and_data(project, addr, no_owner, no_acl, cache)
+		return dump_remote(addr, no_owner, no_acl, cache), None
+	# roles are read while database is dumped, they have to exist before restore
+	roles = []
+	thread = threading.Thread(target=lambda: roles.append(get_roles(addr, cache)))
+	thread.start()
+	if project:
+		sql_remote, table_data = dump_remote_and_data(project, addr, no_owner, no_acl, cache)
+	else:
+		sql_remote, table_data = dump_remote(addr, no_owner, no_acl, cache), None
+	thread.join()
+	if not roles:
+		sys.exit(1)
+	create_roles(roles[0])
+	return load_dump_and_dump(sql_remote, project, table_data, clean, no_owner, no_acl, pre_load=pre_load, post_load=post_load, dbs="remote", pg_extractor=pg_extractor, project_name=project_name)
+
+def catalog_remote_and_data(project, addr, no_owner, no_acl, cache):
+	pr_remote = catalog_remote(addr, no_owner, no_acl)
+	pr_remote.set_data(dump_remote_data(project, addr, cache))
+	return pr_remote
+
+def diff_pg(addr, git_tag, diff_raw, clean, no_owner, no_acl, pre_load=None, post_load=None, pre_remoted_load=None, post_remoted_load=None, swap=False, pg_extractor=None, cache=False, ignore_space=False, catalog=False, normalize=False):
 	config.check_set_test_db()
+	if catalog and (diff_raw or pg_extractor or pre_remoted_load or post_remoted_load):
+		logging.error("Error: --catalog cannot be used with --diff-raw, --pg_extractor, --pre-remoted-load and --post-remoted-load")
+		sys.exit(1)
 	if git_tag:
 		project = ProjectGit(git_tag)
 	else:
 		project = ProjectFs()
 
-	roles_remote = get_roles(addr, cache)
-	sql_remote = dump_remote(addr, no_owner, no_acl, cache)
-	create_roles(roles_remote)
-	table_data_remote_old = dump_remote_data(project, addr, cache)
-
-	dump_r, table_data_remote_new = load_dump_and_dump(sql_remote, project, table_data_remote_old, clean, no_owner, no_acl, pre_load=pre_remoted_load, post_load=post_remoted_load, dbs="remote", pg_extractor=pg_extractor)
+	if catalog:
+		# remote structure is read from catalogs, no dump is transferred and loaded to test pg
+		(pr_remote, pr_cur) = run_pipelines([
+			("remote", catalog_remote_and_data, (project, addr, no_owner, no_acl, cache), {}),
+			("local", load_and_parse, (project,), dict(clean=clean, no_owner=no_owner, no_acl=no_acl, pre_load=pre_load, post_load=post_load)),
+		])
+		if swap:
+			pr_cur.diff(pr_remote, no_owner=no_owner, no_acl=no_acl, ignore_space=ignore_space)
+		else:
+			pr_remote.diff(pr_cur, no_owner=no_owner, no_acl=no_acl, ignore_space=ignore_space)
+		return
 
-	dump_cur, table_data_cur = load_and_dump(project, clean, no_owner, no_acl, pre_load=pre_load, post_load=post_load, pg_extractor=pg_extractor)
+	direct = direct_remote(addr, normalize, diff_raw, pre_remoted_load, post_remoted_load, pg_extractor)
+	# remote dump and its restore run while the project is loaded
+	((dump_r, table_data_remote_new), (dump_cur, table_data_cur)) = run_pipelines([
+		("remote", remote_and_dump, (addr, project, direct, clean, no_owner, no_acl),
+			dict(pre_load=pre_remoted_load, post_load=post_remoted_load, pg_extractor=pg_extractor, cache=cache)),
+		("local", load_and_dump, (project, clean, no_owner, no_acl), dict(pre_load=pre_load, post_load=post_load, pg_extractor=pg_extractor)),
+	], parallel=not pg_extractor)
 
 	if pg_extractor:
 		pg_extractor.print_diff(swap, ignore_space)
@@ -928,15 +1709,153 @@ def diff_pg(addr, git_tag, diff_raw, clean, no_owner, no_acl, pre_load=None, pos
 	else:
 		print_diff(dump_r, dump_cur, table_data_remote_new, table_data_cur, diff_raw, no_owner, no_acl, fromfile=addr.addr, tofile="local project", swap=swap, ignore_space=ignore_space)
 
-def diff_pg_file(addr, fname, diff_raw, clean, no_owner, no_acl, pre_load=None, post_load=None, pre_remoted_load=None, post_remoted_load=None, swap=False, pg_extractor=None, cache=False, ignore_space=False):
+def load_targets(fname):
+	# PGCONN per line, empty lines and lines starting with # are skipped
+	targets = []
+	with io.open(fname, encoding="utf8") as f:
+		for line in f:
+			line = line.strip()
+			if line and not line.startswith("#"):
+				targets.append(address.Address(line))
+	return targets
+
+def fingerprint_target_worker(targets, project, result):
+	# cheap key of target, None when the target has to be dumped alone
+	while True:
+		try:
+			addr = targets.get_nowait()
+		except Queue.Empty:
+			return
+		pg = pg_conn.PG(addr)
+		identity = pg.database_identity()
+		struct = pg.fingerprint("struct")
+		data = pg.fingerprint("data", project.table_data) if project.table_data else ""
+		if identity and struct and data is not None:
+			result[addr.addr] = (identity, struct, data)
+		else:
+			result[addr.addr] = None
+
+def dump_target_worker(groups, project, no_owner, no_acl, cache, result):
+	# targets of one group have the same fingerprint, the first one which can be dumped is dumped for all
+	while True:
+		try:
+			group = groups.get_nowait()
+		except Queue.Empty:
+			return
+		for i, addr in enumerate(group):
+			pg = pg_conn.PG(addr)
+			try:
+				progress("dump remote %s" % (addr.addr,))
+				server_version = pg.server_version()
+				pg.export_snapshot()
+				dump = pg.dump(no_owner, no_acl, cache=cache)
+				table_data = pg.dump_data(project, cache=cache)
+			except pg_conn.PgError as e:
+				result[addr.addr] = (None, None, None, e.output)
+				continue
+			finally:
+				pg.release_snapshot()
+			for member in group[i:]:
+				result[member.addr] = (server_version, dump, table_data, None)
+			break
+
+def run_workers(jobs, count, function, args):
+	workers = []
+	for i in xrange(max(1, min(jobs, count))):
+		worker = threading.Thread(target=function, args=args)
+		worker.start()
+		workers.append(worker)
+	for worker in workers:
+		worker.join()
+
+def dump_hash(dump, table_data):
+	# the same structure and data give the same hash, comments of pg_dump contain versions
+	h = hashlib.sha1()
+	for line in dump.splitlines():
+		if line.strip() and not line.startswith("--"):
+			h.update(line.encode("utf8") + b"\n")
+	h.update(json.dumps(table_data, sort_keys=True))
+	return h.hexdigest()
+
+def diff_pg_targets(addrs, git_tag, diff_raw, clean, no_owner, no_acl, pre_load=None, post_load=None, pre_remoted_load=None, post_remoted_load=None, swap=False, cache=False, ignore_space=False, normalize=False, jobs=4):
+	# databases with the same structure and data are one variant, each variant is compared once
 	config.check_set_test_db()
+	if git_tag:
+		project = ProjectGit(git_tag)
+	else:
+		project = ProjectFs()
 
-	roles_remote = get_roles(addr, cache)
-	sql_remote = dump_remote(addr, no_owner, no_acl, cache)
-	create_roles(roles_remote)
-	dump_r, x = load_dump_and_dump(sql_remote, None, None, clean, no_owner, no_acl, pre_load=pre_remoted_load, post_load=post_remoted_load, dbs="remote", pg_extractor=pg_extractor, project_name="project")
+	# the same database behind more addresses is dumped once
+	targets = Queue.Queue()
+	for addr in addrs:
+		targets.put(addr)
+	fingerprints = {}
+	run_workers(jobs, len(addrs), fingerprint_target_worker, (targets, project, fingerprints))
+	groups = Queue.Queue()
+	by_fingerprint = {}
+	for addr in addrs:
+		key = fingerprints[addr.addr]
+		if key is None:
+			groups.put([addr])
+		elif key in by_fingerprint:
+			by_fingerprint[key].append(addr)
+		else:
+			by_fingerprint[key] = [addr]
+			groups.put(by_fingerprint[key])
+	result = {}
+	run_workers(jobs, groups.qsize(), dump_target_worker, (groups, project, no_owner, no_acl, cache, result))
+
+	variants = []
+	by_hash = {}
+	failed = []
+	for addr in addrs:
+		(server_version, dump, table_data, error) = result[addr.addr]
+		if error is not None:
+			logging.error("Dump %s fail:\n%s" % (addr.addr, error))
+			failed.append(addr)
+			continue
+		key = dump_hash(dump, table_data)
+		if key not in by_hash:
+			by_hash[key] = (addr, server_version, dump, table_data, [])
+			variants.append(by_hash[key])
+		by_hash[key][4].append(addr)
+	variants.sort(key=lambda variant: len(variant[4]), reverse=True)
+
+	dump_cur, table_data_cur = load_and_dump(project, clean, no_owner, no_acl, pre_load=pre_load, post_load=post_load)
+	test_version = major_version(get_server_version(config.test_db))
+	test_dump_version = pg_conn.PG(config.test_db).dump_version()
+
+	for i, (addr, server_version, dump, table_data, members) in enumerate(variants):
+		print("-- variant %d of %d: %d databases" % (i + 1, len(variants), len(members)))
+		for member in members:
+			print("--   %s" % (member.addr,))
+		direct = major_version(server_version) == test_version and test_dump_version and pg_conn.PG(addr).dump_version() == test_dump_version
+		if normalize or diff_raw or pre_remoted_load or post_remoted_load or not direct:
+			try:
+				create_roles(get_roles(addr, cache))
+				dump, table_data = load_dump_and_dump(dump, project, table_data, clean, no_owner, no_acl, pre_load=pre_remoted_load, post_load=post_remoted_load, dbs="remote")
+			except SystemExit:
+				# error is logged, the other variants are compared
+				failed += members
+				print()
+				continue
+		print_diff(dump, dump_cur, table_data, table_data_cur, diff_raw, no_owner, no_acl, fromfile=addr.addr, tofile="local project", swap=swap, ignore_space=ignore_space)
+		print()
+
+	if failed:
+		print("-- failed: %d databases" % (len(failed),))
+		for addr in failed:
+			print("--   %s" % (addr.addr,))
+
+def diff_pg_file(addr, fname, diff_raw, clean, no_owner, no_acl, pre_load=None, post_load=None, pre_remoted_load=None, post_remoted_load=None, swap=False, pg_extractor=None, cache=False, ignore_space=False, normalize=False):
+	config.check_set_test_db()
 
-	dump_file = load_file_and_dump(fname, "project", clean, no_owner, no_acl, pre_load=pre_load, post_load=post_load, dbs="file", pg_extractor=pg_extractor)
+	direct = direct_remote(addr, normalize, diff_raw, pre_remoted_load, post_remoted_load, pg_extractor)
+	((dump_r, x), dump_file) = run_pipelines([
+		("remote", remote_and_dump, (addr, None, direct, clean, no_owner, no_acl),
+			dict(pre_load=pre_remoted_load, post_load=post_remoted_load, pg_extractor=pg_extractor, cache=cache, project_name="project")),
+		("file", load_file_and_dump, (fname, "project", clean, no_owner, no_acl), dict(pre_load=pre_load, post_load=post_load, dbs="file", pg_extractor=pg_extractor)),
+	], parallel=not pg_extractor)
 
 	if pg_extractor:
 		pg_extractor.print_diff(swap, ignore_space)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import re
+import os
+import io
+import sys
+import gzip
+import json
+import time
+import types
+import hashlib
+import logging
+import tempfile
+
+import config
+import pg_types
+import utils
+
+# dictionaries of pg_types.Project stored in snapshot
+ELEMENTS = ("schemas", "extentions", "types", "tables", "sequences", "views", "operators", "functions")
+
+def get_dir():
+	directory = config.get("snapshot_dir") or os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.join(os.environ["HOME"], ".local", "share"), "pgdist", "snapshots")
+	for d in (directory, os.path.join(directory, "objects")):
+		if not os.path.isdir(d):
+			os.makedirs(d, 0o700)
+	return directory
+
+def object_file(key):
+	return os.path.join(get_dir(), "objects", key[:2], key[2:] + ".gz")
+
+def manifest_file(name):
+	return os.path.join(get_dir(), name + ".json")
+
+def put_object(value):
+	# value is stored once for all snapshots, key is hash of its JSON
+	data = json.dumps(value, sort_keys=True).encode("utf8")
+	key = hashlib.sha1(data).hexdigest()
+	fname = object_file(key)
+	if not os.path.isfile(fname):
+		if not os.path.isdir(os.path.dirname(fname)):
+			os.makedirs(os.path.dirname(fname))
+		(fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(fname), prefix=".tmp-")
+		os.close(fd)
+		f = gzip.open(tmp, "wb")
+		try:
+			f.write(data)
+		finally:
+			f.close()
+		os.rename(tmp, fname)
+	return key
+
+def get_object(key):
+	f = gzip.open(object_file(key), "rb")
+	try:
+		return json.loads(unicode(f.read(), "utf8"))
+	finally:
+		f.close()
+
+def dump_element(element):
+	value = dict(element.__dict__)
+	value["class"] = element.__class__.__name__
+	return value
+
+def load_element(value):
+	value = dict(value)
+	cls = getattr(pg_types, value.pop("class"))
+	# attributes are restored without constructor
+	return types.InstanceType(cls, value)
+
+def check_name(name):
+	if not re.match(r"^[\w.-]+$", name):
+		logging.error("Error: snapshot name can contain only letters, digits, '_', '.' and '-': %s" % (name,))
+		sys.exit(1)
+
+def save(name, addr, project, table_data, no_owner, no_acl):
+	if not name:
+		name = "%s-%s" % (re.sub(r"[^\w.-]+", "-", addr.addr).strip("-"), time.strftime("%Y%m%d-%H%M%S"))
+	check_name(name)
+	directory = get_dir()
+	with utils.Lock(directory, exclusive=True):
+		if os.path.isfile(manifest_file(name)):
+			logging.error("Error: snapshot %s exists" % (name,))
+			sys.exit(1)
+		manifest = {
+			"name": name,
+			"addr": addr.addr,
+			"created": time.time(),
+			"no_owner": no_owner,
+			"no_acl": no_acl,
+			"elements": {},
+			"others": [put_object(dump_element(other)) for other in project.others],
+			"data": {},
+		}
+		for elements_name in ELEMENTS:
+			elements = getattr(project, elements_name)
+			manifest["elements"][elements_name] = dict([(key, put_object(dump_element(elements[key]))) for key in elements])
+		for table in table_data or {}:
+			manifest["data"][table] = put_object(table_data[table])
+		(fd, tmp) = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+		with os.fdopen(fd, "w") as f:
+			json.dump(manifest, f, sort_keys=True)
+		os.rename(tmp, manifest_file(name))
+	return name
+
+def load(name):
+	# manifest and pg_types.Project of snapshot
+	check_name(name)
+	with utils.Lock(get_dir()):
+		if not os.path.isfile(manifest_file(name)):
+			logging.error("Error: snapshot %s not exists" % (name,))
+			sys.exit(1)
+		with io.open(manifest_file(name), encoding="utf8") as f:
+			manifest = json.load(f)
+		project = pg_types.Project()
+		for elements_name in ELEMENTS:
+			elements = getattr(project, elements_name)
+			for key, h in manifest["elements"][elements_name].items():
+				elements[key] = load_element(get_object(h))
+		project.others = [load_element(get_object(h)) for h in manifest["others"]]
+		project.set_data(dict([(table, get_object(h)) for table, h in manifest["data"].items()]))
+	return manifest, project
+
+def manifests():
+	directory = get_dir()
+	r = []
+	for name in os.listdir(directory):
+		if name.endswith(".json"):
+			with io.open(os.path.join(directory, name), encoding="utf8") as f:
+				r.append(json.load(f))
+	r.sort(key=lambda manifest: manifest["created"])
+	return r
+
+def object_keys(manifest):
+	keys = set(manifest["others"]) | set(manifest["data"].values())
+	for elements in manifest["elements"].values():
+		keys |= set(elements.values())
+	return keys
+
+def objects():
+	# (key, size) of all stored objects
+	r = []
+	objects_dir = os.path.join(get_dir(), "objects")
+	for prefix in os.listdir(objects_dir):
+		for name in os.listdir(os.path.join(objects_dir, prefix)):
+			if name.endswith(".gz"):
+				r.append((prefix + name[:-3], os.path.getsize(os.path.join(objects_dir, prefix, name))))
+	return r
+
+def remove(name):
+	# snapshot and objects not used by other snapshots
+	check_name(name)
+	with utils.Lock(get_dir(), exclusive=True):
+		if not os.path.isfile(manifest_file(name)):
+			logging.error("Error: snapshot %s not exists" % (name,))
+			sys.exit(1)
+		os.remove(manifest_file(name))
+		used = set()
+		for manifest in manifests():
+			used |= object_keys(manifest)
+		removed = 0
+		for key, size in objects():
+			if key not in used:
+				os.remove(object_file(key))
+				removed += 1
+	return removed
@@ -3,7 +3,9 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 import re
+import io
 import sys
+import csv
 import difflib
 
 import color
@@ -11,6 +13,10 @@ import utils
 import config
 import table_print
 
+# changes of table data bigger than this are loaded by COPY into temporary table
+DATA_COPY_THRESHOLD = 100
+NULL_MARKER = "NULL@15#7&679"
+
 def rmln(s):
 	if s and s.endswith("\r\n"):
 		return s[:-2]
@@ -282,16 +288,17 @@ class Project:
 				elements1[name].diff(elements2[name], no_owner, no_acl, ignore_space)
 		return difference
 
-	def gen_update(self, file, project2):
+	def gen_update(self, file, project2, server_version=None, file_nt=None):
 		self.update_elements(file, "schemas", self.schemas, project2.schemas)
 		self.update_elements(file, "extentions", self.extentions, project2.extentions)
-		self.update_elements(file, "types", self.types, project2.types)
+		self.update_types(file, project2, server_version, file_nt)
 		self.update_elements(file, "tables", self.tables, project2.tables)
 		self.update_elements(file, "sequences", self.sequences, project2.sequences)
 		self.update_elements(file, "views", self.views, project2.views)
 		self.update_elements(file, "operators", self.operators, project2.operators)
 		self.update_elements(file, "functions", self.functions, project2.functions)
 		self.update_others(file, project2.others)
+		self.update_data(file, project2)
 
 	def update_others(self, file, others2):
 		others_c1 = [other.get_whole_command() for other in self.others]
@@ -305,6 +312,73 @@ class Project:
 			if other.get_whole_command() not in others_c1:
 				file.write(utils.get_command(other.get_whole_command(), "unknown", "Other"))
 
+	def update_types(self, file, project2, server_version=None, file_nt=None):
+		types1 = {}
+		for name in self.types:
+			if name in project2.types and isinstance(self.types[name], Enum) and isinstance(project2.types[name], Enum):
+				self.types[name].update_enum(file, project2.types[name], project2, server_version, file_nt)
+			else:
+				types1[name] = self.types[name]
+		types2 = dict([(name, project2.types[name]) for name in project2.types if name not in self.types or name in types1])
+		self.update_elements(file, "types", types1, types2)
+
+	def update_data(self, file, project2):
+		for n, table in enumerate(sorted(project2.table_data.keys())):
+			d2 = project2.table_data[table]
+			table_name = qualified_name(table)
+			if table in self.table_data:
+				d1 = self.table_data[table]
+			elif table_name not in self.tables:
+				# new table, insert all rows
+				d1 = [d2[0]]
+			else:
+				continue
+			if sorted(d1[0]) != sorted(d2[0]):
+				file.write("\n-- TODO: data of table %s have different columns, update data manually\n\n" % (table,))
+				continue
+			if d1[0] != d2[0]:
+				m = map(lambda x: d1[0].index(x), d2[0])
+				d1 = [[row[i] for i in m] for row in d1]
+
+			columns = d2[0]
+			key = None
+			if table_name in project2.tables:
+				key = project2.tables[table_name].primary_key()
+			if key and not set(key) <= set(columns):
+				key = None
+			if key:
+				key_index = [columns.index(k) for k in key]
+			else:
+				key_index = range(len(columns))
+
+			rows1 = {}
+			for row in d1[1:]:
+				rows1.setdefault(tuple(row[i] for i in key_index), []).append(row)
+			deleted = []
+			inserted = []
+			updated = []
+			for row in d2[1:]:
+				k = tuple(row[i] for i in key_index)
+				if rows1.get(k):
+					row1 = rows1[k].pop()
+					if row1 != row:
+						updated.append(row)
+				else:
+					inserted.append(row)
+			for rows in rows1.values():
+				deleted += rows
+
+			if not deleted and not inserted and not updated:
+				continue
+			command = io.StringIO()
+			command.write("-- deleted: %d, inserted: %d, updated: %d\n" % (len(deleted), len(inserted), len(updated)))
+			# rows of table without key are not unique, they are deleted one by one
+			if key and len(deleted) + len(inserted) + len(updated) > DATA_COPY_THRESHOLD:
+				data_copy(command, table, columns, key, key_index, deleted, inserted, updated, "pgdist_data_%d" % (n+1,))
+			else:
+				data_statements(command, table, columns, key, key_index, deleted, inserted, updated)
+			file.write(utils.get_command(command.getvalue(), table, "Table data"))
+
 	def update_elements(self, file, elements_name, elements1, elements2):
 		for name in elements1:
 			if name not in elements2:
@@ -340,6 +414,70 @@ class Project:
 		for table in self.tables:
 			self.tables[table].check_owner()
 
+def qualified_name(name):
+	if "." in name:
+		return name
+	return "public." + name
+
+def quote_ident(name):
+	if re.match(r"^[a-z_][a-z0-9_]*$", name):
+		return name
+	return '"%s"' % (name.replace('"', '""'),)
+
+def unquote_ident(name):
+	if name.startswith('"') and name.endswith('"'):
+		return name[1:-1].replace('""', '"')
+	return name
+
+def quote_literal(value):
+	if value is None:
+		return "NULL"
+	return "'%s'" % (value.replace("'", "''"),)
+
+def data_condition(columns, key, row):
+	if key:
+		return " AND ".join(["%s = %s" % (quote_ident(k), quote_literal(row[columns.index(k)])) for k in key])
+	return " AND ".join(["%s IS NOT DISTINCT FROM %s" % (quote_ident(c), quote_literal(row[i])) for i, c in enumerate(columns)])
+
+def data_statements(file, table, columns, key, key_index, deleted, inserted, updated):
+	for row in deleted:
+		if key:
+			file.write("DELETE FROM %s WHERE %s;\n" % (table, data_condition(columns, key, row)))
+		else:
+			file.write("DELETE FROM %s WHERE ctid = (SELECT ctid FROM %s WHERE %s LIMIT 1);\n" % (table, table, data_condition(columns, key, row)))
+	for row in updated:
+		sets = ["%s = %s" % (quote_ident(c), quote_literal(row[i])) for i, c in enumerate(columns) if i not in key_index]
+		file.write("UPDATE %s SET %s WHERE %s;\n" % (table, ", ".join(sets), data_condition(columns, key, row)))
+	if inserted:
+		file.write("INSERT INTO %s (%s) VALUES\n" % (table, ", ".join(map(quote_ident, columns))))
+		file.write(",\n".join(["\t(%s)" % (", ".join(map(quote_literal, row)),) for row in inserted]))
+		file.write(";\n")
+
+def data_copy(file, table, columns, key, key_index, deleted, inserted, updated, tmp_table):
+	# changed rows of table with key are loaded by one COPY and applied by set based commands
+	columns_q = ", ".join(map(quote_ident, columns))
+	file.write("CREATE TEMP TABLE %s AS SELECT NULL::text AS pgdist_op, %s FROM %s WITH NO DATA;\n" % (tmp_table, columns_q, table))
+	file.write("COPY %s (pgdist_op, %s) FROM STDIN WITH (FORMAT CSV, NULL '%s');\n" % (tmp_table, columns_q, NULL_MARKER))
+	csv_data = io.BytesIO()
+	writer = csv.writer(csv_data, lineterminator=b"\n")
+	for (op, rows) in (("D", deleted), ("U", updated), ("I", inserted)):
+		for row in rows:
+			writer.writerow([op] + [NULL_MARKER.encode("utf8") if v is None else v.encode("utf8") for v in row])
+	file.write(unicode(csv_data.getvalue(), "utf8"))
+	file.write("\\.\n")
+	file.write("\n")
+	join = " AND ".join(["t.%s = d.%s" % (quote_ident(k), quote_ident(k)) for k in key])
+	if deleted:
+		file.write("DELETE FROM %s t USING %s d WHERE d.pgdist_op = 'D' AND %s;\n" % (table, tmp_table, join))
+	if inserted or updated:
+		sets = ["%s = EXCLUDED.%s" % (quote_ident(c), quote_ident(c)) for i, c in enumerate(columns) if i not in key_index]
+		if sets:
+			conflict = "DO UPDATE SET %s" % (", ".join(sets),)
+		else:
+			conflict = "DO NOTHING"
+		file.write("INSERT INTO %s (%s) SELECT %s FROM %s WHERE pgdist_op IN ('I', 'U')\n\tON CONFLICT (%s) %s;\n" % (table, columns_q, columns_q, tmp_table, ", ".join(map(quote_ident, key)), conflict))
+	file.write("DROP TABLE %s;\n" % (tmp_table,))
+
 class Schema(Element):
 	def __init__(self, command, name):
 		Element.__init__(self, "Schema", command, name)
@@ -358,6 +496,74 @@ class Enum(Element):
 		Element.__init__(self, "Enum", command, name)
 		self.labels = labels
 
+	def dependent_columns(self, project):
+		# columns of tables using enum, they have to be rewritten by recreate
+		type_names = (self.name, self.name.split(".")[-1])
+		columns = []
+		for table_name in sorted(project.tables):
+			for column in project.tables[table_name].columns:
+				x = re.match(r'(?P<column>"[^"]+"|\S+)\s+(?P<type>[^\s\[]+)(?P<array>(\[\])*)', column)
+				if x and x.group("type") in type_names:
+					columns.append((table_name, x.group("column"), x.group("array")))
+		return columns
+
+	def update_enum(self, file, enum2, project2, server_version=None, file_nt=None):
+		change_labels = self.labels != enum2.labels
+		change_owner = self.owner != enum2.owner
+
+		if not change_labels and not change_owner:
+			return
+
+		command = ""
+		added = [label for label in enum2.labels if label not in self.labels]
+		if change_labels and [label for label in enum2.labels if label in self.labels] == self.labels:
+			# only new labels, ALTER TYPE ... ADD VALUE keeps tables untouched
+			for label in added:
+				i = enum2.labels.index(label)
+				if i > 0:
+					command += "ALTER TYPE %s ADD VALUE IF NOT EXISTS %s AFTER %s;\n" % (enum2.name, label, enum2.labels[i-1])
+				elif self.labels:
+					command += "ALTER TYPE %s ADD VALUE IF NOT EXISTS %s BEFORE %s;\n" % (enum2.name, label, self.labels[0])
+				else:
+					command += "ALTER TYPE %s ADD VALUE IF NOT EXISTS %s;\n" % (enum2.name, label)
+			# before PostgreSQL 12 ADD VALUE cannot run inside a transaction block,
+			# unknown version of target server is taken as the old one
+			if not server_version or server_version < 120000:
+				if file_nt is not None:
+					file_nt.write(utils.get_command(command, enum2.name, enum2.element_name))
+					command = ""
+				else:
+					command = "-- TODO: run outside of transaction block (not single_transaction part)\n" + command
+		elif change_labels:
+			removed = [label for label in self.labels if label not in enum2.labels]
+			columns = self.dependent_columns(project2)
+			old_name = "%s__old" % (enum2.name.split(".")[-1],)
+			command += "-- TODO: labels of %s were removed or reordered, type has to be recreated\n" % (enum2.name,)
+			if removed:
+				command += "-- removed labels: %s, they must not be used in data\n" % (", ".join(removed),)
+			if columns:
+				command += "-- dependent tables, they will be rewritten:\n"
+				for (table_name, column, array) in columns:
+					command += "--\t%s (%s)\n" % (table_name, column)
+			else:
+				command += "-- no dependent tables\n"
+			command += "-- column defaults using type have to be dropped before and set after recreate\n"
+			command += "\n"
+			command += "ALTER TYPE %s RENAME TO %s;\n" % (enum2.name, old_name)
+			command += enum2.command.strip() + "\n"
+			for (table_name, column, array) in columns:
+				command += "ALTER TABLE %s ALTER COLUMN %s TYPE %s%s USING %s::text%s::%s%s;\n" % (table_name, column, enum2.name, array, column, array, enum2.name, array)
+			if "." in enum2.name:
+				command += "DROP TYPE %s.%s;\n" % (enum2.name.split(".")[0], old_name)
+			else:
+				command += "DROP TYPE %s;\n" % (old_name,)
+
+		if change_owner and enum2.owner:
+			command += "ALTER TYPE %s OWNER TO %s;\n" % (enum2.name, enum2.owner)
+
+		if command:
+			file.write(utils.get_command(command, enum2.name, enum2.element_name))
+
 class Type(Element):
 	def __init__(self, command, name, attributes):
 		Element.__init__(self, "Type", command, name)
@@ -418,7 +624,7 @@ class Table(Element):
 			print(utils.diff(self.columns_conf, table2.columns_conf, "\t", True))
 
 	def update_element(self, file, table2):
-		if self.command == table2.command and self.owner == table2.owner:
+		if self.command == table2.command and self.owner == table2.owner and sorted(self.indexes) == sorted(table2.indexes):
 			return
 
 		file.write("--\n")
@@ -443,11 +649,6 @@ class Table(Element):
 		if self.defaults != table2.defaults:
 			file.write(utils.diff(self.defaults, table2.defaults))
 
-		self.indexes.sort()
-		table2.indexes.sort()
-		if self.indexes != table2.indexes:
-			file.write(utils.diff(self.indexes, table2.indexes))
-
 		self.triggers.sort()
 		table2.triggers.sort()
 		if self.triggers != table2.triggers:
@@ -456,8 +657,36 @@ class Table(Element):
 		if self.owner != table2.owner and table2.owner:
 			file.write("ALTER TABLE %s OWNER TO %s;\n" % (table2.name, table2.owner))
 
+		# indexes are built without blocking writes into table, out of transaction block
+		table_schema = table2.name.split(".")[0]
+		unknown = []
+		for index in sorted(self.indexes):
+			if index not in table2.indexes:
+				x = re.match(r"(UNIQUE\s+)?INDEX\s+(?P<name>\S+)\s+ON\s", index)
+				if x:
+					file.write("DROP INDEX CONCURRENTLY IF EXISTS %s.%s;\n" % (table_schema, x.group("name")))
+				else:
+					unknown.append(index)
+		for index in sorted(table2.indexes):
+			if index not in self.indexes:
+				if re.match(r"(UNIQUE\s+)?INDEX\s", index):
+					file.write("CREATE %s;\n" % (re.sub(r"INDEX\s+", "INDEX CONCURRENTLY ", index, 1),))
+				else:
+					unknown.append(index)
+		if unknown:
+			# index not parsed, left to be written by hand
+			file.write(utils.diff(sorted([i for i in unknown if i in self.indexes]), sorted([i for i in unknown if i in table2.indexes])))
+
 		file.write("-- end %s: %s\n\n" % (table2.element_name.lower(), table2.name))
 
+	def primary_key(self):
+		for constraint in self.constraints:
+			x = re.match(r"CONSTRAINT \S+ PRIMARY KEY \((?P<columns>[^)]+)\)", constraint)
+			if x:
+				# names of columns as in table data, quoted by quote_ident
+				return [unquote_ident(c.strip()) for c in x.group("columns").split(",")]
+		return None
+
 	def get_whole_command(self):
 		whole_command = self.command
 		if self.constraints:
@@ -2,10 +2,27 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import os
+import fcntl
 import difflib
 
 import color
 
+class Lock:
+	# flock of file lock in directory, shared for reading, exclusive for changes
+	def __init__(self, directory, exclusive=False):
+		self.directory = directory
+		self.exclusive = exclusive
+
+	def __enter__(self):
+		self.f = open(os.path.join(self.directory, "lock"), "a")
+		fcntl.flock(self.f, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		fcntl.flock(self.f, fcntl.LOCK_UN)
+		self.f.close()
+
 def get_header(project_name, header_type, part=None, roles=None, requires=None, version=None, old_version=None, new_version=None, dbparam=None, tables_data=None):
 	project_config = header_type == "project-config"
 	header = "--\n"
@@ -58,6 +75,10 @@ def get_part_header(parts, header_type):
 				part_string += "-- single_transaction\n"
 			else:
 				part_string += "-- not single_transaction\n"
+			if part.backfill:
+				part_string += "-- backfill: %s\n" % (part.backfill)
+			if part.squashed:
+				part_string += "-- squashed: %s\n" % (" ".join(part.squashed))
 			part_string += "--\n"
 			part_string += "-- end header_data\n"
 			part_string += "--\n"
@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 import os
+import re
 import sys
 import config
 import logging
@@ -17,7 +18,7 @@ import pg_project
 
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 
-PGDIST_VERSION = 1
+PGDIST_VERSION = 2
 
 CREATE_PGDIST = """
 CREATE SCHEMA IF NOT EXISTS pgdist;
@@ -42,12 +43,33 @@ CREATE TABLE pgdist.history (
 	comment TEXT
 );
 
+CREATE TABLE pgdist.backfill (
+	project TEXT NOT NULL,
+	version TEXT NOT NULL,
+	part INTEGER NOT NULL,
+	last_key TEXT,
+	done BOOLEAN NOT NULL DEFAULT FALSE,
+	ts TIMESTAMPTZ DEFAULT NOW(),
+	PRIMARY KEY (project, version, part)
+);
+
 INSERT INTO pgdist.pgdist_version VALUES (%d);
 INSERT INTO pgdist.history (project, version, part, comment) VALUES ('pgdist', %d, 1, 'Create PGdist info schema.');
 
 """ % (PGDIST_VERSION, PGDIST_VERSION)
 
 PGDIST_UPDATES = [
+"""
+CREATE TABLE pgdist.backfill (
+	project TEXT NOT NULL,
+	version TEXT NOT NULL,
+	part INTEGER NOT NULL,
+	last_key TEXT,
+	done BOOLEAN NOT NULL DEFAULT FALSE,
+	ts TIMESTAMPTZ DEFAULT NOW(),
+	PRIMARY KEY (project, version, part)
+);
+""",
 ]
 
 class PgError(Exception):
@@ -341,7 +363,101 @@ def install(dbname, project, ver, conninfo, directory, create_db, is_require):
 				(project.name, str(ver.version), part.part, len(ver.parts)))
 
 
-def update(dbname, project, update, conninfo, directory):
+def split_where(command):
+	# split UPDATE command to part before top level WHERE and condition
+	depth = 0
+	quote = None
+	escapes = False
+	i = 0
+	while i < len(command):
+		c = command[i]
+		if quote:
+			if c == "\\" and escapes:
+				i += 1
+			elif c == quote and command[i+1:i+2] == quote:
+				# doubled quote inside string or quoted identifier
+				i += 1
+			elif c == quote:
+				quote = None
+		elif c in ("'", '"'):
+			quote = c
+			# backslash escapes quote only in E'...' string
+			escapes = c == "'" and command[i-1:i] in ("E", "e") and not re.match(r"\w", command[i-2:i-1])
+		elif c == "(":
+			depth += 1
+		elif c == ")":
+			depth -= 1
+		elif depth == 0 and command[i:i+5].upper() == "WHERE" and (i == 0 or not command[i-1].isalnum()) and not command[i+5:i+6].isalnum():
+			return command[:i].strip(), command[i+5:].strip()
+		i += 1
+	return command.strip(), None
+
+def backfill(conn, project_name, version, part, directory):
+	(table, key, batch_size) = part.backfill
+	(command, condition) = split_where(part.get_command(directory).rstrip(";"))
+	cursor = conn.cursor()
+	cursor.execute("SELECT last_key, done FROM pgdist.backfill WHERE project=%s AND version=%s AND part=%s;", (project_name, version, part.part))
+	row = cursor.fetchone()
+	if row and row["done"]:
+		logging.verbose("backfill %s already done" % (table,))
+		return
+	last_key = None
+	if row:
+		last_key = row["last_key"]
+		logging.info("resume backfill %s from %s > %s" % (table, key, last_key))
+	else:
+		cursor.execute("INSERT INTO pgdist.backfill (project, version, part) VALUES (%s, %s, %s);", (project_name, version, part.part))
+
+	rows = 0
+	while True:
+		if last_key is None:
+			cursor.execute("SELECT %s FROM %s ORDER BY %s LIMIT 1 OFFSET %%s;" % (key, table, key), (batch_size - 1,))
+		else:
+			cursor.execute("SELECT %s FROM %s WHERE %s > %%s ORDER BY %s LIMIT 1 OFFSET %%s;" % (key, table, key, key), (last_key, batch_size - 1))
+		row = cursor.fetchone()
+		if not row:
+			cursor.execute("SELECT max(%s) FROM %s;" % (key, table))
+			row = cursor.fetchone()
+		upper_key = row[0]
+
+		where = []
+		params = []
+		if condition:
+			where.append("(%s)" % (condition,))
+		if last_key is not None:
+			where.append("%s > %%s" % (key,))
+			params.append(last_key)
+		if upper_key is not None:
+			where.append("%s <= %%s" % (key,))
+			params.append(upper_key)
+		if params:
+			batch_command = "%s WHERE %s;" % (command.replace("%", "%%"), " AND ".join(where))
+		elif where:
+			batch_command = "%s WHERE %s;" % (command, " AND ".join(where))
+			params = None
+		else:
+			batch_command = "%s;" % (command,)
+			params = None
+
+		# every batch is committed with its progress, so backfill can be resumed
+		cursor.execute("BEGIN;")
+		cursor.execute(batch_command, params)
+		rows += cursor.rowcount
+		done = upper_key is None
+		if not done:
+			cursor.execute("SELECT 1 FROM %s WHERE %s > %%s LIMIT 1;" % (table, key), (upper_key,))
+			done = not cursor.fetchone()
+		if upper_key is not None:
+			last_key = "%s" % (upper_key,)
+		cursor.execute("UPDATE pgdist.backfill SET last_key=%s, done=%s, ts=NOW() WHERE project=%s AND version=%s AND part=%s;",
+			(last_key, done, project_name, version, part.part))
+		cursor.execute("COMMIT;")
+		logging.verbose("backfill %s: %d rows updated, %s <= %s" % (table, rows, key, last_key))
+		if done:
+			break
+	print("Backfill %s: %d rows updated" % (table, rows))
+
+def update(dbname, project, update, conninfo, directory, start_part=1):
 	conn = connect(conninfo, dbname)
 	cursor = conn.cursor()
 	if not check_pgdist_installed(conn):
@@ -357,11 +473,21 @@ def update(dbname, project, update, conninfo, directory):
 		for role in part.roles:
 			create_role(conn, role, project.name, update.version_new, part.part)
 	for part in update.parts:
+		if part.part < start_part:
+			continue
 		if len(update.parts) == 1:
 			print("Update %s in %s %s > %s" % (project.name, dbname, str(update.version_old), str(update.version_new)))
 		else:
 			print("Update %s in %s %s > %s part %d/%d" % (project.name, dbname, str(update.version_old), str(update.version_new), part.part, len(update.parts)))
-		run("psql", conninfo, dbname=dbname, file=os.path.join(directory, part.fname), single_transaction=part.single_transaction)
+		if part.backfill:
+			backfill(conn, project.name, str(update.version_new), part, directory)
+		else:
+			run("psql", conninfo, dbname=dbname, file=os.path.join(directory, part.fname), single_transaction=part.single_transaction)
+		if part.squashed:
+			# prebuilt squashed update, log every step of the chain
+			for version_old, version_new in zip(part.squashed[:-1], part.squashed[1:]):
+				cursor.execute("INSERT INTO pgdist.history (project, version, part, comment) VALUES (%s, %s, %s, %s);",
+					(project.name, version_new, 1, "updated from version %s to %s, squashed" % (version_old, version_new)))
 		cursor.execute("INSERT INTO pgdist.history (project, version, part, comment) VALUES (%s, %s, %s, %s);",
 			(project.name, str(update.version_new), part.part, "updated from version %s to %s, part %d/%d" % (str(update.version_old), str(update.version_new), part.part, len(update.parts))))
 		cursor.execute("UPDATE pgdist.installed SET version=%s, from_version=%s,  part=%s, parts=%s WHERE project=%s RETURNING *;",
@@ -371,6 +497,49 @@ def update(dbname, project, update, conninfo, directory):
 				(project.name, str(update.version), part.part, len(update.parts)))
 	conn.close()
 
+def update_squash(dbname, project, updates, conninfo, directory):
+	# whole chain of updates in one psql session and one transaction
+	conn = connect(conninfo, dbname)
+	cursor = conn.cursor()
+	if not check_pgdist_installed(conn):
+		conn.close()
+		return
+	pgdist_install(dbname, conn)
+	parts = [(update, part) for update in updates for part in update.parts]
+	requires = []
+	for update, part in parts:
+		for require in part.requires:
+			if require not in requires:
+				requires.append(require)
+	for require in requires:
+		cursor.execute("SELECT 1 FROM pgdist.installed WHERE project=%s", (require,))
+		if not cursor.fetchall():
+			pg_project.install(require, dbname, None, conninfo, directory, False, True)
+	# every role is checked once, the last update defines it
+	roles = {}
+	for update, part in parts:
+		for role in part.roles:
+			roles[role.name] = (role, update, part)
+	for name in sorted(roles):
+		(role, update, part) = roles[name]
+		create_role(conn, role, project.name, update.version_new, part.part)
+
+	print("Update %s in %s %s > %s squashed %d updates" % (project.name, dbname, str(updates[0].version_old), str(updates[-1].version_new), len(updates)))
+	script = ["BEGIN;"]
+	for update, part in parts:
+		logging.verbose("squash %s part %d/%d" % (update, part.part, len(update.parts)))
+		script.append("\\i '%s'" % (os.path.abspath(os.path.join(directory, part.fname)).replace("'", "''"),))
+		script.append(cursor.mogrify("INSERT INTO pgdist.history (project, version, part, comment) VALUES (%s, %s, %s, %s);",
+			(project.name, str(update.version_new), part.part, "updated from version %s to %s, part %d/%d, squashed" % (str(update.version_old), str(update.version_new), part.part, len(update.parts)))).decode("utf8"))
+	(update, part) = parts[-1]
+	script.append(cursor.mogrify("UPDATE pgdist.installed SET version=%s, from_version=%s, part=%s, parts=%s WHERE project=%s;",
+		(str(update.version_new), str(update.version_old), part.part, len(update.parts), project.name)).decode("utf8"))
+	script.append(cursor.mogrify("INSERT INTO pgdist.installed (project, version, from_version, part, parts) SELECT %s, %s, %s, %s, %s WHERE NOT EXISTS (SELECT 1 FROM pgdist.installed WHERE project=%s);",
+		(project.name, str(update.version_new), str(update.version_old), part.part, len(update.parts), project.name)).decode("utf8"))
+	script.append("COMMIT;")
+	run("psql", conninfo, cmd="\n".join(script).encode("utf8"), dbname=dbname, single_transaction=False)
+	conn.close()
+
 def clean(project_name, dbname, conninfo):
 	conn = connect(conninfo, dbname)
 	cursor = conn.cursor()
@@ -81,6 +81,8 @@ class ProjectUpdatePart:
 		self.roles = []
 		self.requires = []
 		self.single_transaction = True
+		self.backfill = None
+		self.squashed = None
 		with(open(os.path.join(directory, fname))) as f:
 			for line in f:
 				# single_transaction
@@ -99,10 +101,31 @@ class ProjectUpdatePart:
 				x = re.match(r"--\s*require:\s+(?P<project_name>\S+)", line)
 				if x:
 					self.requires.append(x.group("project_name"))
+				# backfill, table and key can be quoted identifiers with spaces
+				x = re.match(r'--\s*backfill:\s+(?P<table>(?:"(?:[^"]|"")*"|[^\s"])+)\s+(?P<key>(?:"(?:[^"]|"")*"|[^\s"])+)(\s+(?P<batch_size>\d+))?', line)
+				if x:
+					self.backfill = (x.group("table"), x.group("key"), int(x.group("batch_size") or 10000))
+				# squashed
+				x = re.match(r"--\s*squashed:\s+(?P<versions>.*\S)", line)
+				if x:
+					self.squashed = x.group("versions").split()
 				x = re.match(r"--\s*end\s+header", line)
 				if x:
 					break
 
+	def get_command(self, directory):
+		command = []
+		end_header = False
+		with(open(os.path.join(directory, self.fname))) as f:
+			for line in f:
+				if not end_header:
+					end_header = re.match(r"--\s*end\s+header", line)
+					continue
+				if re.match(r"\s*(--.*)?$", line):
+					continue
+				command.append(line)
+		return "".join(command).strip()
+
 class ProjectUpdate:
 	def __init__(self, version_old, version_new):
 		self.version_new = LooseVersion(version_new)
@@ -216,8 +239,11 @@ class Project:
 		logging.verbose("\tnot found")
 		return None
 
-	def update(self, dbname, update, conninfo, directory):
-		pg.update(dbname, self, update, conninfo, directory)
+	def update(self, dbname, update, conninfo, directory, start_part=1):
+		pg.update(dbname, self, update, conninfo, directory, start_part)
+
+	def update_squash(self, dbname, updates, conninfo, directory):
+		pg.update_squash(dbname, self, updates, conninfo, directory)
 
 def get_project_name(directory, fname):
 	with(open(os.path.join(directory, fname))) as f:
@@ -398,7 +424,7 @@ def install(project_name, dbname, version, conninfo, directory, create_db, is_re
 def check_update(project_name, dbname, version, conninfo, directory):
 	update(project_name, dbname, version, conninfo, directory, check=True)
 
-def update(project_name, dbname, version, conninfo, directory, check=False):
+def update(project_name, dbname, version, conninfo, directory, check=False, squash=False):
 	if project_name == "-":
 		project_name = None
 	if dbname == "-":
@@ -415,6 +441,9 @@ def update(project_name, dbname, version, conninfo, directory, check=False):
 	for project in projects:
 		for ins in project.installed:
 			updates = project.find_updates(ins.version, version)
+			if ins.part != ins.parts:
+				# resume interrupted update from the first not finished part
+				updates.insert(0, project.get_update(str(ins.from_version), str(ins.version)))
 			ins.updates = updates
 			if updates:
 				exists_updates = True
@@ -441,15 +470,47 @@ def update(project_name, dbname, version, conninfo, directory, check=False):
 
 	for project in projects:
 		for ins in project.installed:
-			for update in ins.updates:
-				project.update(ins.dbname, update, conninfo, directory)
+			if squash and len(ins.updates) > 1:
+				if ins.part == ins.parts and can_squash(ins.updates, directory):
+					project.update_squash(ins.dbname, ins.updates, conninfo, directory)
+					continue
+				logging.info("%s in db %s: updates contain not single transaction parts or transaction control, they are not squashed" % (project.name, ins.dbname))
+			for i, update in enumerate(ins.updates):
+				if i == 0 and ins.part != ins.parts:
+					project.update(ins.dbname, update, conninfo, directory, start_part=ins.part+1)
+				else:
+					project.update(ins.dbname, update, conninfo, directory)
 	print("Complete!")
 
+def can_squash(updates, directory):
+	# only single transaction parts can be joined to one transaction
+	for update in updates:
+		for part in update.parts:
+			if not part.single_transaction or part.backfill:
+				return False
+			if transaction_control(part.get_command(directory)):
+				return False
+	return True
+
+def transaction_control(command):
+	# BEGIN, COMMIT, ... outside of strings and function bodies would end transaction of squashed updates
+	command = re.sub(r"\$(\w*)\$.*?\$\1\$|'(?:[^']|'')*'|--[^\n]*", "", command, flags=re.DOTALL)
+	for statement in command.split(";"):
+		if re.match(r"\s*(BEGIN|START\s+TRANSACTION|COMMIT|END|ROLLBACK|ABORT|SAVEPOINT|RELEASE|PREPARE\s+TRANSACTION)\b", statement, re.IGNORECASE):
+			return True
+	return False
+
 def check_succesfull_installed(projects):
 	for project in projects:
 		for ins in project.installed:
 			if ins.part != ins.parts:
-				logging.error("%s in db %s fail in upgrade from %s to %s ")
+				update = None
+				if ins.from_version:
+					update = project.get_update(str(ins.from_version), str(ins.version))
+				if update and len(update.parts) > ins.part and update.parts[ins.part].backfill:
+					logging.info("%s in db %s resume backfill in upgrade from %s to %s part %d/%d" % (project.name, ins.dbname, ins.from_version, ins.version, ins.part+1, ins.parts))
+					continue
+				logging.error("%s in db %s fail in upgrade from %s to %s" % (project.name, ins.dbname, ins.from_version, ins.version))
 				# TODO, what do in this case?
 				sys.exit(1)
 
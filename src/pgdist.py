@@ -30,16 +30,34 @@ PGdist Devel - develop PostgreSQL project
     create-update GIT_TAG NEW_VERSION [PARTS] - create update files with differencies
                                           - GIT_TAG - old version tag
                                           - NEW_VERSION - new version
-                                          - PARTS - number of parts you want to create
+                                          - PARTS - minimal number of parts, update is split automatically
+                                          - --backfill 'TABLE[(KEY)] SET COLUMN = EXPRESSION [WHERE CONDITION]' - add part updating rows in batches
+                                          - --target-version VERSION - PostgreSQL version the update is created for (default version of test pg)
     part-update-add OLD_VERSION NEW_VERSION [not-single-transaction] - add update part file
     part-update-rm OLD_VERSION NEW_VERSION PART_NUMBER - delete update part file
     test-update GIT_TAG NEW_VERSION - load old and new version and compare it
                                           - GIT_TAG - old version tag
                                           - NEW_VERSION - new version
+    squash-updates GIT_TAG NEW_VERSION - join chain of updates to one update file and test it
+                                          - GIT_TAG - old version tag
+                                          - NEW_VERSION - new version
+    analyze-update OLD_VERSION NEW_VERSION PGCONN - print commands of update ranked by locks, rewrites and table sizes
 
     diff-db PGCONN [GIT_TAG] - diff project and database
+    diff-db --target PGCONN [--target PGCONN ...] [--targets FILE] [GIT_TAG] - diff project and many databases,
+                                          - project is loaded once, databases with the same structure and data are compared once
     diff-db-file PGCONN FILE - diff file and database
     diff-file-db FILE PGCONN - diff database and file
+    catalog-check PGCONN - compare structure read from catalogs (--catalog) with pg_dump of database
+    snapshot PGCONN [NAME] - save structure and data of database to local snapshot store
+    snapshot-list - print saved snapshots
+    snapshot-diff SNAPSHOT [SNAPSHOT2] - diff two snapshots without database, or snapshot and project
+    snapshot-rm SNAPSHOT - remove snapshot and objects not used by other snapshots
+    cache list - print cached dumps of remote databases (--cache)
+    cache prune - remove expired entries and entries over size limit, --all removes all entries
+    cache warm PGCONN [GIT_TAG] - dump remote database to cache
+    test-db reap [HOURS] - drop test databases of user older than HOURS left by interrupted commands, --all drops all
+    test-db stop - stop local test_db cluster (test_db: local) and remove its data
 
     role-list - print roles in project
     role-add NAME [login|nologin] [password] - add role to project
@@ -62,7 +80,7 @@ PGdist Server - manage projects in PostgreSQL database
     list [PROJECT [DBNAME]] - show list of installed projects in databases
     install PROJECT DBNAME [VERSION] - install project to database
     check-update [PROJECT [DBNAME [VERSION]]] - check update project
-    update [PROJECT [DBNAME [VERSION]]] - update project
+    update [PROJECT [DBNAME [VERSION]]] - update project, --squash runs chain of single transaction updates in one transaction
     clean PROJECT [DBNAME] - remove all info about project
     set-version PROJECT DBNAME VERSION - force change version without run scripts
     get-version PROJECT DBNAME - print installed version of project
@@ -81,7 +99,21 @@ Develop configuration:
         [pgdist]
         test_db: user@host/dbname
 
-        test_db - PGCONN to testing postgres, user has to create databases and users
+        test_db - PGCONN to testing postgres, user has to create databases and users,
+                  more PGCONNs separated by spaces or commas - the least loaded server is used by command
+                  local - private cluster of user started by initdb and pg_ctl in tmpfs, stopped after idle timeout
+        test_db_local_dir, test_db_local_idle, test_db_local_bindir - directory (default /dev/shm/pgdist-USER), idle timeout
+                  in seconds (default 1800) and directory of initdb, pg_ctl and psql (default PATH or pg_config --bindir) of local test_db
+        template_count, template_size - number and size in MB of template databases of loaded projects kept on test pg, default 10 and 4096
+        snapshot_dir - directory of snapshot store, default ~/.local/share/pgdist/snapshots
+        cache_dir - directory of cached dumps (--cache), default ~/.cache/pgdist
+        cache_ttl_roles, cache_ttl_struct, cache_ttl_data - seconds cached entries are valid, default 14400
+        cache_ttl_fingerprint - seconds cached entries are valid while fingerprint of database catalogs matches, default 604800
+        cache_size - size limit of cache in MB, least recently used entries are removed, default 256
+        test_db_reap_age - hours after which test databases are dropped by test-db reap, default 24
+        test_db_max_loads - number of test databases loaded in parallel on one test pg by all commands (advisory locks), default unlimited
+        test_db_pool - number of empty databases kept ready on test pg, 0 disables the pool, default 2
+        test_db_auto_reap - yes to run test-db reap in background by commands loading test databases, default no
 Distribution configuration:
     Configuration file is located at `/etc/pgdist.conf`.
         [pgdist]
@@ -121,7 +153,15 @@ def main():
 	parser.add_argument("--diff-raw", dest="diff_raw", help="compare raw SQL dumps", action="store_true")
 	parser.add_argument("-w", "--ignore-all-space", dest="ignore_space", help="ignore all white space", action="store_true", default=False)
 	parser.add_argument("--no-clean", dest="no_clean", help="no clean test database after load/update test", action="store_true", default=False)
-	parser.add_argument("--cache", dest="cache", help="cache dump remote database for 4 hours", action="store_true", default=False)
+	parser.add_argument("--no-echo", dest="no_echo", help="psql does not echo commands, failed command is found by line number", action="store_true", default=False)
+	parser.add_argument("--psql-log", dest="psql_log", help="append whole output of psql to file")
+	parser.add_argument("--no-template", dest="no_template", help="load project to empty test database, do not use and save template databases", action="store_true", default=False)
+	parser.add_argument("--cache", dest="cache", help="cache dump remote database, see cache_ttl_* and cache_size in configuration", action="store_true", default=False)
+	parser.add_argument("--catalog", dest="catalog", help="read remote structure from system catalogs instead of pg_dump, command: diff-db", action="store_true", default=False)
+	parser.add_argument("--target", dest="target", help="PGCONN of database compared by diff-db, can be repeated", action="append", default=[])
+	parser.add_argument("--targets", dest="targets", help="file with PGCONN per line compared by diff-db")
+	parser.add_argument("--jobs", dest="jobs", help="number of databases dumped in parallel, command: diff-db with targets (default 4)", type=int, default=4)
+	parser.add_argument("--normalize", dest="normalize", help="restore remote dump in test database and dump it again also when major versions of servers match, commands: diff-db, diff-db-file, diff-file-db", action="store_true", default=False)
 	parser.add_argument("--pg_extractor", dest="pg_extractor", help="Dump by pg_extractor, compare by diff -r", action="store_true")
 	parser.add_argument("--pg_extractor_basedir", dest="pg_extractor_basedir", help="Dump by pg_extractor do directory PG_EXTRACTOR_BASEDIR")
 	parser.add_argument("--pre-load", dest="pre_load", help="SQL file to load before load project")
@@ -132,6 +172,9 @@ def main():
 	parser.add_argument("--post-load-old", dest="post_load_old", help="SQL file to load after load old version of the project")
 	parser.add_argument("--pre-load-new", dest="pre_load_new", help="SQL file to load before load new version of the project")
 	parser.add_argument("--post-load-new", dest="post_load_new", help="SQL file to load after load new version of the project")
+	parser.add_argument("--backfill", dest="backfill", help="backfill directive for create-update: 'TABLE[(KEY)] SET COLUMN = EXPRESSION [WHERE CONDITION]'", action="append")
+	parser.add_argument("--batch-size", dest="batch_size", help="number of rows updated in one backfill batch (default 10000)", type=int, default=10000)
+	parser.add_argument("--target-version", dest="target_version", help="PostgreSQL version of servers the update is created for, e.g. 9.6 or 11, command: create-update (default version of test pg)")
 
 	# install projects
 	parser.add_argument("--showall", help="show all versions", action="store_true")
@@ -141,6 +184,7 @@ def main():
 	parser.add_argument("-p", "--port", dest="port", help="Specifies the TCP port or the local Unix-domain socket file.")
 	parser.add_argument("-U", "--username", dest="user", help="Connect to the database as the user username.")
 	parser.add_argument("-P", "--password", dest="password", help="Specifies the password of the user for pg connection")
+	parser.add_argument("--squash", help="run chain of single transaction updates in one transaction, command: update", action="store_true")
 	parser.add_argument("-C", "--create", dest="create", help="Create the database.", action="store_true")
 	parser.add_argument("--directory", help="directory contains script install and update")
 	parser.add_argument("--syslog-facility", dest="syslog_facility", help="syslog facility")
@@ -177,8 +221,9 @@ def main():
 
 	if args.cmd in ("init", "create-schema", "status", "test-load", "create-version", "add", "rm",
 		"part-add", "part-rm", "create-update", "test-update",
-		"part-update-add", "part-update-rm",
-		"diff-db", "diff-db-file", "diff-file-db",
+		"part-update-add", "part-update-rm", "squash-updates", "analyze-update",
+		"diff-db", "diff-db-file", "diff-file-db", "catalog-check", "cache", "test-db",
+		"snapshot", "snapshot-list", "snapshot-diff", "snapshot-rm",
 		"role-list", "role-add", "role-change", "role-rm",
 		"require-add", "require-rm", "dbparam-set", "dbparam-get",
 		"data-add", "data-rm", "data-list"):
@@ -193,7 +238,7 @@ def main():
 
 		if args.less:
 			less = True
-		elif args.noless or args.cmd not in ("diff-db", "diff-db-file", "diff-file-db"):
+		elif args.noless or args.cmd not in ("diff-db", "diff-db-file", "diff-file-db", "catalog-check", "snapshot-diff"):
 			less = False
 		else:
 			less = sys.stdout.isatty()
@@ -210,6 +255,12 @@ def main():
 			color.set(args.color)
 
 		config.git_diff = args.git_diff
+		config.echo_queries = not args.no_echo
+		config.psql_log = args.psql_log
+		config.use_templates = not args.no_template
+		if args.cmd in ("test-load", "create-update", "test-update", "squash-updates",
+			"diff-db", "diff-db-file", "diff-file-db", "snapshot-diff"):
+			pg_project.select_test_db()
 
 	if args.cmd in ("list", "install", "check-update", "update", "clean", "set-version", "get-version","pgdist-update", "log"):
 		sys.path.insert(1, os.path.join(sys.path[0], "mng"))
@@ -275,7 +326,7 @@ def main():
 		(git_tag, new_version, part_count) = args_parse(args.args, 3)
 		pg_project.create_update(git_tag, new_version, args.force, args.gitversion, clean=not args.no_clean, pre_load=args.pre_load, post_load=args.post_load,
 			pre_load_old=args.pre_load_old, pre_load_new=args.pre_load_new, post_load_old=args.post_load_old, post_load_new=args.post_load_new,
-			part_count=part_count or 1)
+			part_count=part_count or 1, backfills=args.backfill, batch_size=args.batch_size, target_version=args.target_version)
 
 	elif args.cmd == "part-update-add" and len(args.args) in (2, 3):
 		(old_version, new_version, transaction_type) = args_parse(args.args, 3)
@@ -291,23 +342,82 @@ def main():
 			pre_load_old=args.pre_load_old, pre_load_new=args.pre_load_new, post_load_old=args.post_load_old, post_load_new=args.post_load_new,
 			pg_extractor=pg_extractor, no_owner=args.no_owner)
 
+	elif args.cmd == "squash-updates" and len(args.args) in (2,):
+		(git_tag, new_version) = args_parse(args.args, 2)
+		pg_project.squash_updates(git_tag, new_version, args.force, gitversion=args.gitversion, clean=not args.no_clean, pre_load=args.pre_load, post_load=args.post_load,
+			pre_load_old=args.pre_load_old, pre_load_new=args.pre_load_new, post_load_old=args.post_load_old, post_load_new=args.post_load_new,
+			pg_extractor=pg_extractor, no_owner=args.no_owner)
+
+	elif args.cmd == "analyze-update" and len(args.args) in (3,):
+		(old_version, new_version, pgconn) = args_parse(args.args, 3)
+		pg_project.analyze_update(old_version, new_version, address.Address(pgconn))
+
+	elif args.cmd == "diff-db" and (args.target or args.targets) and len(args.args) in (0, 1):
+		(git_tag,) = args_parse(args.args, 1)
+		if args.catalog or args.pg_extractor:
+			logging.error("Error: --catalog and --pg_extractor cannot be used with --target and --targets")
+			sys.exit(1)
+		targets = [address.Address(pgconn) for pgconn in args.target]
+		if args.targets:
+			targets += pg_project.load_targets(args.targets)
+		pg_project.diff_pg_targets(targets, git_tag, args.diff_raw, not args.no_clean, args.no_owner, args.no_acl,
+			pre_load=args.pre_load, post_load=args.post_load, pre_remoted_load=args.pre_remoted_load, post_remoted_load=args.post_remoted_load,
+			swap=args.swap, cache=args.cache, ignore_space=args.ignore_space, normalize=args.normalize, jobs=args.jobs)
+
 	elif args.cmd == "diff-db" and len(args.args) in (1, 2):
 		(pgconn, git_tag) = args_parse(args.args, 2)
 		pg_project.diff_pg(address.Address(pgconn), git_tag, args.diff_raw, not args.no_clean, args.no_owner, args.no_acl,
 			pre_load=args.pre_load, post_load=args.post_load, pre_remoted_load=args.pre_remoted_load, post_remoted_load=args.post_remoted_load,
-			swap=args.swap, pg_extractor=pg_extractor, cache=args.cache, ignore_space=args.ignore_space)
+			swap=args.swap, pg_extractor=pg_extractor, cache=args.cache, ignore_space=args.ignore_space, catalog=args.catalog, normalize=args.normalize)
 
 	elif args.cmd == "diff-db-file" and len(args.args) in (2,):
 		(pgconn, file) = args_parse(args.args, 2)
 		pg_project.diff_pg_file(address.Address(pgconn), file, args.diff_raw, not args.no_clean, args.no_owner, args.no_acl,
 			pre_load=args.pre_load, post_load=args.post_load, pre_remoted_load=args.pre_remoted_load, post_remoted_load=args.post_remoted_load,
-			swap=args.swap, pg_extractor=pg_extractor, cache=args.cache, ignore_space=args.ignore_space)
+			swap=args.swap, pg_extractor=pg_extractor, cache=args.cache, ignore_space=args.ignore_space, normalize=args.normalize)
 
 	elif args.cmd == "diff-file-db" and len(args.args) in (2,):
 		(file, pgconn) = args_parse(args.args, 2)
 		pg_project.diff_pg_file(address.Address(pgconn), file, args.diff_raw, not args.no_clean, args.no_owner, args.no_acl,
 			pre_load=args.pre_load, post_load=args.post_load, pre_remoted_load=args.pre_remoted_load, post_remoted_load=args.post_remoted_load,
-			swap=not args.swap, pg_extractor=pg_extractor, cache=args.cache, ignore_space=args.ignore_space)
+			swap=not args.swap, pg_extractor=pg_extractor, cache=args.cache, ignore_space=args.ignore_space, normalize=args.normalize)
+
+	elif args.cmd == "catalog-check" and len(args.args) in (1,):
+		(pgconn,) = args_parse(args.args, 1)
+		pg_project.catalog_check(address.Address(pgconn), args.no_owner, args.no_acl, ignore_space=args.ignore_space)
+
+	elif args.cmd == "snapshot" and len(args.args) in (1, 2):
+		(pgconn, name) = args_parse(args.args, 2)
+		pg_project.snapshot(address.Address(pgconn), name, args.no_owner, args.no_acl, args.cache)
+
+	elif args.cmd == "snapshot-list" and len(args.args) in (0,):
+		pg_project.snapshot_list()
+
+	elif args.cmd == "snapshot-diff" and len(args.args) in (1, 2):
+		(name1, name2) = args_parse(args.args, 2)
+		pg_project.snapshot_diff(name1, name2, not args.no_clean, args.no_owner, args.no_acl,
+			pre_load=args.pre_load, post_load=args.post_load, swap=args.swap, ignore_space=args.ignore_space)
+
+	elif args.cmd == "snapshot-rm" and len(args.args) in (1,):
+		(name,) = args_parse(args.args, 1)
+		pg_project.snapshot_rm(name)
+
+	elif args.cmd == "cache" and args.args[:1] == ["list"] and len(args.args) in (1,):
+		pg_project.cache_list()
+
+	elif args.cmd == "cache" and args.args[:1] == ["prune"] and len(args.args) in (1,):
+		pg_project.cache_prune(args.all)
+
+	elif args.cmd == "cache" and args.args[:1] == ["warm"] and len(args.args) in (2, 3):
+		(pgconn, git_tag) = args_parse(args.args[1:], 2)
+		pg_project.cache_warm(address.Address(pgconn), git_tag, args.no_owner, args.no_acl)
+
+	elif args.cmd == "test-db" and args.args[:1] == ["reap"] and len(args.args) in (1, 2):
+		(hours,) = args_parse(args.args[1:], 1)
+		pg_project.test_db_reap(float(hours) if hours else None, args.all)
+
+	elif args.cmd == "test-db" and args.args[:1] == ["stop"] and len(args.args) in (1,):
+		pg_project.test_db_stop()
 
 	elif args.cmd == "role-list" and len(args.args) in (0,):
 		pg_project.role_list()
@@ -369,7 +479,7 @@ def main():
 
 	elif args.cmd == "update" and len(args.args) in (0, 1, 2, 3,):
 		(project_name, dbname, version) = args_parse(args.args, 3)
-		pg_project.update(project_name, dbname or args.dbname, version, conninfo.ConnInfo(args), args.directory or config.get_install_path())
+		pg_project.update(project_name, dbname or args.dbname, version, conninfo.ConnInfo(args), args.directory or config.get_install_path(), squash=args.squash)
 
 	elif args.cmd == "clean" and len(args.args) in (1, 2,):
 		(project_name, dbname) = args_parse(args.args, 2)
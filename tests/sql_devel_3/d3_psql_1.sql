@@ -0,0 +1,8 @@
+-- syntax run only by psql, not by session of pgdist
+CREATE TABLE pgdist_test_schema.test_table_3$x (
+    id INTEGER,
+    note TEXT DEFAULT E'it\'s; x'
+);
+CREATE TABLE pgdist_test_schema."Test_Table_3" (id INTEGER);
+\set test_value 1
+SELECT :test_value AS test_value \gset
@@ -26,6 +26,7 @@ NC="\033[0m"
 PATH_TEST=$(pwd)
 PATH_D1="${PATH_TEST}/sql_devel_1"
 PATH_D2="${PATH_TEST}/sql_devel_2"
+PATH_D3="${PATH_TEST}/sql_devel_3"
 PATH_PGDIST=$(dirname $PATH_TEST)
 PATH_PGDIST_SRC="${PATH_PGDIST}/src"
 PATH_PGDIST_INSTALL="${PATH_TEST}/install"
@@ -181,6 +182,12 @@ source "${PATH_TEST}/test_devel_2.sh"
 #test pgdist server.sh
 source "${PATH_TEST}/test_server.sh"
 
+#test pgdist devel_3, new functions of devel commands
+source "${PATH_TEST}/test_devel_3.sh"
+
+#checks without PostgreSQL
+source "${PATH_TEST}/test_offline.sh"
+
 if [ "$NO_CLEAN" = false ]; then
     log_pgdist "clean pgdist_test_project pgdist_test_database"
     python "${PATH_PGDIST_SRC}/pgdist.py" clean pgdist_test_project pgdist_test_database -c $PATH_CONFIG_MNG $PGCONN_2
@@ -0,0 +1,159 @@
+#!/bin/bash
+
+TEST_PART="devel_3 | "
+log "test begin\n"
+
+#scripts with syntax of psql only (E'' strings, quoted identifiers, $ in names, \gset)
+log "cp ${PATH_D3}/d3_psql_1.sql ${PATH_TABLES}/"
+cp "${PATH_D3}/d3_psql_1.sql" "${PATH_TABLES}/"
+
+cd $PATH_SQL
+log_pgdist "add ${PATH_TABLES}/d3_psql_1.sql"
+python "${PATH_PGDIST_SRC}/pgdist.py" add "${PATH_TABLES}/d3_psql_1.sql" -c $PATH_CONFIG_DEV
+
+log_pgdist "test-load"
+timeout 300 python "${PATH_PGDIST_SRC}/pgdist.py" test-load -c $PATH_CONFIG_DEV
+
+#loaded project is kept as template database, next load is created from it
+TEMPLATES=$(psql -U postgres -tA -c "SELECT count(*) FROM pg_database WHERE datname LIKE 'pgdist\_tpl\_%';")
+if [ "$TEMPLATES" = "0" ]; then
+    log_err "template database of test load is not created"
+    exit 1
+fi
+
+log_pgdist "test-load"
+timeout 300 python "${PATH_PGDIST_SRC}/pgdist.py" test-load -c $PATH_CONFIG_DEV 2>&1 | tee /dev/stderr | grep -q "create test database from template of project"
+
+#scripts run by psql without echo, whole output of psql in log, project is loaded without template
+log_pgdist "test-load --no-template --no-echo --psql-log ${PATH_TEST}/psql.log"
+timeout 300 python "${PATH_PGDIST_SRC}/pgdist.py" test-load --no-template --no-echo --psql-log "${PATH_TEST}/psql.log" -c $PATH_CONFIG_DEV
+test -s "${PATH_TEST}/psql.log"
+rm -f "${PATH_TEST}/psql.log"
+
+#table data are copied in parallel connections from one exported snapshot
+PGCONN="postgres@/pgdist_test_database"
+log_pgdist "data-add pgdist_test_schema.test_table_2"
+python "${PATH_PGDIST_SRC}/pgdist.py" data-add pgdist_test_schema.test_table_2 -c $PATH_CONFIG_DEV
+
+log_pgdist "diff-db ${PGCONN}"
+python "${PATH_PGDIST_SRC}/pgdist.py" diff-db $PGCONN --noless -c $PATH_CONFIG_DEV
+
+#structure of remote database read from system catalogs
+log_pgdist "catalog-check ${PGCONN}"
+python "${PATH_PGDIST_SRC}/pgdist.py" catalog-check $PGCONN -c $PATH_CONFIG_DEV
+
+log_pgdist "diff-db ${PGCONN} --catalog"
+python "${PATH_PGDIST_SRC}/pgdist.py" diff-db $PGCONN --catalog --noless -c $PATH_CONFIG_DEV
+
+#many databases compared in one run, the same database given twice is dumped once
+log "echo ${PGCONN} > ${PATH_TEST}/targets"
+printf "# test databases\n\n%s\n" "$PGCONN" > "${PATH_TEST}/targets"
+
+log_pgdist "diff-db --targets ${PATH_TEST}/targets --target ${PGCONN}"
+python "${PATH_PGDIST_SRC}/pgdist.py" diff-db --targets "${PATH_TEST}/targets" --target $PGCONN --noless -c $PATH_CONFIG_DEV
+rm -f "${PATH_TEST}/targets"
+
+#dump of remote database cached
+log_pgdist "cache warm ${PGCONN}"
+python "${PATH_PGDIST_SRC}/pgdist.py" cache warm $PGCONN -c $PATH_CONFIG_DEV
+
+log_pgdist "cache list"
+python "${PATH_PGDIST_SRC}/pgdist.py" cache list -c $PATH_CONFIG_DEV | tee /dev/stderr | grep -q "struct"
+
+log_pgdist "diff-db ${PGCONN} --cache"
+python "${PATH_PGDIST_SRC}/pgdist.py" diff-db $PGCONN --cache --noless -c $PATH_CONFIG_DEV
+
+log_pgdist "cache prune --all"
+python "${PATH_PGDIST_SRC}/pgdist.py" cache prune --all -c $PATH_CONFIG_DEV
+
+#structure and data of database saved, compared without database
+log_pgdist "snapshot ${PGCONN} pgdist_test_snapshot"
+python "${PATH_PGDIST_SRC}/pgdist.py" snapshot $PGCONN pgdist_test_snapshot -c $PATH_CONFIG_DEV
+
+log_pgdist "snapshot-list"
+python "${PATH_PGDIST_SRC}/pgdist.py" snapshot-list -c $PATH_CONFIG_DEV | tee /dev/stderr | grep -q "pgdist_test_snapshot"
+
+log_pgdist "snapshot-diff pgdist_test_snapshot pgdist_test_snapshot"
+python "${PATH_PGDIST_SRC}/pgdist.py" snapshot-diff pgdist_test_snapshot pgdist_test_snapshot --noless -c $PATH_CONFIG_DEV
+
+log_pgdist "snapshot-diff pgdist_test_snapshot"
+python "${PATH_PGDIST_SRC}/pgdist.py" snapshot-diff pgdist_test_snapshot --noless -c $PATH_CONFIG_DEV
+
+log_pgdist "snapshot-rm pgdist_test_snapshot"
+python "${PATH_PGDIST_SRC}/pgdist.py" snapshot-rm pgdist_test_snapshot -c $PATH_CONFIG_DEV
+
+#backfill part is run in batches by update and resumed from its recorded progress
+cd $PATH_SQL
+log_pgdist "create-update v1.1 1.2 --backfill 'pgdist_test_schema.test_table_1(id) SET message = message' --batch-size 3"
+python "${PATH_PGDIST_SRC}/pgdist.py" create-update v1.1 1.2 --backfill "pgdist_test_schema.test_table_1(id) SET message = message" --batch-size 3 -c $PATH_CONFIG_DEV
+
+BACKFILL_FILE=$(grep -l "^-- backfill: pgdist_test_schema.test_table_1 id 3$" ${PATH_SQL_DIST}/pgdist_test_project--1.1--1.2*.sql)
+BACKFILL_PART=$(sed -n 's/^-- part: \([0-9]*\)$/\1/p' $BACKFILL_FILE)
+log "backfill part ${BACKFILL_PART}: ${BACKFILL_FILE}"
+
+log_pgdist "test-update v1.1 1.2"
+python "${PATH_PGDIST_SRC}/pgdist.py" test-update v1.1 1.2 -c $PATH_CONFIG_DEV
+
+log "cp -a ${PATH_SQL_DIST}/. ${PATH_PGDIST_INSTALL}"
+cp -a "${PATH_SQL_DIST}/." $PATH_PGDIST_INSTALL
+
+log_pgdist "set-version pgdist_test_project pgdist_test_database 1.1"
+python "${PATH_PGDIST_SRC}/pgdist.py" set-version pgdist_test_project pgdist_test_database 1.1 -c $PATH_CONFIG_MNG $PGCONN_2
+
+#interrupted backfill, rows with id <= 5 are done
+log "psql -U postgres -d pgdist_test_database -c 'INSERT INTO pgdist.backfill ...'"
+psql -U postgres -d pgdist_test_database -c "INSERT INTO pgdist.backfill (project, version, part, last_key, done) VALUES ('pgdist_test_project', '1.2', ${BACKFILL_PART}, '5', false);"
+
+log_pgdist "update pgdist_test_project pgdist_test_database 1.2"
+python "${PATH_PGDIST_SRC}/pgdist.py" update pgdist_test_project pgdist_test_database 1.2 -c $PATH_CONFIG_MNG $PGCONN_2 | tee /dev/stderr | grep -q "Backfill pgdist_test_schema.test_table_1: 5 rows updated"
+
+BACKFILL_DONE=$(psql -U postgres -d pgdist_test_database -tA -c "SELECT done FROM pgdist.backfill WHERE project = 'pgdist_test_project' AND version = '1.2';")
+if [ "$BACKFILL_DONE" != "t" ]; then
+    log_err "backfill is not done: ${BACKFILL_DONE}"
+    exit 1
+fi
+
+#commands of update ranked by locks and sizes of tables in database
+log_pgdist "analyze-update 1.1 1.2 ${PGCONN}"
+python "${PATH_PGDIST_SRC}/pgdist.py" analyze-update 1.1 1.2 $PGCONN -c $PATH_CONFIG_DEV | tee /dev/stderr | grep -q "part:line"
+
+#chain of single transaction updates run in one transaction, every step is logged
+cd $PATH_SQL
+log_pgdist "create-update v1.1 1.2 -f"
+python "${PATH_PGDIST_SRC}/pgdist.py" create-update v1.1 1.2 -f -c $PATH_CONFIG_DEV
+
+log "cp -a ${PATH_SQL_DIST}/. ${PATH_PGDIST_INSTALL}"
+rm -f ${PATH_PGDIST_INSTALL}/pgdist_test_project--1.1--1.2*.sql
+cp -a "${PATH_SQL_DIST}/." $PATH_PGDIST_INSTALL
+
+log_pgdist "install pgdist_test_project pgdist_test_squash 1.0 -C"
+python "${PATH_PGDIST_SRC}/pgdist.py" install pgdist_test_project pgdist_test_squash 1.0 -C -c $PATH_CONFIG_MNG $PGCONN_2
+
+log_pgdist "update pgdist_test_project pgdist_test_squash 1.2 --squash"
+python "${PATH_PGDIST_SRC}/pgdist.py" update pgdist_test_project pgdist_test_squash 1.2 --squash -c $PATH_CONFIG_MNG $PGCONN_2
+
+SQUASH_STEPS=$(psql -U postgres -d pgdist_test_squash -tA -c "SELECT string_agg(DISTINCT version, ' ') FROM pgdist.history WHERE project = 'pgdist_test_project' AND version IN ('1.1', '1.2');")
+if [ "$SQUASH_STEPS" != "1.1 1.2" ]; then
+    log_err "steps of squashed update are not logged: ${SQUASH_STEPS}"
+    exit 1
+fi
+psql -U postgres -c "DROP DATABASE pgdist_test_squash;"
+
+#chain of updates joined to one update file
+log_pgdist "squash-updates v1.0 1.2"
+python "${PATH_PGDIST_SRC}/pgdist.py" squash-updates v1.0 1.2 -c $PATH_CONFIG_DEV
+grep -q "^-- squashed: 1.0 1.1 1.2$" "${PATH_SQL_DIST}/pgdist_test_project--1.0--1.2.sql"
+
+#test databases left by interrupted commands
+log_pgdist "test-db reap"
+python "${PATH_PGDIST_SRC}/pgdist.py" test-db reap -c $PATH_CONFIG_DEV
+
+log_pgdist "test-db reap --all"
+python "${PATH_PGDIST_SRC}/pgdist.py" test-db reap --all -c $PATH_CONFIG_DEV
+TEST_DBS=$(psql -U postgres -tA -c "SELECT count(*) FROM pg_database WHERE datname LIKE 'pgdist\_test\_$(whoami)\_%';")
+if [ "$TEST_DBS" != "0" ]; then
+    log_err "test databases are not reaped: ${TEST_DBS}"
+    exit 1
+fi
+
+log "test 3/3 finished"
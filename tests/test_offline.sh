@@ -0,0 +1,1115 @@
+#!/bin/bash
+
+#checks of pgdist modules without PostgreSQL, sourced by test.sh or run alone: ./test_offline.sh
+if ! type log > /dev/null 2>&1; then
+    set -e
+    PATH_TEST=$(cd $(dirname $0) && pwd)
+    PATH_PGDIST_SRC="$(dirname $PATH_TEST)/src"
+    log() {
+        echo -e "Test | ${TEST_PART}$1"
+    }
+fi
+
+TEST_PART="offline | "
+log "test begin\n"
+
+#python script from stdin with modules of pgdist devel
+py_check() {
+    log "python check: $1"
+    PYTHONPATH="${PATH_PGDIST_SRC}/dev" PYTHONIOENCODING=utf8 python - || { log "python check failed: $1"; exit 1; }
+}
+
+py_check "session splits only scripts of known syntax, others run by psql" <<'PY'
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import logging
+logging.verbose = logging.debug
+import pg_conn
+for script in ["CREATE TABLE a$b (x int);", "SELECT E'it\\'s; x';", 'SELECT "a;b" FROM t;', "SELECT 1 \\gset", "SELECT $1;"]:
+    assert not pg_conn.session_script(script), script
+    assert pg_conn.expand_script(script, ".", ".") is None, script
+commands = pg_conn.expand_script("-- c\nCREATE FUNCTION f() RETURNS text AS $$ SELECT 'a;b' $$ LANGUAGE sql;\nCOPY t (a) FROM stdin;\nx;y\n\\.\nSELECT 'it''s';\n", ".", ".")
+assert [copy_data for command, copy_data in commands] == [None, "x;y\n", None], commands
+assert commands[2][0].strip() == "SELECT 'it''s';", commands
+PY
+
+py_check "failed copy of table data is an error, snapshot is released" <<'PY'
+from __future__ import unicode_literals
+import logging
+logging.verbose = logging.debug
+import address, pg_conn, pg_project
+class Project:
+    table_data = [pg_project.TableData("s.t%d" % (i,)) for i in range(6)]
+project = Project()
+released = []
+class Session:
+    def __init__(self, *args):
+        raise pg_conn.PgError(2, "connect", output="connection refused")
+pg_conn.Session = Session
+pg_conn.connect_address = lambda addr: addr
+pg_conn.PG.export_snapshot = lambda self: setattr(self, "snapshot", "snap")
+pg_conn.PG.release_snapshot = lambda self: released.append(self.snapshot)
+try:
+    pg_conn.PG(address.Address("localhost/db")).dump_data(project)
+    assert False, "no error"
+except pg_conn.PgError as e:
+    assert "connection refused" in e.output, e.output
+assert released == ["snap"], released
+PY
+
+py_check "update is split by rules of target version, parts of one kind are merged" <<'PY'
+from __future__ import unicode_literals
+import io, logging
+logging.verbose = logging.debug
+import pg_lock, pg_project, pg_types
+add_column = "ALTER TABLE s.t ADD COLUMN c integer DEFAULT 1;"
+assert pg_lock.Statement(add_column, server_version=100000).rewrite
+assert not pg_lock.Statement(add_column, server_version=110000).rewrite
+for default, rewrite in (("now()", False), ("CURRENT_TIMESTAMP", False), ("lower('A')", False), ("clock_timestamp()", True), ("random()", True),
+        ("nextval('s.q'::regclass)", True), ("gen_random_uuid()", True), ("public.uuid_generate_v4()", True), ("timeofday()", True)):
+    statement = pg_lock.Statement("ALTER TABLE s.t ADD COLUMN c text DEFAULT %s;" % (default,), server_version=110000)
+    assert statement.rewrite == rewrite and statement.scan == rewrite, default
+assert not pg_lock.Statement("ALTER TABLE s.t ADD COLUMN c integer DEFAULT NULL;", server_version=90600).rewrite
+assert pg_project.parse_version("9.6") == 90600 and pg_project.parse_version("11") == 110000
+update = "ALTER TYPE s.e ADD VALUE 'b';\nDROP INDEX CONCURRENTLY s.i;\nCREATE FUNCTION s.f() RETURNS int AS $$ SELECT 1 $$ LANGUAGE sql;\n"
+assert [st for st, data in pg_project.split_update(update, 110000)] == [False, True]
+assert [st for st, data in pg_project.split_update(update, 120000)] == [True, False, True]
+# new label is used only after ADD VALUE is committed, labels added together
+update = "ALTER TYPE s.e ADD VALUE 'b';\nALTER TYPE s.e ADD VALUE 'c' AFTER 'b';\nCREATE FUNCTION s.f() RETURNS int AS $$ SELECT 1 $$ LANGUAGE sql;\nINSERT INTO s.t (e) VALUES ('b');\n"
+parts = pg_project.split_update(update, 120000)
+assert [st for st, data in parts] == [True, True], parts
+assert "ADD VALUE 'c'" in parts[0][1] and "INSERT" not in parts[0][1] and "CREATE FUNCTION" not in parts[0][1], parts
+assert "INSERT INTO s.t (e) VALUES ('b');" in parts[1][1], parts
+assert [st for st, data in pg_project.split_update(update, 110000)] == [False, True]
+t1 = pg_types.Table("CREATE TABLE s.t (a int);\n", "s.t", ["a int"])
+t2 = pg_types.Table("CREATE TABLE s.t (a int);\n", "s.t", ["a int"])
+t1.indexes = ["INDEX i1 ON s.t USING btree (a)", "weird index"]
+t2.indexes = ["INDEX i2 ON s.t USING btree (a)"]
+out = io.StringIO()
+t1.update_element(out, t2)
+assert "DROP INDEX CONCURRENTLY IF EXISTS s.i1;" in out.getvalue(), out.getvalue()
+assert "CREATE INDEX CONCURRENTLY i2 ON" in out.getvalue(), out.getvalue()
+assert "-- -weird index" in out.getvalue(), out.getvalue()
+PY
+
+py_check "enum labels are added by ADD VALUE, out of transaction for target version before 12" <<'PY'
+from __future__ import unicode_literals
+import io, logging
+logging.verbose = logging.debug
+import pg_types
+class Project:
+    tables = {}
+e1 = pg_types.Enum("CREATE TYPE s.e AS ENUM ('a', 'c');\n", "s.e", ["'a'", "'c'"])
+e2 = pg_types.Enum("CREATE TYPE s.e AS ENUM ('a', 'b', 'c');\n", "s.e", ["'a'", "'b'", "'c'"])
+for version, transactional in ((90600, False), (110000, False), (120000, True), (None, False)):
+    out = io.StringIO()
+    out_nt = io.StringIO()
+    e1.update_enum(out, e2, Project(), version, out_nt)
+    (data, other) = (out, out_nt) if transactional else (out_nt, out)
+    assert "ALTER TYPE s.e ADD VALUE IF NOT EXISTS 'b' AFTER 'a';" in data.getvalue(), (version, data.getvalue())
+    assert "ADD VALUE" not in other.getvalue(), (version, other.getvalue())
+PY
+
+py_check "data changes: keyless duplicates deleted one by one, quoted key quoted once" <<'PY'
+from __future__ import unicode_literals
+import io, logging
+logging.verbose = logging.debug
+import pg_types
+pg_types.DATA_COPY_THRESHOLD = 2
+def project(rows, key):
+    pr = pg_types.Project()
+    table = pg_types.Table("CREATE TABLE s.t (a int);\n", "s.t", [])
+    if key:
+        table.constraints = ['CONSTRAINT t_pkey PRIMARY KEY ("Id")']
+    pr.tables["s.t"] = table
+    pr.table_data = {"s.t": [["Id", "a"]] + rows}
+    return pr
+out = io.StringIO()
+project([["1", "x"]] * 5, False).update_data(out, project([["1", "x"]] * 2, False))
+assert out.getvalue().count("DELETE FROM s.t WHERE ctid = (SELECT ctid FROM s.t WHERE \"Id\" IS NOT DISTINCT FROM '1' AND a IS NOT DISTINCT FROM 'x' LIMIT 1);") == 3, out.getvalue()
+assert "COPY" not in out.getvalue(), out.getvalue()
+out = io.StringIO()
+project([["1", "x"], ["2", "y"]], True).update_data(out, project([["1", "z"], ["3", "w"], ["4", "v"]], True))
+assert "USING pgdist_data_1 d WHERE d.pgdist_op = 'D' AND t.\"Id\" = d.\"Id\";" in out.getvalue(), out.getvalue()
+assert 'ON CONFLICT ("Id") DO UPDATE SET a = EXCLUDED.a;' in out.getvalue(), out.getvalue()
+PY
+
+py_check "template key of requires follows moved branch of require" <<'PY'
+from __future__ import unicode_literals
+import os, shutil, tempfile, subprocess, logging
+logging.verbose = logging.debug
+import pg_project
+directory = tempfile.mkdtemp()
+try:
+    def git(*args):
+        subprocess.check_output(["git", "-c", "user.name=t", "-c", "user.email=t@t", "-C", directory] + list(args))
+    os.mkdir(os.path.join(directory, "sql"))
+    def commit(content):
+        with open(os.path.join(directory, "sql", "pg_project.sql"), "w") as f:
+            f.write("-- name: req\n-- part: 1\n%s" % (content,))
+        git("add", "-A")
+        git("commit", "-q", "-m", "c")
+    git("init", "-q")
+    commit("")
+    # requires are archived from inside of a project
+    os.chdir(directory)
+    class Project:
+        name = "main"
+        requires = [pg_project.Require("req", directory, "HEAD")]
+    key1 = pg_project.requires_key(Project())
+    assert key1 == pg_project.requires_key(Project()), "key is stable"
+    commit("-- changed\n")
+    pg_project.remote_archives.clear()
+    assert pg_project.requires_key(Project()) != key1, "key follows branch"
+finally:
+    shutil.rmtree(directory)
+PY
+
+py_check "targets with the same fingerprint are dumped once, failed target does not stop the others" <<'PY'
+from __future__ import unicode_literals
+import logging, threading
+logging.verbose = logging.debug
+import address, config, pg_conn, pg_project
+dumped = []
+snapshots = []
+lock = threading.Lock()
+class PG:
+    def __init__(self, addr, dbname=None):
+        self.name = addr.addr.split("/")[-1]
+    def database_identity(self):
+        return {"a1": "1:db", "a2": "1:db", "b": "2:db", "c": "3:db", "bad": "4:db"}[self.name]
+    def fingerprint(self, entry_type, table_data=None):
+        return "f"
+    def server_version(self):
+        return 110000
+    def dump_version(self):
+        return "11.22"
+    def export_snapshot(self):
+        with lock:
+            snapshots.append(self.name)
+    def release_snapshot(self):
+        with lock:
+            snapshots.remove(self.name)
+    def dump(self, no_owner, no_acl, cache=False):
+        with lock:
+            dumped.append(self.name)
+        if self.name == "bad":
+            raise pg_conn.PgError(2, "pg_dump", output="dump failed")
+        return "CREATE TABLE t (a %s);\n" % ("text" if self.name == "c" else "int",)
+    def dump_data(self, project, cache=False):
+        return {}
+pg_conn.PG = PG
+class Project:
+    table_data = []
+config.test_db = address.Address("localhost/test")
+pg_project.ProjectFs = Project
+pg_project.load_and_dump = lambda *args, **kwargs: ("CREATE TABLE t (a int);\n", {})
+pg_project.get_server_version = lambda addr: 110000
+diffs = []
+pg_project.print_diff = lambda *args, **kwargs: diffs.append(kwargs["fromfile"])
+addrs = [address.Address("localhost/%s" % (name,)) for name in ("a1", "a2", "b", "c", "bad")]
+pg_project.diff_pg_targets(addrs, None, False, True, False, False, jobs=3)
+assert sorted(dumped) == ["a1", "b", "bad", "c"], dumped
+assert snapshots == [], snapshots
+assert sorted(diffs) == ["localhost/a1", "localhost/c"], diffs
+PY
+
+py_check "pool of test databases: prefix of user, refill flag reset, reap of pooled databases" <<'PY'
+from __future__ import unicode_literals
+import time, logging, threading
+logging.verbose = logging.debug
+import address, config, pg_conn, pg_project
+config.get = lambda key, default=None: {"test_db_pool": "2"}.get(key, default)
+now = time.time()
+class PG(pg_conn.PG):
+    def psql(self, cmd=None, **kwargs):
+        if cmd.startswith("SELECT count(*)"):
+            return (0, "0\n")
+        raise pg_conn.PgError(1, "psql", output="permission denied to create database")
+    def test_databases(self, prefix=pg_conn.TEST_PREFIX):
+        return dict([(name, database) for name, database in databases.items() if name.startswith(prefix)])
+    def drop_database(self, dbname, exit_on_fail=True):
+        dropped.append(dbname)
+        return True
+databases = {
+    "pgdist_pool_bob_0123456789abcdef": (1, {"created": now}, 0),
+    "pgdist_pool_bob_1123456789abcdef": (1, {"created": now - 10}, 0),
+    "pgdist_pool_bob_2123456789abcdef": (1, {"created": now - 20}, 0),
+    "pgdist_pool_bob_3123456789abcdef": (1, {}, 0),
+    "pgdist_pool_bob_x_0123456789abcdef": (1, {}, 0),
+}
+dropped = []
+pg = PG(address.Address("bob@localhost/postgres"))
+assert pg.pool_prefix() == "pgdist_pool_bob_", pg.pool_prefix()
+pg.refill_pool()
+for thread in threading.enumerate():
+    if thread is not threading.current_thread():
+        thread.join()
+assert not pg_conn.refilling, "refilling is reset after fail"
+pg_project.reap_test_dbs(pg, 1)
+assert sorted(dropped) == ["pgdist_pool_bob_2123456789abcdef", "pgdist_pool_bob_3123456789abcdef"], dropped
+del dropped[:]
+pg_project.reap_test_dbs(pg, 0)
+assert len(dropped) == 4 and "pgdist_pool_bob_x_0123456789abcdef" not in dropped, dropped
+PY
+
+py_check "remote dump is parsed directly only with the same version of pg_dump on both sides" <<'PY'
+from __future__ import unicode_literals
+import logging
+logging.verbose = logging.debug
+import address, config, pg_conn, pg_project
+config.test_db = address.Address("localhost/test")
+pg_project.get_server_version = lambda addr: 140005
+versions = {}
+pg_conn.PG.dump_version = lambda self: versions[self.address.addr]
+remote = address.Address("root@server//localhost/db")
+versions.update({"localhost/test": "14.5", remote.addr: "14.5"})
+assert pg_project.direct_remote(remote, False, False, None, None, None)
+versions[remote.addr] = "14.12"
+assert not pg_project.direct_remote(remote, False, False, None, None, None)
+versions[remote.addr] = None
+assert not pg_project.direct_remote(remote, False, False, None, None, None)
+PY
+
+py_check "catalog: older servers, objects not read from catalogs are refused" <<'PY'
+from __future__ import unicode_literals
+import json, logging
+logging.verbose = logging.debug
+import pg_catalog
+query = pg_catalog.catalog_query(90500)
+for text in ("pg_sequence", "relispartition", "pg_get_partkeydef", "proparallel", "pg_init_privs"):
+    assert text not in query, text
+assert "pg_policy" in query and "pg_operator" in query and "pg_aggregate" in query
+catalog = {"schemas": [], "default_acl": [], "extensions": [], "types": [], "functions": [], "relations": [], "unsupported": []}
+catalog["relations"].append({"oid": 1, "name": "public.s", "kind": "S", "persistence": "p", "owner": "u", "options": None, "acl": [], "acldefault": [],
+    "comment": None, "viewdef": None, "partkeydef": None, "inherits": None, "columns": None, "constraints": None, "indexes": None, "triggers": None,
+    "rules": None, "owned_by": None, "identity": False,
+    "sequence": {"type": "bigint", "start": "1", "increment": "1", "min": "1", "max": "9223372036854775807", "cache": "1", "cycle": False}})
+class PG:
+    def __init__(self, version):
+        self.version = version
+    def server_version(self):
+        return self.version
+    def psql(self, cmd=None, **kwargs):
+        return (0, (pg_catalog.CATALOG_MARK + json.dumps(catalog)).encode("utf8"))
+project = pg_catalog.load_project(PG(90500))
+assert "NO MAXVALUE" in project.sequences["public.s"].command, project.sequences["public.s"].command
+catalog["unsupported"].append({"name": "operator public.===(integer,integer)"})
+for version in (90300, 120000):
+    try:
+        pg_catalog.load_project(PG(version))
+        assert False, "not refused"
+    except SystemExit:
+        pass
+PY
+
+py_check "backfill: key of primary key quoted once, explicit key kept, table without key refused" <<'PY'
+from __future__ import unicode_literals
+import logging
+logging.verbose = logging.debug
+import pg_project, pg_types
+pr = pg_types.Project()
+table = pg_types.Table("CREATE TABLE s.t (a int);\n", "s.t", [])
+table.constraints = ['CONSTRAINT t_pkey PRIMARY KEY ("Id")']
+pr.tables["s.t"] = table
+pr.tables["public.k"] = pg_types.Table("CREATE TABLE public.k (a int);\n", "public.k", [])
+(header, command) = pg_project.get_backfill("s.t SET a = 1 WHERE a IS NULL;", pr, 500)
+assert header == 's.t "Id" 500', header
+assert command == "UPDATE s.t SET a = 1 WHERE a IS NULL;\n", command
+(header, command) = pg_project.get_backfill("k(a) SET a = a + 1", pr, 10)
+assert header == "public.k a 10", header
+# quoted identifiers with spaces
+(header, command) = pg_project.get_backfill('s."my ""t"" (1)"("my key") SET a = 1', pr, 10)
+assert header == 's."my ""t"" (1)" "my key" 10', header
+assert command == 'UPDATE s."my ""t"" (1)" SET a = 1;\n', command
+for backfill in ("k SET a = 1", "s.t a = 1"):
+    try:
+        pg_project.get_backfill(backfill, pr, 10)
+        assert False, backfill
+    except SystemExit:
+        pass
+PY
+
+py_check "analyze-update: statements ranked by lock held until end of transaction, lines of part file" <<'PY'
+from __future__ import unicode_literals
+import io, os, sys, shutil, tempfile, logging
+logging.verbose = logging.debug
+import pg_conn, pg_project
+directory = tempfile.mkdtemp()
+try:
+    os.makedirs(os.path.join(directory, "sql_dist"))
+    os.mkdir(os.path.join(directory, "sql"))
+    io.open(os.path.join(directory, "sql", "pg_project.sql"), "w").write("-- name: proj\n")
+    os.chdir(directory)
+    part = pg_project.UpdatePart(1, os.path.join(directory, "sql_dist", "proj--1.0--1.1.sql"), new=True)
+    part.data = "CREATE FUNCTION s.f() RETURNS int AS $$ SELECT 1 $$ LANGUAGE sql;\nALTER TABLE s.small ALTER COLUMN a TYPE bigint;\n\nALTER TABLE s.big ALTER COLUMN a TYPE bigint;\n"
+    part.save_conf("proj", "1.0", "1.1")
+    class ProjectFs:
+        name = "proj"
+    class PG:
+        def __init__(self, addr):
+            pass
+        def server_version(self):
+            return 110000
+        def table_sizes(self):
+            return {"s.big": (1000000, 50000000), "s.small": (10, 100)}
+    pg_project.ProjectFs = ProjectFs
+    pg_conn.PG = PG
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        pg_project.analyze_update("1.0", "1.1", None)
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    rows = [[column.strip() for column in line.split("|")] for line in output.splitlines()[2:] if "|" in line]
+    content = io.open(part.fname).read().splitlines()
+    for row in rows:
+        assert content[int(row[0].split(":")[1]) - 1].startswith(row[10][:20]), (row, output)
+    # lock of the small table is held until the end of transaction, after rewrite of the big one
+    assert sorted(row[5] for row in rows[:2]) == ["s.big", "s.small"] and rows[2][5] == "", output
+    small = [row for row in rows if row[5] == "s.small"][0]
+    assert small[1] == "ACCESS EXCLUSIVE" and small[3] == "yes" and small[8] == "< 1s" and small[9] == "3m 54s", output
+finally:
+    shutil.rmtree(directory)
+PY
+
+py_check "squash: chain of single transaction updates joined in order, other parts refused" <<'PY'
+from __future__ import unicode_literals
+import io, os, shutil, tempfile, logging
+logging.verbose = logging.debug
+import pg_project
+directory = tempfile.mkdtemp()
+try:
+    os.makedirs(os.path.join(directory, "sql_dist"))
+    os.mkdir(os.path.join(directory, "sql"))
+    io.open(os.path.join(directory, "sql", "pg_project.sql"), "w").write("-- name: proj\n")
+    os.chdir(directory)
+    def update(old_version, new_version, data, number=None, single_transaction=True):
+        if number:
+            fname = "proj--%s--%s--p%02d.sql" % (old_version, new_version, number)
+        else:
+            fname = "proj--%s--%s.sql" % (old_version, new_version)
+        part = pg_project.UpdatePart(number or 1, os.path.join(directory, "sql_dist", fname), single_transaction, new=True)
+        part.data = data
+        part.save_conf("proj", old_version, new_version)
+    update("1.0", "1.1", "CREATE TABLE s.a (x int);\n")
+    update("1.1", "1.2", "CREATE TABLE s.b (x int);\n", 1)
+    update("1.1", "1.2", "CREATE TABLE s.c (x int);\n", 2)
+    update("1.2", "1.3", "CREATE TABLE s.d (x int);\n")
+    class ProjectFs:
+        name = "proj"
+        roles = []
+        requires = []
+    ProjectFs.directory = directory
+    pg_project.ProjectFs = ProjectFs
+    pg_project.squash_updates("v1.0", "1.2", False, test=False)
+    squashed = pg_project.Update("proj", "1.0", "1.2")
+    assert len(squashed.parts) == 1 and squashed.parts[0].squashed == ["1.0", "1.1", "1.2"], squashed.parts
+    data = squashed.parts[0].data
+    assert data.index("s.a") < data.index("s.b") < data.index("s.c") and "s.d" not in data, data
+    try:
+        pg_project.squash_updates("v1.0", "1.2", False, test=False)
+        assert False, "squashed update is overwritten only by force"
+    except SystemExit:
+        pass
+    update("1.2", "1.3", "CREATE INDEX CONCURRENTLY i ON s.d (x);\n", single_transaction=False)
+    try:
+        pg_project.squash_updates("v1.1", "1.3", True, test=False)
+        assert False, "not single transaction part is squashed"
+    except SystemExit:
+        pass
+    # own transaction control would commit squashed chain halfway, BEGIN of function body is allowed
+    update("1.3", "1.4", "CREATE FUNCTION s.f() RETURNS void AS $$ BEGIN\n  PERFORM 1;\nEND; $$ LANGUAGE plpgsql;\n")
+    update("1.4", "1.5", "CREATE TABLE s.f (x int);\n")
+    update("1.5", "1.6", "CREATE TABLE s.e (x int);\n-- end of transaction\nCOMMIT;\n")
+    pg_project.squash_updates("v1.3", "1.5", False, test=False)
+    try:
+        pg_project.squash_updates("v1.3", "1.6", False, test=False)
+        assert False, "part with COMMIT is squashed"
+    except SystemExit:
+        pass
+finally:
+    shutil.rmtree(directory)
+PY
+
+py_check "ssh: one master connection per target, tunnel to postgres host through the master" <<'PY'
+from __future__ import unicode_literals
+import io, os, shutil, tempfile, logging
+logging.verbose = logging.debug
+import address
+bindir = tempfile.mkdtemp()
+try:
+    # ssh of test logs its arguments
+    log = os.path.join(bindir, "ssh.log")
+    with io.open(os.path.join(bindir, "ssh"), "w") as f:
+        f.write("#!/bin/sh\necho \"$@\" >> %s\n" % (log,))
+    os.chmod(os.path.join(bindir, "ssh"), 0o755)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+    a1 = address.Address("user@server:2222//pg:secret@db.local/mydb?sslmode=require")
+    a2 = address.Address("user@server:2222//pg@db.local/other")
+    a3 = address.Address("user@server//pg@/mydb")
+    args = a1.ssh_command()
+    assert args[:6] == ["ssh", "-o", "ControlMaster=auto", "-o", args[4], "-o"] and args[4].startswith("ControlPath="), args
+    assert args[-3:] == ["-p", "2222", "user@server"], args
+    assert a2.ssh_command() == args, "one master per ssh target"
+    assert a3.ssh_command()[4] != args[4], "other port, other master"
+    tunnel = a1.tunnel()
+    assert tunnel.get_host() == "127.0.0.1" and tunnel.get_user() == "pg" and tunnel.get_password() == "secret", tunnel.addr
+    assert tunnel.get_dbname() == "mydb" and tunnel.get_param() == "sslmode=require" and not tunnel.ssh, tunnel.addr
+    assert a1.tunnel() is tunnel
+    calls = io.open(log).read().splitlines()
+    assert calls[-1].endswith("-O forward -L 127.0.0.1:%s:db.local:5432 user@server" % (tunnel.get_port(),)), calls
+    assert a3.tunnel() is None, "postgres without host is reached by socket on ssh server"
+    control_dir = address.control_dir
+    address.close_masters()
+    assert not os.path.exists(control_dir) and not address.masters
+    assert "-O exit user@server" in io.open(log).read()
+finally:
+    shutil.rmtree(bindir)
+PY
+
+py_check "ssh: COPY output compressed on remote side, exit code of remote psql kept" <<'PY'
+from __future__ import unicode_literals
+import io, os, shutil, tempfile, logging
+logging.verbose = logging.debug
+import address, pg_conn
+bindir = tempfile.mkdtemp()
+try:
+    # ssh of test runs the remote command locally, psql prints rows
+    with io.open(os.path.join(bindir, "ssh"), "w") as f:
+        f.write("#!/bin/sh\nwhile [ $# -gt 1 ]; do shift; done\nexec sh -c \"$1\"\n")
+    with io.open(os.path.join(bindir, "psql"), "w") as f:
+        f.write("#!/bin/sh\ncat > /dev/null\nseq 1 100\n[ \"$PSQL_RC\" = 0 ] || echo 'ERROR: copy failed' >&2\nexit $PSQL_RC\n")
+    for name in ("ssh", "psql"):
+        os.chmod(os.path.join(bindir, name), 0o755)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+    addr = address.Address("server//pg@/db")
+    assert addr.compressor() in ("zstd", "gzip"), addr.compress
+    os.environ["PSQL_RC"] = "0"
+    (retcode, output) = pg_conn.PG(addr).psql(cmd="COPY s.t TO STDOUT;", tuples_only=True)
+    assert retcode == 0 and output.split() == [str(i) for i in range(1, 101)], (retcode, output)
+    os.environ["PSQL_RC"] = "3"
+    (retcode, output) = pg_conn.PG(addr).psql(cmd="COPY s.t TO STDOUT;", tuples_only=True, exit_on_fail=False)
+    assert retcode == 3 and "PGDIST_RETCODE" not in output, (retcode, output)
+    try:
+        pg_conn.PG(addr).psql(cmd="COPY s.t TO STDOUT;", tuples_only=True)
+        assert False, "failed remote psql"
+    except pg_conn.PgError as e:
+        assert e.returncode == 3 and len(e.output.split("\n")) <= pg_conn.TAIL_LINES and "ERROR: copy failed" in e.output, e.output
+finally:
+    shutil.rmtree(bindir)
+PY
+
+py_check "table data streamed to COPY FROM STDIN, table failing on foreign key loaded again" <<'PY'
+from __future__ import unicode_literals
+import io, os, glob, shutil, tempfile, logging
+logging.verbose = logging.debug
+import address, pg_conn, pg_types
+def rows(count, read):
+    for i in range(count):
+        read.append(i)
+        yield ["%d" % (i,), None if i % 2 else "a;\"b\""]
+read = []
+stream = pg_conn.CsvStream(rows(1000, read))
+data = stream.read(10)
+assert len(data) == 10 and len(read) < 5, "rows are formatted when they are read"
+while True:
+    chunk = stream.read(7)
+    if not chunk:
+        break
+    data += chunk
+assert data == pg_conn.CsvStream(rows(1000, [])).read(), "reads of any size give the same data"
+assert data.startswith(b'0;"a;""b"""\r\n1;%s\r\n' % (pg_types.NULL_MARKER.encode("utf8"),)), data[:40]
+bindir = tempfile.mkdtemp()
+try:
+    # psql of test keeps its input, first COPY of child fails on foreign key
+    with io.open(os.path.join(bindir, "psql"), "w") as f:
+        f.write("#!/bin/sh\nd=$(dirname $0)\nf=$(mktemp $d/in.XXXXXX)\ncat > $f\n"
+            "if grep -q 'COPY s.child' $f && [ ! -f $d/fk ]; then touch $d/fk; echo 'ERROR:  insert or update on table \"child\" violates foreign key constraint'; exit 3; fi\n")
+    os.chmod(os.path.join(bindir, "psql"), 0o755)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+    class Table:
+        def __init__(self, table_name):
+            self.table_name = table_name
+    class Project:
+        table_data = [Table("s.parent"), Table("s.child")]
+    table_data = {"s.parent": [["id"], ["1"], ["2"]], "s.child": [["id", "parent"], ["1", "2"]]}
+    pg_conn.PG(address.Address("pg@/db"), "db").load_data(Project(), table_data)
+    inputs = [io.open(fname, "rb").read() for fname in sorted(glob.glob(os.path.join(bindir, "in.*")), key=os.path.getmtime)]
+    assert len(inputs) == 3 and inputs[-1].startswith(b"COPY s.child (id, parent) FROM STDIN"), inputs
+    assert [i for i in inputs if i.startswith(b"COPY s.parent (id) FROM STDIN")][0].endswith(b"\n1\r\n2\r\n\\.\n"), inputs
+finally:
+    shutil.rmtree(bindir)
+PY
+
+py_check "psql output: tail in memory, whole output in psql log, failed line of script without echo" <<'PY'
+from __future__ import unicode_literals
+import io, os, shutil, tempfile, logging
+logging.verbose = logging.debug
+import address, config, pg_conn
+bindir = tempfile.mkdtemp()
+try:
+    # psql of test prints long output and reports error on line 60 of its input
+    with io.open(os.path.join(bindir, "psql"), "w") as f:
+        f.write("#!/bin/sh\necho \"$@\" > $(dirname $0)/args\ncat > /dev/null\nseq 1 200\necho 'psql:<stdin>:60: ERROR:  division by zero'\nexit 3\n")
+    os.chmod(os.path.join(bindir, "psql"), 0o755)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+    config.echo_queries = False
+    config.psql_log = os.path.join(bindir, "psql.log")
+    script = "".join("SELECT %d;\n" % (i,) for i in range(1, 59)) + "SELECT 1 /\n0;\n"
+    try:
+        pg_conn.PG(address.Address("pg@/db")).psql(cmd=script)
+        assert False, "failed psql"
+    except pg_conn.PgError as e:
+        (output, context) = e.output.split("\n-- <stdin>, lines 51-60:\n")
+        assert len(output.split("\n")) <= pg_conn.TAIL_LINES and "200\npsql:<stdin>:60: ERROR:" in output, output
+        assert context.split("\n")[:10] == ["SELECT %d;" % (i,) for i in range(51, 59)] + ["SELECT 1 /", "0;"], context
+    assert "--echo-queries" not in io.open(os.path.join(bindir, "args")).read()
+    log = io.open(config.psql_log).read()
+    assert log.startswith("1\n2\n") and log.count("\n") == 201, log[:20]
+finally:
+    shutil.rmtree(bindir)
+PY
+
+py_check "cache: entries keyed by target, type and params, expired by ttl, least recently used evicted" <<'PY'
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import io, os, json, time, shutil, tempfile, binascii, logging
+logging.verbose = logging.debug
+import address, config, dump_cache
+directory = tempfile.mkdtemp()
+try:
+    config.get = lambda key, default=None: {"cache_dir": directory, "cache_ttl_struct": "60", "cache_size": "1"}.get(key, default)
+    a1 = address.Address("pg@host1/db")
+    a2 = address.Address("pg@host2/db")
+    dump_cache.put(a1, "struct", "CREATE TABLE ž;", [False, False])
+    assert dump_cache.get(a1, "struct", [False, False]) == "CREATE TABLE ž;"
+    assert dump_cache.get(a1, "struct", [True, False]) is None and dump_cache.get(a2, "struct", [False, False]) is None
+    assert dump_cache.get(a1, "roles", [False, False]) is None
+    # entry older than ttl of its type
+    meta = dump_cache.entry_file(a1, "struct", [False, False]) + ".json"
+    with io.open(meta, encoding="utf8") as f:
+        content = json.load(f)
+    content["created"] -= 61
+    with io.open(meta, "wb") as f:
+        f.write(json.dumps(content))
+    assert dump_cache.get(a1, "struct", [False, False]) is None
+    # about 0.4 MB of every entry, limit is 1 MB
+    for name in ("a", "b"):
+        dump_cache.put(address.Address("pg@%s/db" % (name,)), "roles", binascii.hexlify(os.urandom(400000)))
+        time.sleep(0.01)
+    assert dump_cache.get(address.Address("pg@a/db"), "roles") is not None
+    dump_cache.put(address.Address("pg@c/db"), "roles", binascii.hexlify(os.urandom(400000)))
+    assert sorted(entry.addr for entry in dump_cache.entries()) == ["pg@a/db", "pg@c/db"], "expired entry and entry not used recently are removed"
+    assert len(dump_cache.prune(True)) == 2 and not dump_cache.entries()
+    assert not [name for name in os.listdir(directory) if name.startswith(".tmp-")]
+finally:
+    shutil.rmtree(directory)
+PY
+
+py_check "cache: dump is valid while fingerprint of catalogs matches, also after ttl of its type" <<'PY'
+from __future__ import unicode_literals
+import io, json, shutil, tempfile, logging
+logging.verbose = logging.debug
+import address, config, dump_cache, pg_conn
+directory = tempfile.mkdtemp()
+try:
+    config.get = lambda key, default=None: {"cache_dir": directory, "cache_ttl_struct": "60", "cache_ttl_fingerprint": "600"}.get(key, default)
+    class PG(pg_conn.PG):
+        def fingerprint(self, entry_type, table_data=None):
+            return fingerprints[0]
+        def pg_dump(self, change_db=False, no_owner=False, no_acl=False):
+            dumps.append(fingerprints[0])
+            return (0, b"-- dump %s\n" % (fingerprints[0].encode("utf8"),))
+    fingerprints = ["f1"]
+    dumps = []
+    pg = PG(address.Address("pg@host/db"))
+    assert pg.dump(cache=True) == pg.dump(cache=True) == "-- dump f1\n" and dumps == ["f1"], dumps
+    # older than ttl of struct, fingerprint is the same
+    meta = dump_cache.entry_file(pg.address, "struct", [False, False]) + ".json"
+    with io.open(meta, encoding="utf8") as f:
+        content = json.load(f)
+    content["created"] -= 120
+    with io.open(meta, "wb") as f:
+        f.write(json.dumps(content))
+    assert pg.dump(cache=True) == "-- dump f1\n" and dumps == ["f1"], dumps
+    fingerprints[0] = "f2"
+    assert pg.dump(cache=True) == "-- dump f2\n" and dumps == ["f1", "f2"], dumps
+    # fingerprint cannot be read, entry is valid by age
+    fingerprints[0] = None
+    assert dump_cache.get(pg.address, "struct", [False, False], None) == "-- dump f2\n"
+    # entry with fingerprint older than fingerprint ttl
+    with io.open(meta, encoding="utf8") as f:
+        content = json.load(f)
+    assert content["fingerprint"] == "f2", content
+    content["created"] -= 601
+    with io.open(meta, "wb") as f:
+        f.write(json.dumps(content))
+    assert dump_cache.get(pg.address, "struct", [False, False], "f2") is None
+finally:
+    shutil.rmtree(directory)
+PY
+
+py_check "snapshots: project and data restored, objects shared by snapshots, removed with last snapshot" <<'PY'
+from __future__ import unicode_literals
+import io, os, sys, shutil, tempfile, logging
+logging.verbose = logging.debug
+import address, config, pg_parser, pg_project, pg_snapshot
+directory = tempfile.mkdtemp()
+try:
+    config.get = lambda key, default=None: {"snapshot_dir": directory}.get(key, default)
+    dump = "CREATE SCHEMA s;\n\nCREATE TABLE s.t (\n    a integer,\n    b text\n);\n\nCREATE FUNCTION s.f() RETURNS integer\n    LANGUAGE sql\n    AS $$ SELECT 1 $$;\n"
+    addr = address.Address("pg@host/db")
+    data = {"s.t": [["a", "b"], ["1", "x"]]}
+    pg_snapshot.save("one", addr, pg_parser.parse(io.StringIO(dump)), data, False, False)
+    count = len(pg_snapshot.objects())
+    pg_snapshot.save("two", addr, pg_parser.parse(io.StringIO(dump.replace("b text", "b varchar"))), data, False, False)
+    assert len(pg_snapshot.objects()) == count + 1, "only changed table is stored again"
+    try:
+        pg_snapshot.save("one", addr, pg_parser.parse(io.StringIO(dump)), data, False, False)
+        assert False, "snapshot is overwritten"
+    except SystemExit:
+        pass
+    manifest, pr = pg_snapshot.load("one")
+    assert sorted(pr.tables) == ["s.t"] and sorted(pr.functions) == ["s.f[]"] and pr.table_data == data, pr.table_data
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        pg_project.snapshot_diff("one", "one", True, False, False)
+        same = sys.stdout.getvalue()
+        sys.stdout.truncate(0)
+        pg_project.snapshot_diff("one", "two", True, False, False)
+        changed = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    assert same == "-- one (-) and one (+)\n", same
+    assert "-b text" in changed and "+b varchar" in changed, changed
+    assert pg_snapshot.remove("one") == 1 and len(pg_snapshot.objects()) == count
+    pg_snapshot.remove("two")
+    assert not pg_snapshot.objects() and not pg_snapshot.manifests()
+finally:
+    shutil.rmtree(directory)
+PY
+
+py_check "pipelines: run in parallel, failure of one cancels the others and terminates their backends" <<'PY'
+from __future__ import unicode_literals
+import io, sys, time, threading, logging
+logging.verbose = logging.debug
+import address, config, pg_conn, pg_project
+terminated = []
+class PG:
+    def __init__(self, addr, dbname=None):
+        pass
+    def terminate_backends(self, dbname):
+        terminated.append(dbname)
+pg_conn.PG = PG
+config.test_db = address.Address("pg@/postgres")
+started = threading.Event()
+def load(name, wait):
+    pg_project.progress("load %s" % (name,))
+    if wait:
+        started.set()
+    else:
+        assert started.wait(10), "pipelines run in parallel"
+    return name
+stderr = sys.stderr
+sys.stderr = io.StringIO()
+try:
+    assert pg_project.run_pipelines([("old", load, ["1.0", True], {}), ("new", load, ["1.1", False], {})]) == ["1.0", "1.1"]
+    progress = sys.stderr.getvalue()
+finally:
+    sys.stderr = stderr
+assert sorted(progress.splitlines()) == ["[new] load 1.1", "[old] load 1.0"], progress
+outcome = []
+def slow():
+    pg_project.running_dbs.add("pgdist_test_slow")
+    try:
+        for i in range(1000):
+            pg_project.check_cancelled()
+            time.sleep(0.01)
+    except pg_conn.PgError as e:
+        outcome.append(e.output)
+        raise SystemExit(1)
+    finally:
+        pg_project.running_dbs.discard("pgdist_test_slow")
+def fail():
+    while "pgdist_test_slow" not in pg_project.running_dbs:
+        time.sleep(0.01)
+    sys.exit(1)
+try:
+    pg_project.run_pipelines([("old", slow, [], {}), ("new", fail, [], {})])
+    assert False, "failed pipeline"
+except SystemExit:
+    pass
+assert outcome == ["cancelled"] and terminated == ["pgdist_test_slow"], (outcome, terminated)
+PY
+
+py_check "pipelines: sequential mode stops after failure, remote structure dumped while tables are copied" <<'PY'
+from __future__ import unicode_literals
+import sys, threading, logging
+logging.verbose = logging.debug
+import address, pg_conn, pg_project
+order = []
+def step(name, fail=False):
+    order.append(name)
+    if fail:
+        sys.exit(1)
+    return name
+assert pg_project.run_pipelines([("a", step, ["a"], {}), ("b", step, ["b"], {})], parallel=False) == ["a", "b"]
+try:
+    pg_project.run_pipelines([("c", step, ["c", True], {}), ("d", step, ["d"], {})], parallel=False)
+    assert False, "failed pipeline"
+except SystemExit:
+    pass
+assert order == ["a", "b", "c"], order
+released = []
+copying = threading.Event()
+class PG:
+    def __init__(self, addr, dbname=None):
+        self.address = addr
+    def export_snapshot(self):
+        return "snapshot-1"
+    def release_snapshot(self):
+        released.append(True)
+    def dump(self, no_owner=False, no_acl=False, cache=False):
+        assert copying.wait(10), "pg_dump runs while tables are copied"
+        if self.address.addr == "fail":
+            raise pg_conn.PgError(1, "pg_dump", output="pg_dump: error")
+        return "-- dump"
+    def dump_data(self, project, cache=False):
+        copying.set()
+        if self.address.addr == "fail-data":
+            raise pg_conn.PgError(1, "COPY", output="COPY: error")
+        return {"s.t": [["a"], ["1"]]}
+pg_conn.PG = PG
+assert pg_project.dump_remote_and_data(None, address.Address("ok"), False, False, False) == ("-- dump", {"s.t": [["a"], ["1"]]})
+for addr in ("fail", "fail-data"):
+    try:
+        pg_project.dump_remote_and_data(None, address.Address(addr), False, False, False)
+        assert False, "failed dump of %s" % (addr,)
+    except SystemExit:
+        pass
+assert released == [True, True, True], "snapshot is released also after fail"
+PY
+
+py_check "test databases: dropped in background, forced drop by server version, reap of old ones" <<'PY'
+from __future__ import unicode_literals
+import atexit, io, os, shutil, tempfile, time, logging
+logging.verbose = logging.debug
+import address, config, pg_conn, pg_project
+config.get = lambda key, default=None: default
+commands = []
+class PG(pg_conn.PG):
+    version = 130000
+    def server_version(self):
+        return self.version
+    def psql(self, cmd=None, single_transaction=True, change_db=False, file=None, cwd=None, tuples_only=False, exit_on_fail=True):
+        commands.append(cmd)
+        return (0, output)
+output = ""
+pg = PG(address.Address("pg@/postgres"))
+pg.drop_database("pgdist_test_x")
+assert commands == ["DROP DATABASE IF EXISTS pgdist_test_x WITH (FORCE);"], commands
+del commands[:]
+pg.version = 120000
+pg.drop_database("pgdist_test_x")
+assert "pg_terminate_backend" in commands[0] and commands[1] == "DROP DATABASE IF EXISTS pgdist_test_x;", commands
+# drop by detached psql, command goes on and does not wait for it at exit
+bindir = tempfile.mkdtemp()
+try:
+    log = os.path.join(bindir, "psql.log")
+    for name, script in (("psql", "sleep 1; echo \"$@\" >> %s\n" % (log,)), ("ssh", "echo \"$@\" >> %s\n" % (log,))):
+        with io.open(os.path.join(bindir, name), "w") as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(os.path.join(bindir, name), 0o755)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+    class DropPG(pg_conn.PG):
+        def server_version(self):
+            return 130000
+    start = time.time()
+    DropPG(address.Address("pg@/postgres"), "pgdist_test_y").clean(background=True)
+    assert time.time() - start < 0.5 and "pgdist_test_y" in pg_conn.cleanups and not os.path.exists(log)
+    assert pg_conn.wait_cleanups not in [f for f, args, kwargs in atexit._exithandlers]
+    pg_conn.wait_cleanups("pgdist_test_y")
+    assert not pg_conn.cleanups
+    assert io.open(log).read().strip().endswith("--command DROP DATABASE IF EXISTS pgdist_test_y WITH (FORCE);"), io.open(log).read()
+    # remote psql is started in background on ssh server
+    os.remove(log)
+    DropPG(address.Address("user@server//pg@/postgres"), "pgdist_test_z").clean(background=True)
+    pg_conn.wait_cleanups()
+    remote = io.open(log).read().strip()
+    assert remote.endswith("'--command' 'DROP DATABASE IF EXISTS pgdist_test_z WITH (FORCE);' >/dev/null 2>&1 &") and "nohup 'psql'" in remote, remote
+    address.close_masters()
+finally:
+    shutil.rmtree(bindir)
+# name|size|connections|comment of test databases
+prefix = pg_project.test_db_prefix()
+now = time.time()
+output = "\n".join([
+    "%sold|100|0|{\"created\": %d}" % (prefix, now - 5 * 3600),
+    "%snew|100|0|{\"created\": %d}" % (prefix, now - 600),
+    "%sconnected|100|1|" % (prefix,),
+    "%sunused|100|0|" % (prefix,),
+    "%srunning|100|0|{\"created\": %d}" % (prefix, now - 5 * 3600),
+])
+class ReapPG(PG):
+    def pooled_databases(self):
+        return {}
+    def drop_database(self, dbname, exit_on_fail=True):
+        return True
+pg_project.running_dbs.add("%srunning" % (prefix,))
+dropped = pg_project.reap_test_dbs(ReapPG(address.Address("pg@/postgres")), 1)
+pg_project.running_dbs.clear()
+assert sorted(dropped) == [("%sold" % (prefix,), 100), ("%sunused" % (prefix,), 100)], dropped
+PY
+
+py_check "local test_db: cluster initialized once, started on first use, stopped after idle timeout" <<'PY'
+from __future__ import unicode_literals
+import io, os, time, atexit, shutil, getpass, tempfile, logging
+logging.verbose = logging.debug
+import config, local_cluster
+directory = tempfile.mkdtemp()
+# removed after use of cluster is recorded at exit
+atexit.register(shutil.rmtree, directory, True)
+bindir = tempfile.mkdtemp()
+try:
+    # initdb, pg_ctl and psql of test keep state of cluster in files
+    scripts = {
+        "initdb": "while [ $# -gt 0 ]; do [ \"$1\" = -D ] && mkdir -p \"$2\" && echo 12 > \"$2/PG_VERSION\"; shift; done\n",
+        "pg_ctl": "case \"$1\" in status) [ -f $d/running ];; start) touch $d/running;; stop) rm -f $d/running;; esac\n",
+        "psql": "echo 0\n",
+    }
+    for name, script in scripts.items():
+        with io.open(os.path.join(bindir, name), "w") as f:
+            f.write("#!/bin/sh\nd=$(dirname $0)\necho \"%s $*\" >> $d/calls\n%s" % (name, script))
+        os.chmod(os.path.join(bindir, name), 0o755)
+    config.get = lambda key, default=None: {"test_db_local_dir": directory, "test_db_local_bindir": bindir, "test_db_local_idle": "1"}.get(key, default)
+    addr = local_cluster.LocalAddress()
+    assert addr.get_host() == directory.replace("/", "%2F") and addr.get_port() == "5432" and addr.get_user() == getpass.getuser(), addr.addr
+    assert addr.get_pg("pgdist_test_x").endswith("/pgdist_test_x")
+    local_cluster.LocalAddress().get_pg()
+    calls = io.open(os.path.join(bindir, "calls")).read().splitlines()
+    assert [call.split()[0:2] for call in calls] == [["pg_ctl", "status"], ["initdb", "-N"], ["pg_ctl", "start"], ["pg_ctl", "status"]], calls
+    assert "unix_socket_directories=%s" % (directory,) in calls[2] and "fsync=off" in calls[2], calls[2]
+    # user running pgdist is superuser of the cluster
+    assert " -U %s " % (getpass.getuser(),) in calls[1], calls[1]
+    assert os.path.isfile(os.path.join(directory, "watch.pid"))
+    # watch process stops idle cluster and removes its data
+    for i in range(100):
+        if not os.path.isfile(os.path.join(directory, "watch.pid")):
+            break
+        time.sleep(0.1)
+    assert not os.path.exists(os.path.join(bindir, "running")) and not os.path.exists(local_cluster.data_dir(directory)), io.open(os.path.join(bindir, "calls")).read()
+finally:
+    shutil.rmtree(bindir)
+PY
+
+py_check "test databases: unique names up to 63 characters, least loaded test_db, wait for load slot" <<'PY'
+from __future__ import unicode_literals
+import io, os, sys, tempfile, logging
+logging.verbose = logging.debug
+import address, config, pg_conn, pg_project
+config.get = lambda key, default=None: {"test_db_max_loads": "2"}.get(key, default)
+name = pg_project.get_test_dbname("proj")
+assert name == "%sproj_%s" % (pg_project.test_db_prefix(), pg_project.run_id), name
+long1 = pg_project.get_test_dbname("p" * 80, "1")
+long2 = pg_project.get_test_dbname("p" * 80, "2")
+assert len(long1) == len(long2) == 63 and long1 != long2 and long1.endswith(pg_project.run_id), (long1, long2)
+(fd, fname) = tempfile.mkstemp()
+with os.fdopen(fd, "w") as f:
+    f.write("[pgdist]\ntest_db: pg@host1/postgres, pg@host2/postgres\n     pg@host3/postgres\n")
+config.load_file(fname)
+os.remove(fname)
+assert [addr.addr for addr in config.test_dbs] == ["pg@host1/postgres", "pg@host2/postgres", "pg@host3/postgres"]
+counts = {"pg@host1/postgres": (2, 5), "pg@host2/postgres": None, "pg@host3/postgres": (1, 9)}
+pg_conn.load_counts = lambda addr: counts[addr.addr]
+pg_project.select_test_db()
+assert config.test_db.addr == "pg@host3/postgres", "the least loaded reachable server"
+events = []
+class LoadSlot:
+    def __init__(self, addr, max_loads):
+        self.tries = 0
+        events.append(("slots", max_loads))
+    def acquire(self):
+        self.tries += 1
+        return self.tries > 2
+    def release(self):
+        events.append("release")
+pg_conn.LoadSlot = LoadSlot
+pg = pg_conn.PG(config.test_db, name)
+stderr = sys.stderr
+sys.stderr = io.StringIO()
+try:
+    pg_project.start_load(pg)
+    waiting = sys.stderr.getvalue()
+finally:
+    sys.stderr = stderr
+assert waiting == "wait for free load slot of test pg (test_db_max_loads 2)\n", waiting
+assert name in pg_project.running_dbs and pg_project.load_slots[name].tries == 3
+pg_project.end_load(pg)
+assert events == [("slots", 2), "release"] and name not in pg_project.running_dbs and not pg_project.load_slots, events
+PY
+
+py_check "fingerprint: catalogs of operators, casts and text search included, data only with track_counts" <<'PY'
+from __future__ import unicode_literals
+import hashlib, re, logging
+logging.verbose = logging.debug
+import address, pg_conn
+catalog = {"pg_class": "700", "pg_operator": "701", "pg_cast": "702", "pg_ts_config_map": "703"}
+settings = {"track_counts": "on"}
+class PG(pg_conn.PG):
+    def server_version(self):
+        return 120000
+    def psql(self, cmd=None, change_db=False, tuples_only=False, **kwargs):
+        if cmd.startswith("SHOW "):
+            return (0, settings[cmd[5:].rstrip(";")] + "\n")
+        # catalogs read by the query with xmin of their rows
+        names = re.findall(r"FROM pg_catalog\.(\w+)", cmd)
+        rows = ["%s:%s" % (name, catalog.get(name, "1")) for name in names]
+        return (0, hashlib.md5(",".join(rows).encode("utf8")).hexdigest() + "\n")
+class Table(object):
+    table_name = "public.t"
+pg = PG(address.Address("pg@host/db"))
+struct = pg.fingerprint("struct")
+for name in ("pg_operator", "pg_aggregate", "pg_opclass", "pg_opfamily", "pg_cast", "pg_collation", "pg_ts_config", "pg_ts_config_map", "pg_ts_dict", "pg_ts_parser", "pg_ts_template"):
+    assert name in [c[0] for c in pg_conn.FINGERPRINT_CATALOGS], name
+# CREATE OPERATOR changes xmin of pg_operator
+catalog["pg_operator"] = "801"
+assert pg.fingerprint("struct") != struct
+struct = pg.fingerprint("struct")
+catalog["pg_cast"] = "802"
+assert pg.fingerprint("struct") != struct
+data = pg.fingerprint("data", [Table()])
+assert data and data != pg.fingerprint("struct")
+# counters of rows are not changed without track_counts
+settings["track_counts"] = "off"
+assert pg.fingerprint("data", [Table()]) is None
+assert pg.fingerprint("struct")
+PY
+
+py_check "locks: relation of dropped or altered index, view and sequence, database wide vacuum" <<'PY'
+from __future__ import unicode_literals
+import io, logging
+logging.verbose = logging.debug
+import pg_lock, pg_project
+for command, relation in (
+        ("DROP INDEX s.i;", "s.i"),
+        ("DROP INDEX IF EXISTS s.i CASCADE;", "s.i"),
+        ("ALTER INDEX s.i RENAME TO j;", "s.i"),
+        ("DROP VIEW IF EXISTS s.v, s.w;", "s.v"),
+        ("ALTER VIEW v OWNER TO r;", "public.v"),
+        ("DROP MATERIALIZED VIEW s.m;", "s.m"),
+        ("ALTER SEQUENCE s.q RESTART;", "s.q"),
+        ("DROP SEQUENCE s.q;", "s.q")):
+    statement = list(pg_lock.statements(io.StringIO(command + "\n")))[0]
+    assert statement.table == relation and statement.lock == "ACCESS EXCLUSIVE", (command, statement.table)
+    assert statement.kind() == "heavy", (command, statement.kind())
+for command, table in (("VACUUM;", None), ("VACUUM FULL;", None), ("VACUUM (VERBOSE, ANALYZE);", None), ("VACUUM ANALYZE s.t;", "s.t"), ("VACUUM FULL s.t;", "s.t")):
+    statement = list(pg_lock.statements(io.StringIO(command + "\n")))[0]
+    assert statement.table == table and statement.kind() == "not_transactional", (command, statement.table, statement.kind())
+# heavy drop is not merged into light part
+update = "CREATE FUNCTION s.f() RETURNS int AS $$ SELECT 1 $$ LANGUAGE sql;\nDROP VIEW s.v;\nVACUUM;\n"
+assert [st for st, data in pg_project.split_update(update, 120000)] == [True, True, False]
+PY
+
+py_check "lock of directory: shared locks together, exclusive lock waits for them" <<'PY'
+from __future__ import unicode_literals
+import os, shutil, tempfile, threading
+import utils
+directory = tempfile.mkdtemp()
+try:
+    events = []
+    def exclusive():
+        with utils.Lock(directory, exclusive=True):
+            events.append("exclusive")
+    with utils.Lock(directory):
+        with utils.Lock(directory):
+            thread = threading.Thread(target=exclusive)
+            thread.start()
+            thread.join(0.3)
+            assert events == [] and thread.is_alive()
+            events.append("shared")
+    thread.join(5)
+    assert events == ["shared", "exclusive"], events
+    assert os.path.isfile(os.path.join(directory, "lock"))
+finally:
+    shutil.rmtree(directory)
+PY
+
+py_check "backfill in mng: quoted identifiers of header, top level WHERE outside of strings" <<'PY'
+from __future__ import unicode_literals
+import io, os, sys, shutil, tempfile, logging
+try:
+    import psycopg2
+except ImportError:
+    print("psycopg2 is not installed, check skipped")
+    sys.exit(0)
+# modules of pgdist mng
+sys.path.insert(0, os.path.join(os.path.dirname(os.environ["PYTHONPATH"]), "mng"))
+import pg, pg_project
+assert pg.split_where("UPDATE t SET a = 'it''s WHERE' WHERE b = 1") == ("UPDATE t SET a = 'it''s WHERE'", "b = 1")
+assert pg.split_where('UPDATE t SET "a "" WHERE" = 1 WHERE b = 1') == ('UPDATE t SET "a "" WHERE" = 1', "b = 1")
+assert pg.split_where("UPDATE t SET a = E'x\\' WHERE' WHERE b = 'y\\'") == ("UPDATE t SET a = E'x\\' WHERE'", "b = 'y\\'")
+assert pg.split_where("UPDATE t SET a = (SELECT 1 WHERE true)") == ("UPDATE t SET a = (SELECT 1 WHERE true)", None)
+directory = tempfile.mkdtemp()
+try:
+    for fname, header in (("a.sql", '-- backfill: s."my ""t""" "my key" 500\n'), ("b.sql", "-- backfill: s.t id\n")):
+        with io.open(os.path.join(directory, fname), "w") as f:
+            f.write("--\n-- pgdist update\n--\n%s--\n-- end header\n" % (header,))
+    assert pg_project.ProjectUpdatePart("a.sql", directory, 1).backfill == ('s."my ""t"""', '"my key"', 500)
+    assert pg_project.ProjectUpdatePart("b.sql", directory, 1).backfill == ("s.t", "id", 10000)
+    # squashed chain refuses parts with own transaction control
+    assert not pg_project.transaction_control("CREATE FUNCTION f() RETURNS void AS $f$ BEGIN\n  PERFORM 'COMMIT;';\nEND; $f$ LANGUAGE plpgsql;\nINSERT INTO t VALUES ('; BEGIN');\n-- COMMIT;\n")
+    for command in ("CREATE TABLE t (x int);\nCOMMIT;\n", "begin;\nCREATE TABLE t (x int);\n", "SAVEPOINT a;", "START TRANSACTION;"):
+        assert pg_project.transaction_control(command), command
+    class Update:
+        def __init__(self, *fnames):
+            self.parts = [pg_project.ProjectUpdatePart(fname, directory, i + 1) for i, fname in enumerate(fnames)]
+    with io.open(os.path.join(directory, "c.sql"), "w") as f:
+        f.write("--\n-- pgdist update\n--\n-- end header\nBEGIN;\nCREATE TABLE t (x int);\nCOMMIT;\n")
+    with io.open(os.path.join(directory, "d.sql"), "w") as f:
+        f.write("--\n-- pgdist update\n--\n-- end header\nCREATE TABLE t (x int);\n")
+    assert pg_project.can_squash([Update("d.sql"), Update("d.sql")], directory)
+    assert not pg_project.can_squash([Update("d.sql"), Update("c.sql")], directory)
+finally:
+    shutil.rmtree(directory)
+PY
+
+py_check "table data: COPY output parsed while it is read, failed copy is an error" <<'PY'
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import logging
+logging.verbose = logging.debug
+import address, pg_conn, pg_project
+class Project:
+    table_data = [pg_project.TableData("s.big"), pg_project.TableData("s.bad")]
+class Session:
+    def __init__(self, *args):
+        pass
+    def copy_to(self, cmd, snapshot=None, output=None):
+        # output is written by parts, more than capacity of pipe
+        assert output is not None and snapshot == "snap", (output, snapshot)
+        output.write(b'"id","name"\r\n')
+        if "s.bad" in cmd:
+            output.write(b'"1","unterminated')
+            raise pg_conn.PgError(3, cmd, output="canceling statement")
+        for i in range(20000):
+            output.write(b'"%d","n\xc3\xa1zev ""%d"""\r\n"%d","%s"\r\n' % (i, i, -i, pg_conn.NULL_MARKER.encode("utf8")))
+    def close(self):
+        pass
+pg_conn.Session = Session
+pg_conn.connect_address = lambda addr: addr
+pg_conn.PG.export_snapshot = lambda self: setattr(self, "snapshot", "snap")
+pg_conn.PG.release_snapshot = lambda self: setattr(self, "snapshot", None)
+rows = pg_conn.copy_rows(Session(), "COPY s.big TO STDOUT;", "snap")
+assert len(rows) == 40001 and rows[0] == ["id", "name"], rows[:2]
+assert rows[1] == ["0", "název \"0\""] and rows[2] == ["0", None] and rows[-1] == ["-19999", None], rows[-2:]
+try:
+    pg_conn.PG(address.Address("localhost/db")).dump_data(Project())
+    assert False, "no error"
+except pg_conn.PgError as e:
+    assert "canceling statement" in e.output, e.output
+PY
+
+log "test offline finished"